@@ -1,4 +1,8 @@
 import json
+import logging
+import time
+from collections import OrderedDict
+from secrets import token_hex
 
 from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
@@ -6,46 +10,68 @@ from channels.generic.websocket import AsyncWebsocketConsumer
 from django.utils import translation
 from django.utils.module_loading import import_string
 from Crypto.Cipher import AES
-from Crypto import Random
+from Crypto.Random import get_random_bytes
+from Crypto.Util.Padding import pad, unpad
 from urllib.parse import parse_qs
 from db.models import Car
+from tculink.sms.smsgateway import gateway_group, gateway_acks, gateway_ack_latency
+
+logger = logging.getLogger(__name__)
+
+
+# Relayed messages remembered per connection for their delivery acknowledgements
+MAX_PENDING_ACKS = 1000
+
+
+@database_sync_to_async
+def get_gateway_encryption_key(device_id):
+    sms_config = Car.for_gateway_device(device_id).values_list("sms_config", flat=True).first()
+    if sms_config is None:
+        return None
+    return sms_config.get('encryption_key', '')
 
 
 class SMSGatewayConsumer(AsyncWebsocketConsumer):
 
     async def connect(self):
         params = parse_qs(self.scope["query_string"].decode("utf8"), keep_blank_values=False)
+        headers = dict(self.scope['headers'])
         if 'device_id' in params:
             device_id = params['device_id'][0]
-        elif "X-Device-Id" not in self.scope['headers'] or len(self.scope['headers']['X-Device-Id']) < 1:
+        elif len(headers.get(b'x-device-id', b'')) < 1:
             await self.close()
             return
         else:
-            device_id = self.scope['headers']['X-Device-Id']
+            device_id = headers[b'x-device-id'].decode('utf-8')
 
-        cars = await sync_to_async(Car.objects.filter)(sms_config__provider='smsgateway', sms_config__device_id=device_id)
-        cars_count = await sync_to_async(cars.count)()
-        if cars_count == 0:
+        encryption_key = await get_gateway_encryption_key(device_id)
+        if encryption_key is None:
             await self.close()
             return
 
-        first_car = await sync_to_async(cars.first)()
-
         try:
-            key = bytes.fromhex(first_car.sms_config.get('encryption_key', '').strip())
+            key = bytes.fromhex(encryption_key.strip())
+            if len(key) not in AES.key_size:
+                raise ValueError(f"Invalid AES key length {len(key)}")
         except Exception as e:
             print(e)
             await self.close()
             return
 
-        self.user_id = f'sms_{device_id}'
+        self.user_id = gateway_group(device_id)
+        # Key of the device, read once per connection
         self.encryption_key = key
+        # App receives messages to the device in one batch parcel
+        self.batch = params.get('batch', ['0'])[0] == '1'
+        self.pending_acks = OrderedDict()
 
         await self.channel_layer.group_add(self.user_id, self.channel_name)
         await self.accept()
         await self.send_encrypted_parcel(text_data=json.dumps({'type': 'connect'}))
 
 
+    # Parcels in both directions are a random 16 byte IV followed by the AES-CBC encrypted, PKCS7
+    # padded data
     async def send_encrypted_parcel(self, text_data=None, byte_data=None):
         if text_data is None and byte_data is None:
             raise Exception('You must specify either text_data or byte_data!')
@@ -54,22 +80,15 @@ class SMSGatewayConsumer(AsyncWebsocketConsumer):
         if text_data is not None:
             data = text_data.encode('utf-8')
 
-        nonce = Random.new().read(16)
-
-        padding_length = 16 - (len(data) % 16)
-        data += bytes([padding_length]) * padding_length
-
+        nonce = get_random_bytes(16)
         cipher = AES.new(self.encryption_key, AES.MODE_CBC, nonce)
-        encrypted_data = cipher.encrypt(data)
-        encrypted_data = nonce+encrypted_data
-        await self.send(bytes_data=encrypted_data)
+        await self.send(bytes_data=nonce + cipher.encrypt(pad(data, AES.block_size)))
 
     async def decrypt_received_parcel(self, data):
         try:
-            nonce = data[:16]
-            cipher = AES.new(self.encryption_key, AES.MODE_GCM, nonce)
-            return cipher.decrypt(data[16:])
-        except:
+            cipher = AES.new(self.encryption_key, AES.MODE_CBC, data[:16])
+            return unpad(cipher.decrypt(data[16:]), AES.block_size)
+        except ValueError:
             return None
 
     async def disconnect(self, close_code):
@@ -80,22 +99,62 @@ class SMSGatewayConsumer(AsyncWebsocketConsumer):
     async def receive(self, text_data=None, bytes_data=None):
         if text_data is not None and text_data == 'ping':
             await self.send(text_data='pong')
+        elif bytes_data is not None and hasattr(self, 'encryption_key'):
+            data = await self.decrypt_received_parcel(bytes_data)
+            try:
+                parcel = json.loads(data)
+            except (TypeError, ValueError):
+                return
+            if isinstance(parcel, dict) and parcel.get('type') == 'ack':
+                self.receive_acks(parcel.get('acks', []))
+
+    def receive_acks(self, acks):
+        now = time.monotonic()
+        for ack in acks:
+            if not isinstance(ack, dict):
+                continue
+            relayed_at = self.pending_acks.pop(ack.get('id'), None)
+            if relayed_at is None:
+                continue
+            status = 'sent' if ack.get('status') == 'sent' else 'failed'
+            gateway_acks.inc(status=status)
+            gateway_ack_latency.observe(now - relayed_at)
+            if status == 'failed':
+                logger.warning("SMS gateway %s could not send message %s: %s", self.user_id, ack.get('id'),
+                               ack.get('error', ''))
+
+    async def relay_parcels(self, message):
+        parcels = message['parcels']
+        now = time.monotonic()
+        for parcel in parcels:
+            self.pending_acks[parcel['id']] = now
+        while len(self.pending_acks) > MAX_PENDING_ACKS:
+            self.pending_acks.popitem(last=False)
+
+        if self.batch and len(parcels) > 1:
+            await self.send_encrypted_parcel(text_data=json.dumps({'type': 'batch', 'parcels': parcels}))
+        else:
+            for parcel in parcels:
+                await self.send_encrypted_parcel(text_data=json.dumps(parcel))
 
+    # Messages sent to the group by earlier versions, relayed as single parcels
     async def relay_sms(self, message):
-        await self.send_encrypted_parcel(text_data=json.dumps({
+        await self.relay_parcels({'parcels': [{
             'type': 'sms',
+            'id': token_hex(8),
             'sms': message['sms'],
             'phone': message['phone'],
-        }))
+        }]})
 
     async def relay_pdu(self, message):
-        await self.send_encrypted_parcel(text_data=json.dumps({
+        await self.relay_parcels({'parcels': [{
             'type': 'pdu',
+            'id': token_hex(8),
             'data': message['data'],
             'pdu': message['pdu'],
             'length': message['length'],
             'phone': message['phone'],
-        }))
+        }]})
 
 class NotificationConsumer(AsyncWebsocketConsumer):
     async def connect(self):
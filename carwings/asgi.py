@@ -95,11 +95,26 @@ class TokenAuthMiddlewareInstance:
 
 TokenAuthMiddlewareStack = lambda inner: TokenAuthMiddleware(AuthMiddlewareStack(inner))
 from api.routing import websocket_urlpatterns
+from tculink.utils import upstream
+
+
+async def lifespan(scope, receive, send):
+    # Pooled upstream connections are closed with the event loop they belong to
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await upstream.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
 
 application = ProtocolTypeRouter(
     {
         "http": get_asgi_application(),
         "websocket": TokenAuthMiddlewareStack(URLRouter(websocket_urlpatterns)),
+        "lifespan": lifespan,
     }
 )
 
@@ -193,6 +193,9 @@ AUTH_USER_MODEL = "db.User"
 SIGNUP_ENABLED = True
 ACTIVATION_SMS_MESSAGE = "NISSAN_EVIT_TELEMATICS_CENTER"
 
+# Optional third element holds provider options, e.g. {"rate": 5, "burst": 10, "concurrency": 4, "timeout": 10}
+# (requests per second, requests sent at once after idling, concurrent requests, seconds to wait for the API),
+# defaults are 10, 10, 4 and 10. "pool_size" sets the HTTP connections kept open, by default "concurrency"
 SMS_PROVIDERS = {
     #'viaaqmobile': ('viaaq mobile', 'tculink.sms.viaaqmobile.ProviderViaaqMobileGlobal'),   # for larger instances
     'viaaqmobile': ('viaaq mobile', 'tculink.sms.viaaqmobile.ProviderViaaqMobileAPIToken'), # for self-hosting
@@ -226,6 +229,66 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Shared by the web server and tcuserver workers, used for TCU identity lookups
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.environ["REDIS_HOST"],
+    }
+}
+
+# Seconds to keep TCU identities in the shared cache and in the per-process cache
+TCU_IDENTITY_CACHE_TTL = 300
+TCU_IDENTITY_LOCAL_TTL = 5
+
+# Database threads (and connections) per tcuserver worker
+TCU_SERVER_DB_THREADS = 8
+# Connection limits of a tcuserver worker, timeouts in seconds
+TCU_SERVER_MAX_CONNECTIONS = 1000
+TCU_SERVER_MAX_SESSIONS_PER_VIN = 2
+TCU_SERVER_READ_TIMEOUT = 30
+TCU_SERVER_IDLE_TIMEOUT = 300
+# Packets waiting for a database thread before further packets are rejected
+TCU_SERVER_MAX_DB_QUEUE = 200
+# Seconds between full packet dumps of a VIN in the tcuserver log, 0 disables
+TCU_LOG_SAMPLE_INTERVAL = 3600
+# Seconds between reloads of the VINs set with manage.py tcucapture
+TCU_DEBUG_CAPTURE_REFRESH = 10
+# Bearer token required by the /metrics scrape endpoint, the endpoint is disabled when empty
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# Seconds between flushes of metrics of each process to the shared cache
+METRICS_FLUSH_INTERVAL = 15
+# Quota of captured debug payloads under logs/, oldest captures are deleted first
+CAPTURE_MAX_BYTES = 256 * 1024 * 1024
+CAPTURE_MAX_FILES = 10000
+# Append captures to compressed files instead of writing a file per payload
+CAPTURE_COMPRESS = False
+# Notifications delivered concurrently by each notification worker
+NOTIFICATION_CONCURRENCY = 4
+# Delivery attempts of a notification, waiting NOTIFICATION_RETRY_DELAY seconds doubled after every failure
+NOTIFICATION_MAX_ATTEMPTS = 5
+NOTIFICATION_RETRY_DELAY = 30
+# Seconds between command timeout and timer checks of tcuscheduler
+SCHEDULER_INTERVAL = 15
+# Threads sending wake-up SMS, and seconds a scheduler run waits for rate limits before deferring commands
+SMS_DISPATCH_WORKERS = 16
+SMS_DISPATCH_MAX_WAIT = 30
+# Refresh each car at a slot offset by its VIN instead of one interval after its last connection,
+# and wake up at most this many cars per minute (0 for no limit), the others wait for later runs
+PERIODIC_REFRESH_SPREAD = False
+PERIODIC_REFRESH_MAX_PER_MINUTE = 0
+# Queue wake-up SMS in the database and acknowledge commands right away, `manage.py smsworker` sends them
+SMS_OUTBOX = True
+# Send attempts of a queued SMS, waiting SMS_OUTBOX_RETRY_DELAY seconds doubled after every failure
+# (with jitter, at most SMS_OUTBOX_MAX_DELAY), and days sent and failed messages are kept
+SMS_OUTBOX_MAX_ATTEMPTS = 6
+SMS_OUTBOX_RETRY_DELAY = 5
+SMS_OUTBOX_MAX_DELAY = 60
+SMS_OUTBOX_RETENTION = 7
+# Relay SMS gateway messages in relay_parcels events, which only consumers of this version handle.
+# Set to False while web and worker processes of the previous version are still running.
+SMS_GATEWAY_RELAY_PARCELS = True
+
 from datetime import timedelta
 
 SIMPLE_JWT = {
@@ -247,7 +310,14 @@ APNS_USE_SANDBOX = False
 
 FCM_SERVICE_FILE = ""
 FCM_PROJECT_ID = ""
+# Connections kept open to APNs and FCM by each process sending push notifications
+PUSH_MAX_CONNECTIONS = 4
 # Leave empty to disable, the server will try to scrape all location info available, but may fail sometimes
 GOOGLE_API_KEY = ""
 OPENCHARGEMAP_API_KEY = ""
-ITERNIO_API_KEY = ""
\ No newline at end of file
+ITERNIO_API_KEY = ""
+# Connections kept open to third-party APIs (charge points, places, weather) by each process, in total and
+# to one API, and seconds to wait for a response
+UPSTREAM_MAX_CONNECTIONS = 100
+UPSTREAM_MAX_CONNECTIONS_PER_HOST = 25
+UPSTREAM_TIMEOUT = 20
\ No newline at end of file
@@ -62,6 +62,7 @@ urlpatterns = [
     path('navi', views.vflash_editor),
     path('WARCondelivbas/it-m_gw10/', tculink_views.carwings_http_gateway),
     path('ficosa/gdc', tculink_views.ficosa_http_gateway),
+    path('metrics', tculink_views.metrics_endpoint),
     path('signup', views.signup, name='car_list'),
     path('signin', views.signin, name='signin'),
     path('signout', views.signout, name='signout'),
@@ -0,0 +1,77 @@
+# Generated by Django 5.1.15 on 2026-10-18 09:47
+
+import datetime
+import zoneinfo
+
+from django.db import migrations, models
+from django.utils import timezone
+
+# Copies of db.models as of this migration, so later model changes don't alter it
+TIMER_WEEKDAY_FIELDS = ("weekday_mon", "weekday_tue", "weekday_wed", "weekday_thu", "weekday_fri", "weekday_sat",
+                        "weekday_sun")
+TIMER_LEAD = datetime.timedelta(minutes=1)
+BATCH_SIZE = 500
+
+
+def get_user_timezone(name):
+    try:
+        return zoneinfo.ZoneInfo(name or "UTC")
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        return datetime.timezone.utc
+
+
+def next_timer_fire(timer, after, tz):
+    after = after.astimezone(datetime.timezone.utc)
+    weekdays = {day for day, field in enumerate(TIMER_WEEKDAY_FIELDS) if getattr(timer, field)}
+
+    candidate_days = []
+    if timer.date is not None:
+        candidate_days += [timer.date + datetime.timedelta(days=offset) for offset in (-1, 0, 1)]
+    if weekdays:
+        candidate_days += [after.date() + datetime.timedelta(days=offset) for offset in range(-1, 9)]
+
+    fire_times = []
+    for day in candidate_days:
+        fire_at = datetime.datetime.combine(day, timer.time, tzinfo=datetime.timezone.utc)
+        if fire_at <= after:
+            continue
+        local_day = fire_at.astimezone(tz).date()
+        if local_day == timer.date or local_day.weekday() in weekdays:
+            fire_times.append(fire_at)
+    return min(fire_times, default=None)
+
+
+def compute_next_fire_at(apps, schema_editor):
+    CommandTimerSetting = apps.get_model('db', 'CommandTimerSetting')
+    Car = apps.get_model('db', 'Car')
+    now = timezone.now()
+    timers = (CommandTimerSetting.objects.filter(enabled=True).order_by('pk')
+              .prefetch_related(models.Prefetch('car_set', queryset=Car.objects.select_related('owner'))))
+    updated = []
+    for timer in timers.iterator(chunk_size=BATCH_SIZE):
+        cars = timer.car_set.all()
+        after = now
+        if timer.last_command_execution is not None:
+            after = max(after, timer.last_command_execution + TIMER_LEAD)
+        timer.next_fire_at = next_timer_fire(timer, after, get_user_timezone(cars[0].owner.timezone if cars else None))
+        updated.append(timer)
+        if len(updated) >= BATCH_SIZE:
+            CommandTimerSetting.objects.bulk_update(updated, ['next_fire_at'], batch_size=BATCH_SIZE)
+            updated = []
+    CommandTimerSetting.objects.bulk_update(updated, ['next_fire_at'], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0062_cartransferrequest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commandtimersetting',
+            name='next_fire_at',
+            field=models.DateTimeField(blank=True, db_index=True, default=None, editable=False, null=True),
+        ),
+        migrations.RunPython(compute_next_fire_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.15 on 2026-10-18 09:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0063_commandtimersetting_next_fire_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='car',
+            index=models.Index(condition=models.Q(('command_result__in', (-1, 3))), fields=['command_result', 'command_request_time'], name='car_pending_command_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.15 on 2026-10-18 09:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0064_car_pending_command_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='car',
+            index=models.Index(condition=models.Q(('periodic_refresh__gt', 0), ('periodic_refresh_running__gt', 0), _connector='OR'), fields=['last_connection'], name='car_periodic_refresh_idx'),
+        ),
+    ]
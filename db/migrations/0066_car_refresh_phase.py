@@ -0,0 +1,36 @@
+# Generated by Django 5.1.15 on 2026-10-18 09:57
+
+import zlib
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def compute_refresh_phase(apps, schema_editor):
+    Car = apps.get_model('db', 'Car')
+    updated = []
+    for car in Car.objects.only('vin').order_by('pk').iterator(chunk_size=BATCH_SIZE):
+        # Copy of db.models.vin_refresh_phase as of this migration
+        car.refresh_phase = zlib.crc32(car.vin.encode()) & 0x7FFFFFFF
+        updated.append(car)
+        if len(updated) >= BATCH_SIZE:
+            Car.objects.bulk_update(updated, ['refresh_phase'], batch_size=BATCH_SIZE)
+            updated = []
+    Car.objects.bulk_update(updated, ['refresh_phase'], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0065_car_periodic_refresh_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='car',
+            name='refresh_phase',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(compute_refresh_phase, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.15 on 2026-10-18 10:06
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0066_car_refresh_phase'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SMSOutboxMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(max_length=64)),
+                ('command_id', models.IntegerField()),
+                ('message', models.TextField()),
+                ('binary', models.BooleanField(default=False)),
+                ('status', models.IntegerField(choices=[(0, 'Pending'), (1, 'Sent'), (2, 'Failed'), (3, 'Cancelled')], default=0)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('sent_at', models.DateTimeField(blank=True, default=None, null=True)),
+                ('last_error', models.TextField(blank=True, default=None, null=True)),
+                ('car', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='db.car')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('status', 0)), fields=['next_attempt_at'], name='sms_outbox_due_idx')],
+            },
+        ),
+    ]
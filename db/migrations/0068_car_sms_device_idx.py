@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-18 10:10
+
+import django.db.models.fields.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0067_smsoutboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='car',
+            index=models.Index(django.db.models.fields.json.KeyTextTransform('device_id', 'sms_config'), name='car_sms_device_idx'),
+        ),
+    ]
@@ -1,10 +1,16 @@
+import datetime
 import re
+import zlib
+import zoneinfo
 from secrets import token_hex
 
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.core import validators
 from django.db import models
+from django.db.models.fields.json import KeyTextTransform
+from django.db.models.functions import Cast, Mod, NullIf
+from django.db.models.lookups import Exact
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
@@ -130,11 +136,63 @@ PROBE_CONFIG_RESULTS = (
     (3, _("Rejected")),
 )
 
+SMS_OUTBOX_STATUS = (
+    (0, _('Pending')),
+    (1, _('Sent')),
+    (2, _('Failed')),
+    (3, _('Cancelled')),
+)
+
 TIMER_TYPE = (
     (0, "One-time"),
     (1, "Repeating")
 )
 
+TIMER_WEEKDAY_FIELDS = ("weekday_mon", "weekday_tue", "weekday_wed", "weekday_thu", "weekday_fri", "weekday_sat",
+                        "weekday_sun")
+# Timer commands are sent this long before the timer time
+TIMER_LEAD = datetime.timedelta(minutes=1)
+
+
+def get_user_timezone(name):
+    try:
+        return zoneinfo.ZoneInfo(name or "UTC")
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        return datetime.timezone.utc
+
+
+def vin_refresh_phase(vin):
+    """Stable offset of a car's periodic refresh slots, taken modulo the refresh interval"""
+    return zlib.crc32(vin.encode()) & 0x7FFFFFFF
+
+
+def next_timer_fire(timer, after, tz):
+    """
+    First time after `after` the timer fires, None if it does not fire again. The time of the
+    timer is in UTC (clients convert it), its date and weekdays are days of the owner's calendar.
+    """
+    if not timer.enabled:
+        return None
+    after = after.astimezone(datetime.timezone.utc)
+    weekdays = {day for day, field in enumerate(TIMER_WEEKDAY_FIELDS) if getattr(timer, field)}
+
+    candidate_days = []
+    if timer.date is not None:
+        # The UTC day of a local date differs by one day at most
+        candidate_days += [timer.date + datetime.timedelta(days=offset) for offset in (-1, 0, 1)]
+    if weekdays:
+        candidate_days += [after.date() + datetime.timedelta(days=offset) for offset in range(-1, 9)]
+
+    fire_times = []
+    for day in candidate_days:
+        fire_at = datetime.datetime.combine(day, timer.time, tzinfo=datetime.timezone.utc)
+        if fire_at <= after:
+            continue
+        local_day = fire_at.astimezone(tz).date()
+        if local_day == timer.date or local_day.weekday() in weekdays:
+            fire_times.append(fire_at)
+    return min(fire_times, default=None)
+
 coordinator_keys = list(COORDINATORS.keys())
 TCU_TYPE = (
     (coordinator_keys[0], _("Continental 2012-2015")),
@@ -297,6 +355,27 @@ class CommandTimerSetting(models.Model):
     weekday_sun = models.BooleanField(default=False)
     time = models.TimeField()
     date = models.DateField(null=True, blank=True)
+    # Next timer time in UTC, updated on save and when the owner or their timezone changes
+    next_fire_at = models.DateTimeField(null=True, default=None, blank=True, editable=False, db_index=True)
+
+    def owner_timezone(self):
+        car = self.car_set.select_related("owner").first() if self.pk is not None else None
+        return get_user_timezone(car.owner.timezone if car is not None else None)
+
+    def update_next_fire_at(self, now=None):
+        after = now or timezone.now()
+        if self.last_command_execution is not None:
+            # Not again for the time it last ran for
+            after = max(after, self.last_command_execution + TIMER_LEAD)
+        self.next_fire_at = next_timer_fire(self, after, self.owner_timezone())
+
+    @staticmethod
+    def due_for_cars(until):
+        """Car and timer pairs of enabled timers due until `until`, fetched in one query"""
+        return (Car.timer_commands.through.objects
+                .filter(commandtimersetting__enabled=True, commandtimersetting__next_fire_at__lte=until)
+                .select_related("car", "car__owner", "commandtimersetting")
+                .order_by("commandtimersetting__next_fire_at", "commandtimersetting_id"))
 
 class VehicleHealthInfo(models.Model):
     # DTC
@@ -346,6 +425,8 @@ class Car(models.Model):
     veh_health = models.OneToOneField(VehicleHealthInfo, on_delete=models.CASCADE, null=True, blank=True)
     periodic_refresh = models.IntegerField(default=0, choices=PERIODIC_REFRESH)
     periodic_refresh_running = models.IntegerField(default=0, choices=PERIODIC_REFRESH_ACTIVE)
+    # Offset of the refresh slots when they are spread, see due_for_refresh
+    refresh_phase = models.IntegerField(default=0, editable=False)
     # Command handle
     command_id = models.IntegerField(default=-1)
     command_result = models.IntegerField(default=-1, choices=COMMAND_RESULTS)
@@ -370,9 +451,95 @@ class Car(models.Model):
     hmac_key = models.CharField(max_length=32, default="", blank=True)
     tcu_type = models.CharField(max_length=32, default='continental2012', choices=TCU_TYPE)
 
+    class Meta:
+        indexes = [
+            # Commands waiting for the car or its response, scanned for timeouts
+            models.Index(fields=["command_result", "command_request_time"], name="car_pending_command_idx",
+                         condition=models.Q(command_result__in=(-1, 3))),
+            # Cars with periodic refresh, scanned by the scheduler
+            models.Index(fields=["last_connection"], name="car_periodic_refresh_idx",
+                         condition=models.Q(periodic_refresh__gt=0) | models.Q(periodic_refresh_running__gt=0)),
+            # SMS gateway device of the car, looked up when the gateway app connects
+            models.Index(KeyTextTransform("device_id", "sms_config"), name="car_sms_device_idx"),
+        ]
+
     def __str__(self):
         return self.vin
 
+    @staticmethod
+    def for_gateway_device(device_id):
+        """Cars sending SMS through an SMS gateway device, filtered by the car_sms_device_idx expression"""
+        # A plain text comparison, the JSON key lookup sms_config__device_id can't use the index
+        return Car.objects.filter(Exact(KeyTextTransform("device_id", "sms_config"), device_id),
+                                  sms_config__provider="smsgateway")
+
+    @staticmethod
+    def due_for_refresh(now, spread=False):
+        """
+        Cars whose periodic refresh is due, selected by the database. Charging or running cars use
+        periodic_refresh_running when it is set. Cars with a pending command, or a command which
+        timed out within their refresh interval, are not due.
+
+        With `spread`, a car is refreshed once per interval at a slot offset by its refresh_phase
+        instead of one interval after its last connection, so cars set up at the same time do not
+        wake up together. A car which connected since its last slot waits for the next one.
+        The annotated refresh_after is the time the car became due.
+        """
+        refresh_interval = models.Case(
+            models.When((models.Q(ev_info__charging=True) | models.Q(ev_info__car_running=True))
+                        & models.Q(periodic_refresh_running__gt=0), then=models.F("periodic_refresh_running")),
+            default=models.F("periodic_refresh"),
+        )
+        if spread:
+            # NULL instead of a division by zero for cars without refresh, which are filtered out
+            period = NullIf(models.ExpressionWrapper(models.F("refresh_interval") * 60,
+                                                     output_field=models.IntegerField()), 0)
+            since_slot = Cast(Mod(models.Value(int(now.timestamp())) - Mod(models.F("refresh_phase"), period), period),
+                              models.IntegerField())
+            elapsed = models.ExpressionWrapper(since_slot * models.Value(datetime.timedelta(seconds=1)),
+                                               output_field=models.DurationField())
+        else:
+            elapsed = models.ExpressionWrapper(
+                models.F("refresh_interval") * models.Value(datetime.timedelta(minutes=1)),
+                output_field=models.DurationField())
+        refresh_after = models.ExpressionWrapper(models.Value(now) - elapsed, output_field=models.DateTimeField())
+        return (Car.objects
+                .filter(models.Q(periodic_refresh__gt=0) | models.Q(periodic_refresh_running__gt=0),
+                        last_connection__isnull=False)
+                .exclude(command_requested=True, command_result=-1)
+                .annotate(refresh_interval=refresh_interval, refresh_after=refresh_after)
+                .filter(refresh_interval__gt=0, last_connection__lt=models.F("refresh_after"))
+                .exclude(command_result=2, command_request_time__gt=models.F("refresh_after"))
+                .select_related("ev_info", "owner"))
+
+# Wake-up SMS of a command, sent and retried by `manage.py smsworker`
+class SMSOutboxMessage(models.Model):
+    car = models.ForeignKey(Car, on_delete=models.CASCADE)
+    provider = models.CharField(max_length=64)
+    command_id = models.IntegerField()
+    # Binary messages are stored hex encoded
+    message = models.TextField()
+    binary = models.BooleanField(default=False)
+    status = models.IntegerField(default=0, choices=SMS_OUTBOX_STATUS)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, default=None, blank=True)
+    last_error = models.TextField(null=True, default=None, blank=True)
+
+    class Meta:
+        indexes = [
+            # Pending messages, picked by the worker once due
+            models.Index(fields=["next_attempt_at"], name="sms_outbox_due_idx", condition=models.Q(status=0)),
+        ]
+
+    def get_message(self):
+        return bytes.fromhex(self.message) if self.binary else self.message
+
+    def set_message(self, message):
+        self.binary = not isinstance(message, str)
+        self.message = message.hex() if self.binary else message
+
 # Probe config
 class ProbeConfig(models.Model):
     car = models.ForeignKey(Car, on_delete=models.CASCADE)
@@ -1,14 +1,129 @@
+import threading
+from contextlib import contextmanager
+
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
-from django.db.models.signals import post_save, pre_delete, pre_save
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, pre_delete, pre_save, post_delete, m2m_changed
 from django.dispatch import receiver
 
-from db.models import Car, AlertHistory, EVInfo, TCUConfiguration, LocationInfo, SendToCarLocation, CommandTimerSetting
+from db.models import Car, AlertHistory, EVInfo, TCUConfiguration, LocationInfo, SendToCarLocation, \
+    CommandTimerSetting, User, vin_refresh_phase
+from tculink.utils.tcu_identity import car_identity_changed, owner_identity_changed, invalidate_tcu_identity
 from ui.serializers import CarSerializer, AlertHistoryFullSerializer
 
+# Set while a car is updated as one unit of work, see coalesced_car_updates
+_coalesce_state = threading.local()
+
+
+def _coalesced_alerts():
+    return getattr(_coalesce_state, "alerts", None)
+
+
+@contextmanager
+def coalesced_car_updates(car):
+    """
+    Skip the per-object broadcasts of car data saved inside the block. One car update and the
+    created alerts are broadcast once the surrounding transaction commits.
+    """
+    _coalesce_state.alerts = []
+    try:
+        yield
+        alerts = _coalesce_state.alerts
+    finally:
+        _coalesce_state.alerts = None
+
+    broadcast_car_updates_on_commit([(car.owner_id, car.pk, alerts)])
+
+
+def broadcast_car_updates_on_commit(updates):
+    """
+    Broadcast car updates and created alerts once the surrounding transaction commits, for
+    changes saved without signals. `updates` holds (owner id, car pk, alert pks) tuples.
+    """
+    def broadcast():
+        channel_layer = get_channel_layer()
+        for owner_id, car_pk, alert_pks in updates:
+            group = f'notif_{owner_id}_user'
+            async_to_sync(channel_layer.group_send)(group, {
+                'type': 'object_update',
+                'object_type': 'car',
+                'serializer': CarSerializer.__module__ + '.' + CarSerializer.__name__,
+                'object': Car.__module__ + '.' + Car.__name__,
+                'data': car_pk
+            })
+            for alert_pk in alert_pks:
+                async_to_sync(channel_layer.group_send)(group, {
+                    'type': 'object_update',
+                    'object_type': 'alert',
+                    'serializer': AlertHistoryFullSerializer.__module__ + '.' + AlertHistoryFullSerializer.__name__,
+                    'object': AlertHistory.__module__ + '.' + AlertHistory.__name__,
+                    'data': alert_pk
+                })
+
+    transaction.on_commit(broadcast, robust=True)
+
+
+# Identity cache is invalidated before broadcasting, so a failing channel layer can't skip it
+@receiver(post_init, sender=Car)
+def remember_car_vin(sender, instance, **kwargs):
+    # Deferred VINs are not loaded just to be remembered
+    instance._saved_vin = instance.__dict__.get("vin") if instance.pk is not None else None
+
+@receiver(post_save, sender=Car)
+def invalidate_car_identity(sender, instance, update_fields=None, **kwargs):
+    car_identity_changed(instance, update_fields, getattr(instance, "_saved_vin", None))
+    if update_fields is None or "vin" in update_fields:
+        instance._saved_vin = instance.vin
+
+@receiver(post_delete, sender=Car)
+def invalidate_deleted_car_identity(sender, instance, **kwargs):
+    invalidate_tcu_identity(instance.vin)
+
+@receiver(post_save, sender=User)
+def invalidate_owner_identity(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        return
+    owner_identity_changed(instance, update_fields)
+
+
+# Spread periodic refresh slots follow the VIN
+@receiver(pre_save, sender=Car)
+def update_car_refresh_phase(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and "refresh_phase" not in update_fields:
+        return
+    instance.refresh_phase = vin_refresh_phase(instance.vin)
+
+
+# Timer times depend on the owner's timezone, next_fire_at is recomputed when it may change
+@receiver(pre_save, sender=CommandTimerSetting)
+def update_timer_next_fire(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and "next_fire_at" not in update_fields:
+        return
+    instance.update_next_fire_at()
+
+def _update_timers_next_fire(timers):
+    for timer in timers:
+        timer.update_next_fire_at()
+        CommandTimerSetting.objects.filter(pk=timer.pk).update(next_fire_at=timer.next_fire_at)
+
+@receiver(m2m_changed, sender=Car.timer_commands.through)
+def update_added_timers_next_fire(sender, instance, action, reverse, pk_set, **kwargs):
+    if action != "post_add":
+        return
+    _update_timers_next_fire([instance] if reverse else CommandTimerSetting.objects.filter(pk__in=pk_set))
+
+@receiver(post_save, sender=User)
+def update_owner_timers_next_fire(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields is not None and "timezone" not in update_fields):
+        return
+    _update_timers_next_fire(CommandTimerSetting.objects.filter(car__owner=instance).distinct())
+
 
 @receiver(post_save, sender=Car)
 def broadcast_car_update(sender, instance, created, **kwargs):
+    if _coalesced_alerts() is not None:
+        return
     channel_layer = get_channel_layer()
     async_to_sync(channel_layer.group_send)(
         f'notif_{instance.owner.id}_user',
@@ -39,6 +154,8 @@ def broadcast_car_timer_update(sender, instance, **kwargs):
 
 @receiver(post_save, sender=EVInfo)
 def broadcast_car_evinfo_update(sender, instance, created, **kwargs):
+    if _coalesced_alerts() is not None:
+        return
     if created:
         return
 
@@ -60,6 +177,8 @@ def broadcast_car_evinfo_update(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=TCUConfiguration)
 def broadcast_car_tcuconf_update(sender, instance, created, **kwargs):
+    if _coalesced_alerts() is not None:
+        return
     if created:
         return
 
@@ -82,6 +201,8 @@ def broadcast_car_tcuconf_update(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=LocationInfo)
 def broadcast_car_locinfo_update(sender, instance, created, **kwargs):
+    if _coalesced_alerts() is not None:
+        return
     if created:
         return
 
@@ -126,6 +247,9 @@ def broadcast_car_send_to_car_update(sender, instance, created, **kwargs):
 def broadcast_new_alert(sender, instance, created, **kwargs):
     if not created:
         return
+    if _coalesced_alerts() is not None:
+        _coalesced_alerts().append(instance.pk)
+        return
     channel_layer = get_channel_layer()
     async_to_sync(channel_layer.group_send)(
         f'notif_{instance.car.owner.id}_user',
@@ -4,7 +4,9 @@ cd /app || echo "Unable to navigate to /app"
 
 python manage.py migrate
 python manage.py collectstatic --noinput
-/usr/sbin/crond -f -l 8 &
+(python manage.py tcuscheduler; [ "$?" -lt 2 ] && kill "$$") &
 (python manage.py tcuserver 0.0.0.0; [ "$?" -lt 2 ] && kill "$$") &
+(python manage.py notificationworker; [ "$?" -lt 2 ] && kill "$$") &
+(python manage.py smsworker; [ "$?" -lt 2 ] && kill "$$") &
 (daphne -b 0.0.0.0 -p 80 --access-log - "$@" carwings.asgi:application; [ "$?" -lt 2 ] && kill "$$") &
 wait
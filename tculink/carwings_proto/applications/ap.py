@@ -3,6 +3,7 @@ import xml.etree.ElementTree as ET
 from db.models import Car
 from tculink.carwings_proto.databuffer import compress_carwings, construct_carwings_filepacket
 from tculink.carwings_proto.xml import carwings_create_xmlfile_content
+from tculink.utils import metrics
 import logging
 logger = logging.getLogger("carwings_apl")
 
@@ -26,6 +27,7 @@ def handle_ap(xml_data, _):
             # confirm TCU ID
             if auth_result and dcm_id != car.tcu_model:
                 logger.info("TCU_id mismatch")
+                metrics.auth_failures.inc(protocol="carwings", reason="tcu_id")
                 auth_result = False
                 reason_title = 'TCU ID mismatch'
                 reason_desc = ('The TCU ID is incorrect. Please correct your TCU ID by visiting '
@@ -44,12 +46,14 @@ def handle_ap(xml_data, _):
             # confirm user&pass
             if auth_result and car.owner.username != username or car.owner.tcu_pass_hash != password:
                 logger.info("Creds mismatch")
+                metrics.auth_failures.inc(protocol="carwings", reason="credentials")
                 auth_result = False
                 reason_title = 'Username or Password is incorrect.'
                 reason_desc = ('The username or password is incorrect. '
                                'Please correct your username or password and try again.')
         except Car.DoesNotExist:
             logger.info("Car DoesNotExist")
+            metrics.auth_failures.inc(protocol="carwings", reason="unknown_car")
             auth_result = False
             reason_title = 'Car not registered with OpenCARWINGS'
             reason_desc = 'The car has not been registered with Open Carwings. Visit Open Carwings website to register your vehicle.'
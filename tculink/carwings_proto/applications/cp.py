@@ -1,9 +1,9 @@
+import asyncio
 import datetime
 import logging
 import math
 import xml.etree.ElementTree as ET
 
-import requests
 from django.conf import settings
 from unidecode import unidecode
 
@@ -13,6 +13,7 @@ from tculink.carwings_proto.meshutils import read_big_endian_u_int32, unpack_mon
     mesh_point_to_map_point
 from tculink.carwings_proto.utils import encode_utf8, parse_std_location_precise
 from tculink.carwings_proto.xml import carwings_create_xmlfile_content
+from tculink.utils import upstream
 from dateutil import parser
 
 logger = logging.getLogger("carwings_cp")
@@ -120,7 +121,24 @@ def find_containing_mesh_id(lat, lon, bounding_boxes):
 
     return nearest_mesh_id, nearest_bbox
 
-def handle_cp(xml_data, files):
+async def get_ocm_chargers(charger_ids):
+    chargers_resp = await upstream.get('https://api.openchargemap.io/v3/poi', "openchargemap", params={
+        'client': 'OpenCARWINGS',
+        'chargepointid': ",".join(charger_ids),
+        'compact': 'false',
+        'maxresults': "150"
+    }, headers={'X-API-Key': settings.OPENCHARGEMAP_API_KEY})
+    try:
+        chargers_resp = chargers_resp.json()
+    except Exception as e:
+        logger.error("Failed to parse OCM charge chunk, chunk: %s, response: status %d, %s", charger_ids,
+                     chargers_resp.status_code, chargers_resp.text)
+        logger.exception(e)
+        chargers_resp = []
+    logger.debug((len(chargers_resp)))
+    return chargers_resp
+
+async def handle_cp(xml_data, files):
     if 'send_data' in xml_data['service_info']['application']:
         if len(xml_data['service_info']['application']['send_data']) == 0:
             return None
@@ -144,7 +162,7 @@ def handle_cp(xml_data, files):
         if req_id == 281:
             location_center = parse_std_location_precise(int.from_bytes(file_content[13:17], "big"), int.from_bytes(file_content[9:13], "big"))
             logger.debug("handle availability!! %f, %f", location_center[0], location_center[1])
-            chargers = requests.get("https://api.iternio.com/1/get_chargers", params={
+            chargers = await upstream.get("https://api.iternio.com/1/get_chargers", "iternio", params={
                 'lat': str(location_center[0]),
                 'lon': str(location_center[1]),
                 'radius': '35000',
@@ -175,7 +193,7 @@ def handle_cp(xml_data, files):
                 charger_ids.append(int.from_bytes(data[(i * 4):(i * 4) + 4], byteorder="big"))
 
             logger.debug("get chargingstation for availability!! %d", count)
-            chargers = requests.post('https://api.iternio.com/2/charger/_get/details', json={
+            chargers = await upstream.post('https://api.iternio.com/2/charger/_get/details', "iternio", json={
                 'chargerIds': charger_ids
             }, headers={"x-api-key": settings.ITERNIO_API_KEY})
             try:
@@ -395,7 +413,7 @@ def handle_cp(xml_data, files):
             boundingbox_br = "(" + (",".join([str(x) for x in bbox[2]])) + ")"
             logger.info("TOP LEFT: %s", boundingbox_tl)
             logger.info("BOTTOM RIGHT: %s", boundingbox_br)
-            chargers_resp = requests.get('https://api.openchargemap.io/v3/poi', params={
+            chargers_resp = await upstream.get('https://api.openchargemap.io/v3/poi', "openchargemap", params={
                 'client': 'OpenCARWINGS',
                 'compact': 'true',
                 # Type 1,2 & Chademo
@@ -458,22 +476,9 @@ def handle_cp(xml_data, files):
 
             chargers_info = []
 
-            for chunk in chunks(charger_ids, 150):
-                chargers_resp = requests.get('https://api.openchargemap.io/v3/poi', params={
-                    'client': 'OpenCARWINGS',
-                    'chargepointid': ",".join(chunk),
-                    'compact': 'false',
-                    'maxresults': "150"
-                }, headers={'X-API-Key': settings.OPENCHARGEMAP_API_KEY})
-                try:
-                    chargers_resp = chargers_resp.json()
-                except Exception as e:
-                    logger.error("Failed to parse OCM charge chunk, chunk: %s, response: status %d, %s", chunk, chargers_resp.status_code,
-                                 chargers_resp.text)
-                    logger.exception(e)
-                    chargers_resp = []
-                logger.debug((len(chargers_resp)))
-                chargers_info = chargers_info + chargers_resp
+            # Chunks are requested concurrently
+            for chunk in await asyncio.gather(*(get_ocm_chargers(chunk) for chunk in chunks(charger_ids, 150))):
+                chargers_info = chargers_info + chunk
 
             logger.info("TOTAL CP INFO: %d", len(chargers_info))
             for charger in chargers_info:
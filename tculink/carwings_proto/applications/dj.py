@@ -11,6 +11,7 @@ from tculink.carwings_proto.databuffer import get_carwings_dj_payload, construct
 from tculink.carwings_proto.dataobjects import construct_gnrlms_payload
 from tculink.carwings_proto.utils import carwings_lang_to_code, get_cws_authenticated_car
 from tculink.carwings_proto.xml import carwings_create_xmlfile_content
+from tculink.utils.capture import capture
 from django.utils.translation import gettext as _
 
 logger = logging.getLogger("carwings_apl")
@@ -36,20 +37,14 @@ def handle_dj(xml_data, files):
         dj_payload = get_carwings_dj_payload(file_content)
         if dj_payload is None:
             logger.error("DJ Payload is not valid!")
-            log_dir = os.path.join("logs", "dj", xml_data['authentication']['navi_id'],
-                                   datetime.now().strftime('%Y%m%d%H%M%S.%s'))
-            os.makedirs(log_dir, exist_ok=True)
-            with open(os.path.join(log_dir, f"INVALID-{id_value}"), 'wb') as f:
-                f.write(file_content)
+            log_dir = os.path.join(xml_data['authentication']['navi_id'], datetime.now().strftime('%Y%m%d%H%M%S.%s'))
+            capture("dj", os.path.join(log_dir, f"INVALID-{id_value}"), file_content)
             return None
 
         if len(dj_payload) < 2:
             logger.error("DJ Payload is invalid!")
-            log_dir = os.path.join("logs", "dj", xml_data['authentication']['navi_id'],
-                                   datetime.now().strftime('%Y%m%d%H%M%S.%s'))
-            os.makedirs(log_dir, exist_ok=True)
-            with open(os.path.join(log_dir, f"UNKNOWNDJPAYL-{id_value}"), 'wb') as f:
-                f.write(file_content)
+            log_dir = os.path.join(xml_data['authentication']['navi_id'], datetime.now().strftime('%Y%m%d%H%M%S.%s'))
+            capture("dj", os.path.join(log_dir, f"UNKNOWNDJPAYL-{id_value}"), file_content)
             return None
 
         activate(carwings_lang_to_code(xml_data['base_info'].get('navigation_settings', {}).get('language', '')))
@@ -128,17 +123,11 @@ def handle_dj(xml_data, files):
                     datapos += 3
                 else:
                     datapos += 3
-                    log_dir = os.path.join("logs", "dj", xml_data['authentication']['navi_id'],
-                                           datetime.now().strftime('%Y%m%d%H%M%S.%s'))
-                    os.makedirs(log_dir, exist_ok=True)
-                    with open(os.path.join(log_dir, f"UNKNOWNID-{id_value}"), 'wb') as f:
-                        f.write(file_content)
+                    log_dir = os.path.join(xml_data['authentication']['navi_id'], datetime.now().strftime('%Y%m%d%H%M%S.%s'))
+                    capture("dj", os.path.join(log_dir, f"UNKNOWNID-{id_value}"), file_content)
         else:
-            log_dir = os.path.join("logs", "dj", xml_data['authentication']['navi_id'],
-                                   datetime.now().strftime('%Y%m%d%H%M%S.%s'))
-            os.makedirs(log_dir, exist_ok=True)
-            with open(os.path.join(log_dir, f"UNKNOWNACT-{id_value}"), 'wb') as f:
-                f.write(file_content)
+            log_dir = os.path.join(xml_data['authentication']['navi_id'], datetime.now().strftime('%Y%m%d%H%M%S.%s'))
+            capture("dj", os.path.join(log_dir, f"UNKNOWNACT-{id_value}"), file_content)
 
         deactivate()
 
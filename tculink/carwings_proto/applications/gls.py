@@ -5,9 +5,10 @@ import math
 import uuid
 import xml.etree.ElementTree as ET
 from urllib.parse import parse_qsl
+
+from asgiref.sync import sync_to_async
 from django.core.cache import cache
 
-import requests
 from PIL import Image
 from django.conf import settings
 from django.utils.http import urlencode
@@ -15,6 +16,7 @@ from unidecode import unidecode
 
 from tculink.carwings_proto.databuffer import construct_carwings_filepacket, compress_carwings
 from tculink.carwings_proto.xml import carwings_create_xmlfile_content
+from tculink.utils import upstream
 
 logger = logging.getLogger("carwings_apl")
 
@@ -26,7 +28,14 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
     return earth_radius * c
 
-def nominatim_radius_search(lat, lon, radius_km, query, limit=60):
+def make_thumbnail(image_data, width, height):
+    img = Image.open(io.BytesIO(image_data))
+    img.thumbnail((width, height), Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    img.save(output, format='JPEG')
+    return output.getvalue()
+
+async def nominatim_radius_search(lat, lon, radius_km, query, limit=60):
     delta_lat = radius_km / 111.0
     delta_lon = radius_km / (111.0 * math.cos(math.radians(lat)))
 
@@ -45,7 +54,7 @@ def nominatim_radius_search(lat, lon, radius_km, query, limit=60):
         'extratags': 1
     }
 
-    response = requests.get("https://nominatim.openstreetmap.org/search", params=params)
+    response = await upstream.get("https://nominatim.openstreetmap.org/search", "nominatim", params=params)
     if response.status_code == 200:
         results = response.json()
         filtered = []
@@ -72,13 +81,13 @@ def nominatim_radius_search(lat, lon, radius_km, query, limit=60):
         logger.error("Error: %d", response.status_code)
         return []
 
-def nominatim_place_info(place_id):
+async def nominatim_place_info(place_id):
     params = {
         'place_id': str(place_id),
         'format': 'json'
     }
 
-    response = requests.get("https://nominatim.openstreetmap.org/details", params=params)
+    response = await upstream.get("https://nominatim.openstreetmap.org/details", "nominatim", params=params)
     if response.status_code == 200:
         place_info = response.json()
         address = ""
@@ -103,7 +112,7 @@ def nominatim_place_info(place_id):
         logger.error("Error: %d", response.status_code)
         return None
 
-def google_radius_search(lat, lon, radius_km, query, pagetoken=None):
+async def google_radius_search(lat, lon, radius_km, query, pagetoken=None):
     params = {
         'query': query,
         'location': f"{lat},{lon}",
@@ -113,7 +122,8 @@ def google_radius_search(lat, lon, radius_km, query, pagetoken=None):
     if pagetoken is not None:
         params['pagetoken'] = pagetoken
 
-    response = requests.get('https://maps.googleapis.com/maps/api/place/textsearch/json', params=params)
+    response = await upstream.get('https://maps.googleapis.com/maps/api/place/textsearch/json', "google_places",
+                                  params=params)
     if response.status_code == 200:
         results = response.json()
         logger.info(results)
@@ -143,14 +153,15 @@ def google_radius_search(lat, lon, radius_km, query, pagetoken=None):
         logger.error("Error: %d", response.status_code)
         return [], None
 
-def google_place_info(place_id):
+async def google_place_info(place_id):
     params = {
         'place_id': str(place_id),
         'fields': 'name,formatted_address,international_phone_number,website,photo,rating,reviews',
         'key': settings.GOOGLE_API_KEY,
     }
 
-    response = requests.get('https://maps.googleapis.com/maps/api/place/details/json', params=params)
+    response = await upstream.get('https://maps.googleapis.com/maps/api/place/details/json', "google_places",
+                                  params=params)
     if response.status_code == 200:
         place_info = response.json().get('result', {})
         photo_url = ""
@@ -182,7 +193,7 @@ def google_place_info(place_id):
         logger.error("Error: %d", response.status_code)
         return None
 
-def handle_gls(xml_data, files):
+async def handle_gls(xml_data, files):
     if 'send_data' in xml_data['service_info']['application']:
         if len(xml_data['service_info']['application']['send_data']) == 0:
             return None
@@ -228,7 +239,7 @@ def handle_gls(xml_data, files):
             radius = int(parsed_query["radius"])+10
             startpos = int(parsed_query["start"])
             if len(settings.GOOGLE_API_KEY) == 0:
-                results = nominatim_radius_search(near_latlon[0], near_latlon[1], radius, parsed_query["q"])[startpos:startpos+20]
+                results = (await nominatim_radius_search(near_latlon[0], near_latlon[1], radius, parsed_query["q"]))[startpos:startpos+20]
                 legal_notice = "OpenStreetMaps and contributors"
                 total_items = len(results)
             else:
@@ -239,12 +250,12 @@ def handle_gls(xml_data, files):
                     curr_page = 0
                     while curr_page < scroll_pages-1:
                         curr_page += 1
-                        _, pagetoken = google_radius_search(near_latlon[0], near_latlon[1], radius, parsed_query["q"], page_token)
+                        _, pagetoken = await google_radius_search(near_latlon[0], near_latlon[1], radius, parsed_query["q"], page_token)
                         if pagetoken is not None:
                             page_token = pagetoken
 
 
-                results, new_token = google_radius_search(near_latlon[0], near_latlon[1], radius, parsed_query["q"], page_token)
+                results, new_token = await google_radius_search(near_latlon[0], near_latlon[1], radius, parsed_query["q"], page_token)
                 logger.info("NEXT PAGE TOKEN: curr:%s, next:%s", page_token, new_token)
                 total_items = len(results)
                 if new_token is not None:
@@ -293,11 +304,11 @@ def handle_gls(xml_data, files):
             if poi_id.startswith('N,'):
                 poi_id = poi_id[2:]
                 logger.info("Nominatim Poi: %s", poi_id)
-                place_info = nominatim_place_info(poi_id)
+                place_info = await nominatim_place_info(poi_id)
             elif poi_id.startswith('G,'):
                 poi_id = poi_id[2:]
                 logger.info("Google Poi: %s", poi_id)
-                place_info = google_place_info(poi_id)
+                place_info = await google_place_info(poi_id)
             else:
                 logger.error("Invalid POI ID identifier!")
                 return None
@@ -323,7 +334,7 @@ def handle_gls(xml_data, files):
                         xml_photo = ET.SubElement(listing, "Images")
                         xml_thumb = ET.SubElement(xml_photo, "IMAGE_THUMB")
                         photo_uuid = uuid.uuid4().__str__()
-                        cache.set(f"GLSPIC_{photo_uuid}", photo["url"], 60*2)
+                        await cache.aset(f"GLSPIC_{photo_uuid}", photo["url"], 60*2)
                         ET.SubElement(xml_thumb, "U").text = f"cache://{photo_uuid}"
                         ET.SubElement(xml_thumb, "IMAGE_HEIGHT").text = str(photo['height'])
                         ET.SubElement(xml_thumb, "IMAGE_WIDTH").text = str(photo['width'])
@@ -353,19 +364,17 @@ def handle_gls(xml_data, files):
             # retrieve photo from cache
             if url.startswith("cache://"):
                 photo_uuid = url.replace("cache://", "")[:38]
-                url = cache.get(f"GLSPIC_{photo_uuid}")
-                cache.delete(f"GLSPIC_{photo_uuid}")
+                url = await cache.aget(f"GLSPIC_{photo_uuid}")
+                await cache.adelete(f"GLSPIC_{photo_uuid}")
 
             if url.startswith('https://maps.googleapis.com/maps/api/place/photo?'):
                 url = url + "&maxwidth=" + str(width) + "&maxheight=" + str(height)+"&key="+settings.GOOGLE_API_KEY
-                jpeg_data = requests.get(url).content
+                jpeg_data = (await upstream.get(url, "google_places")).content
             else:
-                temp_jpeg_data = requests.get(url).content
-                img = Image.open(io.BytesIO(temp_jpeg_data))
-                img.thumbnail((int(width), int(height)), Image.Resampling.LANCZOS)
-                output = io.BytesIO()
-                img.save(output, format='JPEG')
-                jpeg_data = output.getvalue()
+                temp_jpeg_data = (await upstream.get(url, "gls_image")).content
+                # decoding and resizing is CPU bound, keep it off the event loop
+                jpeg_data = await sync_to_async(make_thumbnail, thread_sensitive=False)(
+                    temp_jpeg_data, int(width), int(height))
 
             resp_file += len(jpeg_data).to_bytes(4, byteorder='big')
             resp_file += jpeg_data
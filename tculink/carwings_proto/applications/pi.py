@@ -3,7 +3,6 @@ import io
 import os
 import xml.etree.ElementTree as ET
 from datetime import datetime
-import random
 import uuid
 
 from django.conf import settings
@@ -17,6 +16,7 @@ from tculink.carwings_proto.probe_dot import parse_dotfile, prb_dotfiletypes
 from tculink.carwings_proto.utils import calculate_prb_data_checksum, get_cws_authenticated_car, \
     calculate_prb_update_checksum
 from tculink.carwings_proto.xml import carwings_create_xmlfile_content
+from tculink.utils.capture import capture
 import logging
 logger = logging.getLogger("probe")
 
@@ -31,9 +31,7 @@ def handle_pi(xml_data, files):
         carwings_xml_root = ET.Element("carwings", version="2.2")
         ET.SubElement(carwings_xml_root, "aut_inf", {"sts": "ok"})
 
-        if DEBUG_ENABLED:
-            log_dir = os.path.join("logs", "probe", xml_data['authentication']['navi_id'], datetime.now().strftime('%Y%m%d%H%M'))
-            os.makedirs(log_dir, exist_ok=True)
+        log_dir = os.path.join(xml_data['authentication']['navi_id'], datetime.now().strftime('%Y%m%d%H%M'))
 
         for send_data in xml_data['service_info']['application']['send_data']:
             id_type = send_data['id_type']
@@ -162,25 +160,15 @@ def handle_pi(xml_data, files):
                         if checksum != checksum_byte:
                             logger.info("Probe file checksum error!")
                             if DEBUG_ENABLED:
-                                file_path = os.path.join(log_dir, f"CHKSUMERR-{hex(checksum_byte)}-{hex(checksum)}-{filename}")
-                                if os.path.exists(file_path):
-                                    file_path = os.path.join(log_dir,
-                                                             f"dupl-{random.randrange(111111, 999999, 6)}-CHKSUMERR-{hex(checksum_byte)}-{hex(checksum)}-{filename}")
-                                with open(file_path, 'wb') as f:
-                                    f.write(probe_data)
+                                capture("probe", os.path.join(log_dir, f"CHKSUMERR-{hex(checksum_byte)}-{hex(checksum)}-{filename}"),
+                                        probe_data)
                         else:
                             decrypted_data_for_log = bytearray(probe_data[:10])
                             decrypted_data = probe_xor_data(probe_data[10:(len(probe_data)-1)], xor_key)
                             decrypted_data_for_log += decrypted_data
 
                             if DEBUG_ENABLED:
-                                file_path = os.path.join(log_dir,filename)
-
-                                if os.path.exists(file_path):
-                                    file_path = os.path.join(log_dir, f"dupl-{random.randrange(111111, 999999, 6)}-{filename}")
-
-                                with open(file_path, 'wb') as f:
-                                    f.write(decrypted_data_for_log)
+                                capture("probe", os.path.join(log_dir, filename), decrypted_data_for_log)
 
                             if len(decrypted_data) > 38:
                                 data = decrypted_data[38:]
@@ -235,25 +223,10 @@ def handle_pi(xml_data, files):
                 else:
                     logger.error("Invalid Probe file signature! Got: %s,%s", hex(probe_data[0]), hex(probe_data[1]))
                     if DEBUG_ENABLED:
-                        file_path = os.path.join(log_dir, f"UNKNOWN-{filename}")
-
-                        if os.path.exists(file_path):
-                            file_path = os.path.join(log_dir, f"dupl-{random.randrange(111111, 999999, 6)}-UNKNOWN-{filename}")
-
-                        with open(file_path, 'wb') as f:
-                            f.write(probe_data)
+                        capture("probe", os.path.join(log_dir, f"UNKNOWN-{filename}"), probe_data)
             else:
                 # Unknown request, write to log
-                log_dir = os.path.join("logs", "probe", xml_data['authentication']['navi_id'],
-                                       datetime.now().strftime('%Y%m%d%H%M'))
-                os.makedirs(log_dir, exist_ok=True)
-                file_path = os.path.join(log_dir, id_value)
-
-                if os.path.exists(file_path):
-                    file_path = os.path.join(log_dir, f"unkreq-{random.randrange(111111, 999999, 6)}-{id_value}")
-
-                with open(file_path, 'wb') as f:
-                    f.write(file_content)
+                capture("probe", os.path.join(log_dir, id_value), file_content)
 
 
         srv_inf = ET.SubElement(carwings_xml_root, "srv_inf")
@@ -3,9 +3,7 @@ from suntime import Sun
 import os
 from datetime import timedelta, datetime
 from io import BytesIO
-import geopy.geocoders
 import pngquant
-import requests
 from PIL import Image, ImageFont, ImageDraw, ImageOps
 from django.utils import timezone
 from django.utils.text import format_lazy
@@ -14,6 +12,7 @@ from django.utils.translation import gettext as _
 from tculink.carwings_proto.autodj import NOT_AVAIL_AUTODJ_ITEM
 from tculink.carwings_proto.dataobjects import build_autodj_payload
 from tculink.carwings_proto.utils import xml_coordinate_to_float, encode_utf8
+from tculink.utils import upstream
 
 logger = logging.getLogger("carwings_apl")
 
@@ -96,11 +95,16 @@ def is_daylight(lat, lon):
         return False
 
 def get_city(lat, lon):
-    geolocator = geopy.geocoders.nominatim.Nominatim(user_agent="OpenCARWINGS", timeout=3)
     try:
-        location = geolocator.reverse((lat, lon))
-        city = location.raw['address'].get('city', location.raw['address'].get('town', location.raw['address'].get('municipality', location.raw['address'].get('county', "Weather nearby"))))
-        suburb = location.raw['address'].get('hamlet',  location.raw['address'].get('suburb', location.raw['address'].get('city_district', None)))
+        response = upstream.request_sync("GET", "https://nominatim.openstreetmap.org/reverse", "nominatim", params={
+            "lat": str(lat),
+            "lon": str(lon),
+            "format": "json",
+            "addressdetails": "1",
+        }, timeout=3)
+        address = response.json()['address']
+        city = address.get('city', address.get('town', address.get('municipality', address.get('county', "Weather nearby"))))
+        suburb = address.get('hamlet',  address.get('suburb', address.get('city_district', None)))
         if suburb is not None and suburb != city:
             return f"{suburb}, {city}"
         return city
@@ -117,7 +121,7 @@ def get_weather_data(lat, lon, tz="UTC"):
         "timezone": tz,  # Open-Meteo will return UTC, adjust locally
         "forecast_days": 8
     }
-    response = requests.get(url, params=params, headers={"User-Agent": "OpenCARWINGS"})
+    response = upstream.request_sync("GET", url, "open_meteo", params=params, headers={"User-Agent": "OpenCARWINGS"})
     if response.status_code == 200:
         return response.json()
     else:
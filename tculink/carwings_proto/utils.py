@@ -3,6 +3,7 @@ from django.utils import timezone
 
 from carwings import settings
 from db.models import Car
+from tculink.utils.tcu_identity import get_tcu_identity
 from django.utils.translation import gettext as _
 from unidecode import unidecode
 logger = logging.getLogger("carwings")
@@ -18,23 +19,23 @@ def get_cws_authenticated_car(xml_data, check_user=True) -> Car|None:
         password = xml_data['authentication']['password']
 
         # find car
-        try:
-            car = Car.objects.get(vin=car_vin)
-
-            if navi_id != car.tcu_serial:
-                return None
+        identity = get_tcu_identity(car_vin)
+        if identity is None or navi_id != identity["tcu_serial"]:
+            return None
 
-            # authenticate without user&pass for QY8XXX by detecting rss format
-            if 'base_info' in xml_data and 'vehicle' in xml_data['base_info']:
-                signal_level = xml_data['base_info']['vehicle'].get('rss', '')
-                if signal_level == "out" or signal_level == "in":
-                    return car
+        # authenticate without user&pass for QY8XXX by detecting rss format
+        skip_user_check = False
+        if 'base_info' in xml_data and 'vehicle' in xml_data['base_info']:
+            signal_level = xml_data['base_info']['vehicle'].get('rss', '')
+            skip_user_check = signal_level == "out" or signal_level == "in"
 
-            # confirm user&pass
-            if check_user and (car.owner.username != username or car.owner.tcu_pass_hash != password):
-                return None
+        # confirm user&pass
+        if check_user and not skip_user_check and (identity["owner_username"] != username or
+                                                   identity["owner_tcu_pass_hash"] != password):
+            return None
 
-            return car
+        try:
+            return Car.objects.get(vin=car_vin)
         except Car.DoesNotExist:
             return None
     return None
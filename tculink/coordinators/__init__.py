@@ -1,3 +1,6 @@
+from django.utils.module_loading import import_string
+
+
 class TCUCoordinatorError(Exception):
     pass
 
@@ -14,27 +17,23 @@ class SMSError(TCUCoordinatorError):
     pass
 
 
-def get_supported_commands(code: str) -> list[int]:
-    parts = COORDINATORS.get(code).split('.')
-    module = ".".join(parts[:-1])
-    m = __import__( module )
-    for comp in parts[1:]:
-        m = getattr(m, comp)
+def get_coordinator(code: str):
+    """Shared coordinator instance for a TCU type, its class is imported on first use"""
+    coordinator = _coordinators.get(code)
+    if coordinator is None:
+        coordinator = import_string(COORDINATORS[code])()
+        _coordinators[code] = coordinator
+    return coordinator
 
-    coordinator = m()
-    return coordinator.SUPPORTED_COMMANDS
+def get_supported_commands(code: str) -> list[int]:
+    return get_coordinator(code).SUPPORTED_COMMANDS
 
 def get_required_sms_types(code: str):
-    parts = COORDINATORS.get(code).split('.')
-    module = ".".join(parts[:-1])
-    m = __import__( module )
-    for comp in parts[1:]:
-        m = getattr(m, comp)
-
-    coordinator = m()
-    return coordinator.REQUIRED_SMS_TYPES
+    return get_coordinator(code).REQUIRED_SMS_TYPES
 
 COORDINATORS = {
     'continental2012': "tculink.coordinators.continental2012.Continental2012",
     'ficosa2016': "tculink.coordinators.ficosa2016.Ficosa2016",
-}
\ No newline at end of file
+}
+
+_coordinators = {}
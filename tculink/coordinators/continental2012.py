@@ -1,13 +1,10 @@
 from random import randint
 
-from django.utils import timezone
-
 from db.models import Car, COMMAND_TYPES
-from tculink.coordinators import InvalidCommandError, SMSError, CommandArgumentError
-from tculink.coordinators.stub import TCULink
-from tculink.sms import send_using_provider, SMSType
+from tculink.coordinators import InvalidCommandError, CommandArgumentError
+from tculink.coordinators.stub import TCULink, PreparedCommand
+from tculink.sms import SMSType
 from django.conf import settings
-from django.utils.translation import gettext_lazy as _
 
 class Continental2012(TCULink):
     CODE = 'continental2012'
@@ -15,23 +12,10 @@ class Continental2012(TCULink):
     REQUIRED_SMS_TYPES = [SMSType.TEXT]
 
 
-    def send_command(self, command: int, payload, car: Car):
+    def prepare_command(self, command: int, payload, car: Car):
         if command in dict(COMMAND_TYPES) and command in self.SUPPORTED_COMMANDS:
             if payload is not None and set(payload.keys()) != {"timer"}:
                 raise CommandArgumentError("Command does not support payload field")
-            try:
-                sms_result = send_using_provider(settings.ACTIVATION_SMS_MESSAGE, car.sms_config, car.tcu_model)
-                if not sms_result:
-                    raise SMSError(_('Failed to send SMS message to TCU. Please try again in a moment.'))
-            except Exception as e:
-                raise SMSError(str(e))
-            car.command_type = command
-            car.command_id = randint(10000, 99999)
-            car.command_requested = True
-            car.command_result = -1
-            car.command_payload = payload
-            car.command_request_time = timezone.now()
-            car.save()
-            return car
+            return PreparedCommand(settings.ACTIVATION_SMS_MESSAGE, command, randint(10000, 99999), payload)
         else:
             raise InvalidCommandError()
\ No newline at end of file
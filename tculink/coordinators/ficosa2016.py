@@ -1,16 +1,14 @@
 from random import randint
 
-from django.utils import timezone
 from rest_framework.exceptions import ValidationError
 
 from db.models import Car, COMMAND_TYPES
-from tculink.coordinators import InvalidCommandError, SMSError, CommandArgumentError
-from tculink.coordinators.stub import TCULink
+from tculink.coordinators import InvalidCommandError, CommandArgumentError
+from tculink.coordinators.stub import TCULink, PreparedCommand
 from tculink.gdc_proto.acp245 import composer
 from tculink.gdc_proto.ficosa import smshmac
 from tculink.gdc_proto.ficosa.utils import command_to_destination_id, get_config_map_translated
-from tculink.sms import send_using_provider, SMSType
-from django.utils.translation import gettext_lazy as _
+from tculink.sms import SMSType
 
 from ui.serializers import FicosaConfigSerializer
 
@@ -85,7 +83,7 @@ class Ficosa2016(TCULink):
     SUPPORTED_COMMANDS = [1,2,3,4,6,7,8,9,10,11,12,13,14,15]
     REQUIRED_SMS_TYPES = [SMSType.BINARY]
 
-    def send_command(self, command: int, payload, car: Car):
+    def prepare_command(self, command: int, payload, car: Car):
         if command in dict(COMMAND_TYPES) and command in self.SUPPORTED_COMMANDS:
             # check if this is timer command
             timer_id = -1
@@ -123,24 +121,10 @@ class Ficosa2016(TCULink):
 
             msg_hmac = smshmac.sms_acp_rn_hmac(msg, hmac_key)
 
-            try:
-                sms_result = send_using_provider(msg_hmac, car.sms_config, car.tcu_model)
-                if not sms_result:
-                    raise SMSError(_('Failed to send SMS message to TCU. Please try again in a moment.'))
-            except Exception as e:
-                raise SMSError(str(e))
-            car.command_type = command
-            # GDC range is from 0x7f - 0xff
-            car.command_id = source_id
-            car.command_requested = True
-            car.command_result = -1
-
             if payload is None and timer_id != -1:
                 payload = {"timer": timer_id}
 
-            car.command_payload = payload
-            car.command_request_time = timezone.now()
-            car.save()
-            return car
+            # GDC range is from 0x7f - 0xff
+            return PreparedCommand(msg_hmac, command, source_id, payload)
         else:
             raise InvalidCommandError()
\ No newline at end of file
@@ -1,19 +1,36 @@
 import logging
 
-from tculink.coordinators import COORDINATORS
-from tculink.sms import SMSType
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from tculink.coordinators import get_coordinator, SMSError
+from tculink.sms import SMSType, send_using_provider
+from tculink.sms.outbox import outbox_enabled, enqueue_command
 from db.models import Car
 
 
 def send_command_using_provider(command: int, payload: dict | None, car: Car):
-    parts = COORDINATORS.get(car.tcu_type).split('.')
-    module = ".".join(parts[:-1])
-    m = __import__( module )
-    for comp in parts[1:]:
-        m = getattr(m, comp)
+    return get_coordinator(car.tcu_type).send_command(command, payload, car)
+
+
+class PreparedCommand:
+    """Wake-up SMS of a command, and the command state saved to the car once the SMS was sent"""
 
-    coordinator = m()
-    return coordinator.send_command(command, payload, car)
+    def __init__(self, message, command_type: int, command_id: int, command_payload: dict | None):
+        self.message = message
+        self.command_type = command_type
+        self.command_id = command_id
+        self.command_payload = command_payload
+
+    def apply(self, car: Car):
+        car.command_type = self.command_type
+        car.command_id = self.command_id
+        car.command_requested = True
+        car.command_result = -1
+        car.command_payload = self.command_payload
+        car.command_request_time = timezone.now()
+        car.save()
+        return car
 
 # TCU command coordinator for different models
 class TCULink:
@@ -24,5 +41,18 @@ class TCULink:
     def __init__(self):
         pass
 
+    def prepare_command(self, command: int, payload: dict | None, car: Car) -> PreparedCommand:
+        raise NotImplementedError()
+
     def send_command(self, command: int, payload: dict | None, car: Car):
-        raise NotImplementedError()
\ No newline at end of file
+        prepared = self.prepare_command(command, payload, car)
+        if outbox_enabled():
+            # Acknowledged once queued, smsworker sends and retries the SMS
+            return enqueue_command(car, prepared)
+        try:
+            sms_result = send_using_provider(prepared.message, car.sms_config, car.tcu_model)
+            if not sms_result:
+                raise SMSError(_('Failed to send SMS message to TCU. Please try again in a moment.'))
+        except Exception as e:
+            raise SMSError(str(e))
+        return prepared.apply(car)
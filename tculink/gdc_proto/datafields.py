@@ -28,17 +28,30 @@ def get_body_type(byte):
         return "battery_heat"
     return None
 
-def check_packet_size_match(packet):
-    if len(packet) < 5:
-        return False
+# CONFIG packets do not fit into the size byte, they are always 597 bytes long
+CONFIG_PACKET_SIZE = 597
+
+def get_packet_size(packet):
+    """
+    Expected total length of a GDC packet based on its header, or None if the header is not valid.
+    At least 4 bytes of the packet are needed.
+    """
+    if len(packet) < 4:
+        return None
     data_type = get_packet_type(packet[0])
     if data_type[0] == -1:
-        return False
-    if data_type[1] == 5:
-        return len(packet) == 597 and packet[2] == 0x02
+        return None
+    if data_type[0] == 5:
+        if packet[2] != 0x02:
+            return None
+        return CONFIG_PACKET_SIZE
+
+    return int(packet[3])
 
-    size_byte = int(packet[3])
-    return size_byte == len(packet)
+def check_packet_size_match(packet):
+    if len(packet) < 5:
+        return False
+    return get_packet_size(packet) == len(packet)
 
 def parse_tcu_info(packet):
     if len(packet) < 100:
@@ -0,0 +1,254 @@
+"""
+Decode incoming GDC data packets without intermediate copies
+
+Produces the same values as parse_gdc_packet. Fixed fields are read from a memoryview of the
+packet with precompiled struct layouts, bitfields are looked up in tables built once on import.
+Decoded records use __slots__ and can be read like the dicts of parse_gdc_packet, as_dict()
+returns those dicts.
+"""
+import struct
+
+from tculink.gdc_proto.datafields import get_packet_type, get_body_type, parse_config_data
+
+# Packet type, vehicle descriptor, vehicle codes 1-4 and the identity strings
+TCU_INFO_LAYOUT = struct.Struct(">BB2x4Bx17sx12sx15sx12sx20sx9s")
+# GPS flags, latitude degrees, minutes and seconds * 100, longitude the same
+GPS_LAYOUT = struct.Struct(">5xBBBHBBH")
+GPS_OFFSET = 103
+AUTH_LAYOUT = struct.Struct(">x15s2x15s")
+AUTH_OFFSET = 119
+EVINFO_LAYOUT = struct.Struct(">20B")
+EVINFO_AZE0_LAYOUT = struct.Struct(">22B")
+EVINFO_OFFSET = 153
+CONFIG_OFFSET = 102
+
+# Dict keys which are not valid attribute names
+ATTRIBUTE_NAMES = {"pass": "password", "6kw_chg": "chg_6kw"}
+
+
+def _text(value):
+    return value.decode('ascii').rstrip('\x00').strip()
+
+
+def _gps_flags(byte):
+    # valid_position, datum, lat_mode, lon_mode, home_status
+    return (
+        (byte >> 7) & 1 == 1,
+        (byte >> 6) & 1 == 1,
+        "S" if (byte >> 5) & 1 else "N",
+        "W" if (byte >> 4) & 1 else "E",
+        (byte >> 3) & 1 == 0,
+    )
+
+
+def _charge_status(byte):
+    # chargestate, pluggedin, charging, quick_charging, charging_finish, acstate, ignition, parked,
+    # direction_forward
+    charge_state = (byte >> 6) & 0b11
+    charge_finished = charge_state == 3
+    return (
+        charge_state,
+        (byte & 1) == 1,
+        charge_state == 1,
+        charge_state == 2,
+        charge_finished,
+        bool((byte >> 1) & 0b1),
+        bool(byte & 0b00100000),
+        bool(byte & 0b00000100),
+        bool(byte & 0b00001000),
+    )
+
+
+def _result_state(byte):
+    # pri_ac_req_result, pri_ac_stop_result, batt_start_stop
+    return (byte >> 6) & 3, (byte >> 4) & 3, (byte >> 2) & 3
+
+
+def _alert_state(byte):
+    # charge_request_result, charge_stop, not_plugin_alert, error_notification
+    return byte & 0b11, (byte >> 2) & 0b11, ((byte >> 4) & 1) == 1, (byte >> 5) & 0b111
+
+
+def _aze0_flags(byte):
+    # obc_6kw_exist, batt_heat_exist, batt_heat_active
+    return bool((byte >> 4) & 1), bool((byte >> 1) & 1), ((byte >> 2) & 0b11) != 0
+
+
+PACKET_TYPES = tuple(get_packet_type(byte) for byte in range(256))
+BODY_TYPES = tuple(get_body_type(byte) for byte in range(256))
+GPS_FLAGS = tuple(_gps_flags(byte) for byte in range(256))
+CHARGE_STATUS = tuple(_charge_status(byte) for byte in range(256))
+RESULT_STATE = tuple(_result_state(byte) for byte in range(256))
+ALERT_STATE = tuple(_alert_state(byte) for byte in range(256))
+AZE0_FLAGS = tuple(_aze0_flags(byte) for byte in range(256))
+NOT_AZE0_FLAGS = (False, False, False)
+
+
+class Record:
+    """Decoded fixed layout, readable like a dict with the keys in `fields`"""
+    __slots__ = ()
+    fields = ()
+    _attributes = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._attributes = {key: ATTRIBUTE_NAMES.get(key, key) for key in cls.fields}
+
+    def __getitem__(self, key):
+        try:
+            attribute = self._attributes[key]
+        except KeyError:
+            raise KeyError(key) from None
+        return getattr(self, attribute)
+
+    def get(self, key, default=None):
+        attribute = self._attributes.get(key)
+        if attribute is None:
+            return default
+        return getattr(self, attribute)
+
+    def __contains__(self, key):
+        return key in self._attributes
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def keys(self):
+        return self.fields
+
+    def as_dict(self):
+        """Plain dict with the layout returned by parse_gdc_packet"""
+        result = {}
+        for key, attribute in self._attributes.items():
+            value = getattr(self, attribute)
+            result[key] = value.as_dict() if isinstance(value, Record) else value
+        return result
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+class TCUInfo(Record):
+    __slots__ = ("vehicle_descriptor", "vehicle_code1", "vehicle_code2", "vehicle_code3", "vehicle_code4",
+                 "vin", "tcu_id", "msn", "unit_id", "iccid", "sw_version")
+    fields = __slots__
+
+    def __init__(self, view):
+        (_, self.vehicle_descriptor, self.vehicle_code1, self.vehicle_code2, self.vehicle_code3,
+         self.vehicle_code4, vin, tcu_id, msn, unit_id, iccid, sw_version) = TCU_INFO_LAYOUT.unpack_from(view)
+        self.vin = _text(vin)
+        self.tcu_id = _text(tcu_id)
+        self.msn = _text(msn)
+        self.unit_id = _text(unit_id)
+        self.iccid = _text(iccid)
+        self.sw_version = _text(sw_version)
+
+
+class GPSInfo(Record):
+    __slots__ = ("valid_position", "latitude", "longitude", "lat_mode", "lon_mode", "home_status", "datum")
+    fields = __slots__
+
+    def __init__(self, view):
+        flags, lat_deg, lat_min, lat_sec, lon_deg, lon_min, lon_sec = GPS_LAYOUT.unpack_from(view, GPS_OFFSET)
+        self.valid_position, self.datum, self.lat_mode, self.lon_mode, self.home_status = GPS_FLAGS[flags]
+        # Same operation order as parse_gps_info, results must be identical floats
+        latitude = lat_deg + (lat_min / 60.0) + ((lat_sec / 100.0) / 3600.0)
+        longitude = lon_deg + (lon_min / 60.0) + ((lon_sec / 100.0) / 3600.0)
+        self.latitude = -latitude if self.lat_mode == "S" else latitude
+        self.longitude = -longitude if self.lon_mode == "W" else longitude
+
+
+class AuthInfo(Record):
+    __slots__ = ("user", "password")
+    fields = ("user", "pass")
+
+    def __init__(self, view):
+        user, password = AUTH_LAYOUT.unpack_from(view, AUTH_OFFSET)
+        self.user = _text(user)
+        self.password = _text(password)
+
+
+class EVInfo(Record):
+    __slots__ = ("rangeinfo_len", "evinfo_len", "acon", "acoff", "pluggedin", "charging", "quick_charging",
+                 "charging_finish", "acstate", "chargebars", "chargestate", "resultstate", "alertstate",
+                 "ignition", "parked", "direction_forward", "soc", "soc_display", "gids", "soh", "counter",
+                 "obc_6kw_exist", "batt_heat_exist", "batt_heat_active", "capacity_bars", "full_chg",
+                 "limit_chg", "chg_6kw", "pri_ac_req_result", "pri_ac_stop_result", "batt_start_stop",
+                 "charge_request_result", "charge_stop", "not_plugin_alert", "error_notification")
+    fields = tuple("6kw_chg" if attribute == "chg_6kw" else attribute for attribute in __slots__)
+
+    def __init__(self, view, aze0):
+        b = (EVINFO_AZE0_LAYOUT if aze0 else EVINFO_LAYOUT).unpack_from(view, EVINFO_OFFSET)
+        self.rangeinfo_len = b[0]
+        self.acon = b[2]
+        self.acoff = b[4]
+        self.alertstate = b[6]
+        self.resultstate = b[7]
+        self.evinfo_len = b[8]
+        (self.chargestate, self.pluggedin, self.charging, self.quick_charging, self.charging_finish,
+         self.acstate, self.ignition, self.parked, self.direction_forward) = CHARGE_STATUS[b[9]]
+        (self.pri_ac_req_result, self.pri_ac_stop_result, self.batt_start_stop) = RESULT_STATE[b[7]]
+        (self.charge_request_result, self.charge_stop, self.not_plugin_alert,
+         self.error_notification) = ALERT_STATE[b[6]]
+
+        self.full_chg = (b[10] << 3) | ((b[11] & 0b11100000) >> 5)
+        self.limit_chg = ((b[11] & 0b00011111) << 6) | ((b[12] & 0b11111100) >> 2)
+        self.counter = ((b[12] & 0b00000011) << 8) | b[13]
+        self.gids = (b[14] << 2) | ((b[15] & 0b11000000) >> 6)
+        self.soh = ((b[15] & 0b00111111) << 1) | ((b[16] & 0b10000000) >> 7)
+        self.soc = (((b[16] & 0b01111111) << 4) | ((b[17] & 0b11110000) >> 4)) / 20
+        self.soc_display = 0
+        self.chargebars = ((b[18] & 0b00000011) << 2) | ((b[19] & 0b11000000) >> 6)
+        self.capacity_bars = (b[19] & 0b00011110) >> 1
+
+        if aze0:
+            self.chg_6kw = (b[20] << 3) | ((b[21] & 0b11100000) >> 5)
+            self.obc_6kw_exist, self.batt_heat_exist, self.batt_heat_active = AZE0_FLAGS[b[21]]
+        else:
+            self.chg_6kw = 0xFFF
+            self.obc_6kw_exist, self.batt_heat_exist, self.batt_heat_active = NOT_AZE0_FLAGS
+
+
+class GDCPacket(Record):
+    __slots__ = ("tcu", "gps", "auth", "message_type", "body_type", "body")
+    fields = __slots__
+
+    def __init__(self, tcu, gps, auth, message_type, body_type, body):
+        self.tcu = tcu
+        self.gps = gps
+        self.auth = auth
+        self.message_type = message_type
+        self.body_type = body_type
+        self.body = body
+
+
+def decode_gdc_packet(data):
+    """Decode a GDC packet, raises ValueError on packets parse_gdc_packet rejects"""
+    view = memoryview(data)
+    length = len(view)
+    if length < 5:
+        raise ValueError("Header data must be at least 5 bytes long")
+    if length > 1024:
+        raise ValueError("Too much data for GDC packet")
+
+    packet_type = PACKET_TYPES[view[0]]
+    if packet_type[0] == -1:
+        raise ValueError(f"Invalid packet type 0x{view[0]:02x}")
+    if length < 100:
+        raise ValueError("Data must be at least 100 bytes long")
+
+    body_type = BODY_TYPES[view[100]]
+    tcu = TCUInfo(view)
+
+    if body_type == "config_read":
+        # Config packets arrive once per configuration read, the text fields are parsed the usual way
+        return GDCPacket(tcu, None, None, packet_type, body_type, parse_config_data(bytes(view[CONFIG_OFFSET:])))
+
+    if length < EVINFO_OFFSET:
+        raise ValueError(f"Expected data packet length < 153 bytes for body type {body_type}")
+
+    body = None
+    if packet_type[0] == 3:
+        # AZE0 sends 0x92 as second byte, ZE0 sends 0x02, others unknown
+        body = EVInfo(view, aze0=(view[1] != 0x02))
+    return GDCPacket(tcu, GPSInfo(view), AuthInfo(view), packet_type, body_type, body)
@@ -0,0 +1,73 @@
+"""
+Reassemble GDC packets from a TCP byte stream.
+
+TCUs on mobile networks do not always deliver one packet per segment, reads may return
+a partial packet or several pipelined packets at once.
+"""
+from tculink.gdc_proto.datafields import get_packet_size
+
+# Smallest packet that can carry a header, largest packet the parser accepts
+MIN_PACKET_SIZE = 5
+MAX_PACKET_SIZE = 1024
+HEADER_SIZE = 4
+
+
+class GDCStreamReassembler:
+    """
+    Buffers data read from a TCU connection and splits it into complete GDC packets.
+
+    When the buffer is empty and a read contains exactly one packet (the usual case),
+    the read is handed out as-is without copying. Data that cannot be framed (unknown
+    packet type, bad size) is flushed as a single chunk so the parser can reject and log it.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    @property
+    def pending(self):
+        """Amount of buffered bytes that do not form a complete packet yet"""
+        return len(self._buffer)
+
+    def feed(self, data):
+        """Add received data, returns a list of complete packets"""
+        if not self._buffer:
+            packet_size = self._frame_size(data)
+            if packet_size is not None and packet_size == len(data):
+                return [data]
+
+        self._buffer += data
+        packets = []
+        view = memoryview(self._buffer)
+        offset = 0
+        try:
+            while len(view) - offset >= HEADER_SIZE:
+                packet_size = self._frame_size(view[offset:offset + HEADER_SIZE])
+                if packet_size is None:
+                    # Stream is out of sync, nothing after this point can be trusted
+                    packets.append(bytes(view[offset:]))
+                    offset = len(view)
+                    break
+                if len(view) - offset < packet_size:
+                    break
+                packets.append(bytes(view[offset:offset + packet_size]))
+                offset += packet_size
+        finally:
+            view.release()
+
+        if offset:
+            del self._buffer[:offset]
+        return packets
+
+    def flush(self):
+        """Return and clear leftover data of an incomplete packet"""
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+    @staticmethod
+    def _frame_size(header):
+        packet_size = get_packet_size(header)
+        if packet_size is None or not (MIN_PACKET_SIZE <= packet_size <= MAX_PACKET_SIZE):
+            return None
+        return packet_size
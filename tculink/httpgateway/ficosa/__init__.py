@@ -1,5 +1,6 @@
 import io
 import logging
+import time
 from typing import Any
 
 from django.core.handlers.wsgi import WSGIRequest
@@ -9,19 +10,21 @@ from django.utils import timezone
 from db.models import Car, CommandTimerSetting
 from tculink.gdc_proto.ficosa import acp as ficosa_acp
 from tculink.httpgateway.ficosa.destinations import DESTINATIONS, config
+from tculink.utils import metrics
+from tculink.utils.tcu_identity import get_tcu_identity
 
 logger = logging.getLogger("ficosa")
 
 
 def authenticate_car(veh_desc: dict, app_id: int) -> Car|None:
-    try:
-        car = Car.objects.get(vin=veh_desc.get("vin"), tcu_model=veh_desc.get("dcm"))
+    identity = get_tcu_identity(veh_desc.get("vin"))
 
-        # confirm TCU ID
-        if veh_desc.get('dcm') != car.tcu_model:
-            return None
+    # unknown VINs and TCU ID mismatches are rejected without querying the database
+    if identity is None or veh_desc.get('dcm') != identity["tcu_model"]:
+        return None
 
-        return car
+    try:
+        return Car.objects.get(pk=identity["car_id"])
     except Car.DoesNotExist:
         return None
 
@@ -62,6 +65,7 @@ def handle_request(request: WSGIRequest | Any) -> HttpResponse:
     logger.debug(f">> bin_data: {bin_data.hex()}")
 
 
+    parse_started = time.perf_counter()
     app_header, consumed = ficosa_acp.parser.decode_app_header(bin_data, 0)
 
     # FICOSA TCU uses this for non-standard ACP functions
@@ -89,6 +93,8 @@ def handle_request(request: WSGIRequest | Any) -> HttpResponse:
     else:
         logger.debug(f"unknown, app_id: {app_id}")
         return HttpResponse(status=400)
+    metrics.parse_seconds.observe(time.perf_counter() - parse_started, protocol="ficosa")
+    metrics.gateway_requests.inc(gateway="ficosa", app=app_id)
 
     vin = acp_body["veh_desc"].get("vin", None)
     dcm_id = acp_body["veh_desc"].get("dcm", None)
@@ -98,9 +104,11 @@ def handle_request(request: WSGIRequest | Any) -> HttpResponse:
 
     if car is None:
         logger.debug(f"auth failed")
+        metrics.auth_failures.inc(protocol="ficosa", reason="unknown_car")
         return HttpResponse(status=401)
 
-    timer_id = update_basic_car_info(acp_body, car)
+    with metrics.db_seconds.time(protocol="ficosa"):
+        timer_id = update_basic_car_info(acp_body, car)
 
     source_id = acp_body["source_id"]
     destination_id = acp_body["dest_id"]
@@ -112,10 +120,11 @@ def handle_request(request: WSGIRequest | Any) -> HttpResponse:
 
     try:
         bin_data = bin_data[offset:]
-        if app_id == 0x1d:
-            resp_bin = config.handle(bin_data, acp_body, car, source_id, destination_id)
-        else:
-            resp_bin = DESTINATIONS[destination_id](bin_data, acp_body, car, source_id, destination_id)
+        with metrics.response_seconds.time(protocol="ficosa", app=app_id):
+            if app_id == 0x1d:
+                resp_bin = config.handle(bin_data, acp_body, car, source_id, destination_id)
+            else:
+                resp_bin = DESTINATIONS[destination_id](bin_data, acp_body, car, source_id, destination_id)
     except Exception as e:
         logger.exception(e)
         return HttpResponse(status=500)
@@ -1,6 +1,5 @@
 import logging
 
-from asgiref.sync import sync_to_async
 from django.utils import timezone
 
 from db.models import Car, AlertHistory
@@ -84,13 +83,11 @@ def handle(bin_data: bytes, acp_data: dict, car: Car, source_id: int, destinatio
         new_alert.car = car
         new_alert.command_id = car.command_id
         new_alert.save()
-        sync_to_async(
-            send_vehicle_alert_notification(
-                car,
-                _("Vehicle is unplugged. Please check the situation if necessary."),
-                _("Charger unplugged notification")
-            )
-        , thread_sensitive=False)
+        send_vehicle_alert_notification(
+            car,
+            _("Vehicle is unplugged. Please check the situation if necessary."),
+            _("Charger unplugged notification")
+        )
 
     if destination_id == 0x2c or destination_id == 0xdc:
         new_alert = AlertHistory()
@@ -157,11 +154,11 @@ def handle(bin_data: bytes, acp_data: dict, car: Car, source_id: int, destinatio
         new_alert.command_id = car.command_id
         new_alert.save()
 
-        sync_to_async(send_vehicle_alert_notification(
+        send_vehicle_alert_notification(
             car,
             alert_msg,
             alert_subject
-        ), thread_sensitive=False)
+        )
 
     if destination_id == 0x2a:
         new_alert = AlertHistory()
@@ -195,7 +192,7 @@ def handle(bin_data: bytes, acp_data: dict, car: Car, source_id: int, destinatio
         new_alert.car = car
         new_alert.command_id = car.command_id
         new_alert.save()
-        sync_to_async(send_vehicle_alert_notification(car, alert_message, subject), thread_sensitive=False)
+        send_vehicle_alert_notification(car, alert_message, subject)
 
     if destination_id == 0x2b or destination_id == 0x3e:
         new_alert = AlertHistory()
@@ -226,9 +223,9 @@ def handle(bin_data: bytes, acp_data: dict, car: Car, source_id: int, destinatio
             subject = f"80% {subject}"
 
         new_alert.save()
-        sync_to_async(send_vehicle_alert_notification(
+        send_vehicle_alert_notification(
             car,
             message,
-            subject), thread_sensitive=False)
+            subject)
 
     return acp.make_ack_response(car.vin, car.tcu_model, destination_id, source_id, 0, 0, 1)
\ No newline at end of file
@@ -7,22 +7,16 @@ import tculink.gdc_proto.ficosa.acp as acp
 from db.models import Car
 from tculink.carwings_proto.probe_crm import crm_labelmap, sections, parse_crm_datablocks, update_crm_to_db
 from tculink.gdc_proto.acp245.parser import decode_probe_form_item
+from tculink.utils.capture import capture
 
 logger = logging.getLogger("ficosa")
 
 
 def save_debug_data(tcu_gen, block, block_id, fulldata, req_id):
-    log_dir = os.path.join("logs", "probev2", tcu_gen,
-                           datetime.now().strftime('%Y%m%d%H%M'))
-    os.makedirs(log_dir, exist_ok=True)
-    file_path = os.path.join(log_dir, f"fulldata-{req_id}.bin")
-    if not os.path.exists(file_path):
-        with open(file_path, "wb") as f:
-            f.write(fulldata)
-
-    file_path = os.path.join(log_dir, f"block-{block_id}-{req_id}.bin")
-    with open(file_path, "wb") as f:
-        f.write(block)
+    log_dir = os.path.join(tcu_gen, datetime.now().strftime('%Y%m%d%H%M'))
+    # Full data is the same for every block of a request, duplicates are skipped by the capture
+    capture("probev2", os.path.join(log_dir, f"fulldata-{req_id}.bin"), fulldata)
+    capture("probev2", os.path.join(log_dir, f"block-{block_id}-{req_id}.bin"), block)
 
 
 
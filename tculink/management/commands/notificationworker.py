@@ -0,0 +1,48 @@
+import asyncio
+import logging
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from tculink.utils.notification_queue import NotificationWorker, redis_url
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued vehicle alert notifications (email, APNs and FCM)'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=getattr(settings, "NOTIFICATION_CONCURRENCY", 4),
+                            help="Notifications delivered concurrently")
+
+    def handle(self, *args, **options):
+        url = redis_url()
+        if url is None:
+            raise CommandError("No Redis configured for the notification queue, "
+                               "notifications are delivered by the processes sending them")
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        asyncio.run(self.run_worker(url, options["concurrency"]))
+
+    async def run_worker(self, url, concurrency):
+        import redis.asyncio
+
+        client = redis.asyncio.Redis.from_url(url)
+        worker = NotificationWorker(client, concurrency=concurrency)
+        task = asyncio.create_task(worker.run())
+
+        def stop():
+            # Jobs being delivered are finished, waiting consumers return within their block timeout
+            worker.stopping = True
+
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop)
+
+        logger.info("Notification worker %s started, %d concurrent deliveries", worker.worker_id, concurrency)
+        try:
+            await task
+        finally:
+            await client.aclose()
+            logger.info("Notification worker %s stopped", worker.worker_id)
@@ -0,0 +1,54 @@
+import logging
+import signal
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from tculink.sms.dispatch import CommandDispatcher
+from tculink.sms.outbox import OutboxWorker, outbox_enabled
+
+logger = logging.getLogger(__name__)
+
+# Seconds between deletions of finished outbox messages
+PURGE_INTERVAL = 3600
+
+
+class Command(BaseCommand):
+    help = 'Send and retry wake-up SMS queued in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=1,
+                            help="Seconds between checks for due messages when the outbox is idle")
+        parser.add_argument("--batch", type=int, default=100, help="Messages claimed at once")
+
+    def handle(self, *args, **options):
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        worker = OutboxWorker(CommandDispatcher(getattr(settings, "SMS_DISPATCH_WORKERS", 16)),
+                              batch_size=options["batch"])
+
+        stopping = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stopping.set())
+
+        if not outbox_enabled():
+            logger.info("SMS_OUTBOX is disabled, only messages queued before are sent")
+        logger.info("SMS worker started")
+        next_purge = 0
+        while not stopping.is_set():
+            close_old_connections()
+            try:
+                if time.monotonic() >= next_purge:
+                    next_purge = time.monotonic() + PURGE_INTERVAL
+                    worker.purge(timezone.now())
+                processed = worker.process()
+            except Exception as e:
+                logger.exception("Processing the SMS outbox failed: %s", e)
+                processed = 0
+            # A full batch means more messages are probably due
+            if processed < options["batch"]:
+                stopping.wait(options["interval"])
+        logger.info("SMS worker stopped")
@@ -0,0 +1,55 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tculink.utils.benchmark import run_benchmarks, save_baseline, load_baseline, find_regressions
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the parsers and builders of the TCU and CARWINGS wire formats'
+
+    def add_arguments(self, parser):
+        parser.add_argument("cases", nargs="*", type=str,
+                            help="Only run cases containing one of these names, e.g. gdc or probe.parse_crm")
+        parser.add_argument("--min-time", type=float, default=0.2, help="Seconds per timed round")
+        parser.add_argument("--rounds", type=int, default=5, help="Timed rounds per case, the best one counts")
+        parser.add_argument("--save", type=str, help="Write the results to this baseline JSON file")
+        parser.add_argument("--baseline", type=str, help="Compare the results to this baseline JSON file")
+        parser.add_argument("--threshold", type=float, default=0.2,
+                            help="Allowed slowdown against the baseline, 0.2 fails cases more than 20%% slower")
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["baseline"]:
+            try:
+                baseline = load_baseline(options["baseline"])
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Can not read baseline {options['baseline']}: {e}")
+
+        results = run_benchmarks(options["cases"], min_time=options["min_time"], rounds=options["rounds"])
+        if not results:
+            raise CommandError("No benchmark cases matched")
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+        else:
+            self.stdout.write(f"{'case':<28} {'ops/s':>12} {'peak KiB/op':>12} {'vs baseline':>12}")
+            for name, result in results.items():
+                change = ""
+                if baseline is not None and name in baseline:
+                    change = f"{(result['ops'] / baseline[name]['ops'] - 1) * 100:+.1f}%"
+                self.stdout.write(f"{name:<28} {result['ops']:>12.1f} {result['peak_bytes'] / 1024:>12.1f} "
+                                  f"{change:>12}")
+
+        if options["save"]:
+            save_baseline(options["save"], results)
+            self.stdout.write(self.style.SUCCESS(f"Baseline saved to {options['save']}"))
+
+        if baseline is not None:
+            regressions = find_regressions(results, baseline, options["threshold"])
+            for name, previous, current in regressions:
+                self.stderr.write(f"Regression in {name}: {previous:.1f} -> {current:.1f} ops/s")
+            if regressions:
+                raise CommandError(f"{len(regressions)} cases slower than baseline by more than "
+                                   f"{options['threshold'] * 100:.0f}%")
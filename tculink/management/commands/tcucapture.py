@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from tculink.utils.tcu_logging import get_capture_vins, set_capture_vins
+
+
+class Command(BaseCommand):
+    help = 'Enable or disable full packet logging of VINs on running TCU servers'
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["add", "remove", "list", "clear"])
+        parser.add_argument("vins", nargs="*", type=str)
+
+    def handle(self, *args, **options):
+        action = options["action"]
+        vins = set(options["vins"])
+        if action in ("add", "remove") and not vins:
+            raise CommandError(f"No VINs given to {action}")
+
+        captured = get_capture_vins()
+        if action == "add":
+            captured |= vins
+        elif action == "remove":
+            captured -= vins
+        elif action == "clear":
+            captured = set()
+
+        if action != "list":
+            set_capture_vins(captured)
+            self.stdout.write(self.style.SUCCESS(
+                "Debug capture updated, servers pick up the change within a few seconds"
+            ))
+
+        if not captured:
+            self.stdout.write("No VINs in debug capture")
+        for vin in sorted(captured):
+            self.stdout.write(vin)
@@ -0,0 +1,285 @@
+"""
+Load test the TCU server with a fleet of simulated Continental TCUs.
+
+Every simulated TCU has its own randomized VIN, seeded into the database as a car owned by a
+dedicated load test user. TCUs connect over TCP and send the recorded INIT, DATA and CONFIG
+packets of tculink.gdc_proto.samples with their VIN patched in. DATA and CONFIG packets are not
+answered by the server, they are followed by an INIT probe and timed until its response arrives.
+
+Recorded Ficosa and CARWINGS requests can be replayed to the HTTP gateways as well, those
+must belong to a car registered in the database.
+"""
+import asyncio
+import json
+import math
+import random
+import string
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from db.models import Car, User, TCUConfiguration, LocationInfo, EVInfo
+from tculink.gdc_proto.samples import sample_packet, SAMPLE_INIT, SAMPLE_DATA, SAMPLE_CONFIG
+
+# Seeded cars are recognized by the prefix of their VIN
+LOADTEST_VIN_PREFIX = "LOADTEST"
+LOADTEST_USERNAME = "tculoadtest"
+VIN_OFFSET = 9
+VIN_LENGTH = 17
+
+# Identity of the TCU which recorded the sample packets
+SAMPLE_TCU_ID = "201300026078"
+SAMPLE_UNIT_ID = "100200005035"
+SAMPLE_ICCID = "8935806230914578495"
+
+FICOSA_PATH = "/ficosa/gdc"
+CARWINGS_PATH = "/WARCondelivbas/it-m_gw10/"
+
+
+def random_vin(rng):
+    suffix_length = VIN_LENGTH - len(LOADTEST_VIN_PREFIX)
+    return LOADTEST_VIN_PREFIX + "".join(rng.choice(string.digits) for _ in range(suffix_length))
+
+
+def with_vin(packet, vin):
+    """Copy of a GDC packet with the VIN replaced"""
+    patched = bytearray(packet)
+    patched[VIN_OFFSET:VIN_OFFSET + VIN_LENGTH] = vin.encode("ascii")
+    return bytes(patched)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+class LoadTestResults:
+    """Latencies and errors collected per message type"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, message_type, latency):
+        self.latencies.setdefault(message_type, []).append(latency)
+
+    def error(self, message_type):
+        self.errors[message_type] = self.errors.get(message_type, 0) + 1
+
+    def summary(self, duration):
+        summary = {}
+        for message_type in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies.get(message_type, []))
+            summary[message_type] = {
+                "count": len(values),
+                "errors": self.errors.get(message_type, 0),
+                "throughput": round(len(values) / duration, 2) if duration else 0,
+                "p50_ms": self._ms(percentile(values, 50)),
+                "p95_ms": self._ms(percentile(values, 95)),
+                "p99_ms": self._ms(percentile(values, 99)),
+            }
+        return summary
+
+    @staticmethod
+    def _ms(value):
+        return round(value * 1000, 2) if value is not None else None
+
+
+class Command(BaseCommand):
+    help = 'Load test the TCU server and gateways with simulated TCUs'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", type=str, default="127.0.0.1", help="TCU server host")
+        parser.add_argument("--port", type=int, default=55230, help="TCU server port")
+        parser.add_argument("--tcus", type=int, default=100, help="Number of simulated TCUs")
+        parser.add_argument("--sessions", type=int, default=5, help="Connections made by each TCU")
+        parser.add_argument("--concurrency", type=int, default=50, help="Maximum simultaneous connections")
+        parser.add_argument("--timeout", type=float, default=10, help="Seconds to wait for a response")
+        parser.add_argument("--seed", type=int, default=None, help="Seed for the random VINs")
+        parser.add_argument("--http-url", type=str, default="http://127.0.0.1:8000",
+                            help="Base URL of the HTTP gateways")
+        parser.add_argument("--ficosa-payload", type=str, default=None,
+                            help="Recorded Ficosa request body to post to the gateway")
+        parser.add_argument("--carwings-payload", type=str, default=None,
+                            help="Recorded CARWINGS request body to post to the gateway")
+        parser.add_argument("--http-requests", type=int, default=100, help="Requests per HTTP gateway")
+        parser.add_argument("--json", type=str, default=None, help="Write the results to a JSON file")
+        parser.add_argument("--keep", action="store_true", help="Keep the seeded cars after the test")
+        parser.add_argument("--cleanup", action="store_true", help="Only delete seeded cars and exit")
+
+    def seed_cars(self, vins):
+        """Create a car for every simulated TCU, returns the load test user"""
+        owner, _ = User.objects.get_or_create(
+            username=LOADTEST_USERNAME,
+            defaults={"tcu_pass_hash": "LOADTEST", "email_notifications": False},
+        )
+        with transaction.atomic():
+            # Bulk creation skips the broadcast signals, nobody is watching these cars
+            configs = TCUConfiguration.objects.bulk_create([TCUConfiguration() for _ in vins])
+            locations = LocationInfo.objects.bulk_create([LocationInfo() for _ in vins])
+            ev_infos = EVInfo.objects.bulk_create([EVInfo() for _ in vins])
+            Car.objects.bulk_create([
+                Car(vin=vin, nickname="Load test", sms_config={"provider": "manual"}, owner=owner,
+                    tcu_model=SAMPLE_TCU_ID, tcu_serial=SAMPLE_UNIT_ID, iccid=SAMPLE_ICCID,
+                    disable_auth=True, tcu_configuration=config, location=location, ev_info=ev_info)
+                for vin, config, location, ev_info in zip(vins, configs, locations, ev_infos)
+            ])
+        return owner
+
+    def cleanup(self):
+        cars = Car.objects.filter(vin__startswith=LOADTEST_VIN_PREFIX)
+        with transaction.atomic():
+            related = list(cars.values_list("tcu_configuration_id", "location_id", "ev_info_id"))
+            count = cars.count()
+            cars.delete()
+            TCUConfiguration.objects.filter(pk__in=[ids[0] for ids in related]).delete()
+            LocationInfo.objects.filter(pk__in=[ids[1] for ids in related]).delete()
+            EVInfo.objects.filter(pk__in=[ids[2] for ids in related]).delete()
+            User.objects.filter(username=LOADTEST_USERNAME).delete()
+        return count
+
+    async def request(self, reader, writer, packets):
+        """Send packets and wait for the response to the last one, returns the latency"""
+        started = time.perf_counter()
+        for packet in packets:
+            writer.write(packet)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(1024), self.timeout)
+        if not response:
+            raise ConnectionError("Connection closed by server")
+        return time.perf_counter() - started
+
+    async def simulate_tcu(self, vin, slots):
+        init = with_vin(self.templates[SAMPLE_INIT], vin)
+        data = with_vin(self.templates[SAMPLE_DATA], vin)
+        config = with_vin(self.templates[SAMPLE_CONFIG], vin)
+
+        for _ in range(self.sessions):
+            async with slots:
+                message_type = "connect"
+                writer = None
+                try:
+                    started = time.perf_counter()
+                    reader, writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.host, self.port), self.timeout)
+                    self.results.record(message_type, time.perf_counter() - started)
+
+                    for message_type, packets in (("init", [init]), ("data", [data, init]),
+                                                  ("config", [config, init])):
+                        self.results.record(message_type, await self.request(reader, writer, packets))
+                except (OSError, asyncio.TimeoutError):
+                    self.results.error(message_type)
+                finally:
+                    if writer is not None:
+                        writer.close()
+                        try:
+                            await writer.wait_closed()
+                        except OSError:
+                            pass
+
+    def post(self, session, message_type, url, body, headers):
+        started = time.perf_counter()
+        try:
+            response = session.post(url, data=body, headers=headers, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException:
+            self.results.error(message_type)
+            return
+        self.results.record(message_type, time.perf_counter() - started)
+
+    async def simulate_http(self, message_type, url, body, headers, count, executor):
+        loop = asyncio.get_running_loop()
+        with requests.Session() as session:
+            for _ in range(count):
+                await loop.run_in_executor(executor, self.post, session, message_type, url, body, headers)
+
+    async def run(self, vins, http_targets):
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = [self.simulate_tcu(vin, slots) for vin in vins]
+        executor = ThreadPoolExecutor(max_workers=max(self.concurrency, 1))
+        try:
+            # Requests of a gateway are split between as many clients as allowed concurrent connections
+            clients = min(self.concurrency, self.http_requests)
+            for message_type, url, body, headers in http_targets:
+                for client in range(clients):
+                    count = self.http_requests // clients + (client < self.http_requests % clients)
+                    tasks.append(self.simulate_http(message_type, url, body, headers, count, executor))
+            await asyncio.gather(*tasks)
+        finally:
+            executor.shutdown(wait=False)
+
+    def read_payload(self, path):
+        try:
+            with open(path, "rb") as file:
+                return file.read()
+        except OSError as e:
+            raise CommandError(f"Could not read payload {path}: {e}")
+
+    def handle(self, *args, **options):
+        if options["cleanup"]:
+            count = self.cleanup()
+            self.stdout.write(self.style.SUCCESS(f"Deleted {count} load test cars"))
+            return
+
+        for option in ("tcus", "sessions", "concurrency", "http_requests"):
+            if options[option] < 1:
+                raise CommandError(f"--{option.replace('_', '-')} must be at least 1")
+
+        self.host = options["host"]
+        self.port = options["port"]
+        self.sessions = options["sessions"]
+        self.concurrency = options["concurrency"]
+        self.timeout = options["timeout"]
+        self.http_requests = options["http_requests"]
+        self.templates = {index: sample_packet(index) for index in (SAMPLE_INIT, SAMPLE_DATA, SAMPLE_CONFIG)}
+        self.results = LoadTestResults()
+
+        http_targets = []
+        base_url = options["http_url"].rstrip("/")
+        if options["ficosa_payload"]:
+            http_targets.append(("ficosa", base_url + FICOSA_PATH, self.read_payload(options["ficosa_payload"]),
+                                 {"Content-Type": "application/octet-stream"}))
+        if options["carwings_payload"]:
+            http_targets.append(("carwings", base_url + CARWINGS_PATH, self.read_payload(options["carwings_payload"]),
+                                 {"Content-Type": "application/x-carwings-nz", "User-Agent": "NISSAN CARWINGS"}))
+
+        rng = random.Random(options["seed"])
+        vins = set()
+        while len(vins) < options["tcus"]:
+            vins.add(random_vin(rng))
+        vins = sorted(vins)
+
+        removed = self.cleanup()
+        if removed:
+            self.stdout.write(self.style.WARNING(f"Removed {removed} cars left from a previous load test"))
+        self.seed_cars(vins)
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {len(vins)} cars, running {self.sessions} sessions per TCU against {self.host}:{self.port}"
+        ))
+
+        try:
+            started = time.perf_counter()
+            asyncio.run(self.run(vins, http_targets))
+            duration = time.perf_counter() - started
+        finally:
+            if not options["keep"]:
+                self.cleanup()
+
+        summary = self.results.summary(duration)
+        self.stdout.write(f"Finished in {duration:.2f}s")
+        self.stdout.write(f"{'type':<10}{'count':>8}{'errors':>8}{'msg/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for message_type, row in summary.items():
+            self.stdout.write(
+                f"{message_type:<10}{row['count']:>8}{row['errors']:>8}{row['throughput']:>10}"
+                f"{str(row['p50_ms']):>10}{str(row['p95_ms']):>10}{str(row['p99_ms']):>10}"
+            )
+
+        if options["json"]:
+            with open(options["json"], "w") as file:
+                json.dump({"duration": round(duration, 3), "tcus": len(vins), "sessions": self.sessions,
+                           "results": summary}, file, indent=2)
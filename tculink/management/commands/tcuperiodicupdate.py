@@ -1,12 +1,57 @@
 from random import randint
-from django.db.models import Q
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Case, F, Q, Value, When
 from django.utils import timezone
-from db.models import Car, AlertHistory, CommandTimerSetting
+from db.models import Car, AlertHistory, CommandTimerSetting, TIMER_LEAD, COMMAND_TYPES
+from db.signals import broadcast_car_updates_on_commit
 import datetime
 
-from tculink.coordinators.stub import send_command_using_provider
+from tculink.sms.dispatch import THROTTLED, FAILED
+from tculink.sms.outbox import submit_commands
+from tculink.utils import metrics
+
+# Timers missed by more than this, e.g. while no scheduler was running, are skipped
+TIMER_MISSED_GRACE = datetime.timedelta(minutes=5)
+
+TIMED_OUT_FIELDS = ("id", "vin", "owner", "command_id", "command_type", "command_payload")
+
+
+def claim_timed_out_commands(timeout_threshold, resp_timeout_threshold):
+    """
+    Mark commands the car did not pick up before `timeout_threshold`, or did not answer before
+    `resp_timeout_threshold`, as timed out. Returns the TIMED_OUT_FIELDS of the updated cars.
+    """
+    fields = [Car._meta.get_field(name) for name in TIMED_OUT_FIELDS]
+    if connection.vendor in ("postgresql", "sqlite"):
+        # One statement, a command completing meanwhile is either updated here or not at all
+        qn = connection.ops.quote_name
+        requested = qn(Car._meta.get_field("command_requested").column)
+        result = qn(Car._meta.get_field("command_result").column)
+        request_time = qn(Car._meta.get_field("command_request_time").column)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {qn(Car._meta.db_table)} SET {requested} = %s, {result} = %s "
+                f"WHERE ({requested} = %s AND {result} = %s AND {request_time} <= %s) "
+                f"OR ({result} = %s AND {request_time} <= %s) "
+                f"RETURNING {', '.join(qn(field.column) for field in fields)}",
+                [False, 2,
+                 True, -1, connection.ops.adapt_datetimefield_value(timeout_threshold),
+                 3, connection.ops.adapt_datetimefield_value(resp_timeout_threshold)])
+            rows = cursor.fetchall()
+        return [{field.attname: field.from_db_value(value, None, connection)
+                 if hasattr(field, "from_db_value") else value
+                 for field, value in zip(fields, row)} for row in rows]
+
+    pending = Car.objects.filter(
+        Q(command_requested=True, command_result=-1, command_request_time__lte=timeout_threshold) |
+        Q(command_result=3, command_request_time__lte=resp_timeout_threshold)
+    )
+    with transaction.atomic():
+        timed_out = list(pending.select_for_update().values(*(field.attname for field in fields)))
+        Car.objects.filter(pk__in=[car["id"] for car in timed_out]).update(command_requested=False, command_result=2)
+    return timed_out
 
 
 class Command(BaseCommand):
@@ -16,50 +61,40 @@ class Command(BaseCommand):
         # Get current time
         now = timezone.now()
 
-        # Find cars that need checking
-        timed_out_cars = Car.objects.exclude(periodic_refresh=0, periodic_refresh_running=0).exclude(
-            command_requested=True, command_result=-1)
-
-        cars_count = timed_out_cars.count()
+        # Only cars which need an update, decided by the database, longest waiting first
+        due = Car.due_for_refresh(now, spread=getattr(settings, "PERIODIC_REFRESH_SPREAD", False))
+        due = due.order_by("refresh_after", "pk")
+        # Wake-up budget of this run, the scheduler refreshes once a minute
+        budget = getattr(settings, "PERIODIC_REFRESH_MAX_PER_MINUTE", 0)
+        if budget > 0:
+            due_count = due.count()
+            due_cars = list(due[:budget])
+        else:
+            due_cars = list(due)
+            due_count = len(due_cars)
+        metrics.refresh_wakeups.observe(len(due_cars))
 
-        if cars_count == 0:
+        if len(due_cars) == 0:
             self.stdout.write(
                 self.style.WARNING("No pending car refreshes found")
             )
         else:
             self.stdout.write(
-                self.style.SUCCESS(f"Processing {cars_count} cars")
+                self.style.SUCCESS(f"Processing {len(due_cars)} cars")
+            )
+        if due_count > len(due_cars):
+            metrics.refresh_deferred.inc(due_count - len(due_cars))
+            self.stdout.write(
+                self.style.WARNING(f"Deferring {due_count - len(due_cars)} car refreshes over the wake-up budget")
             )
 
-        for car in timed_out_cars:
-            try:
-                # Set appropriate threshold based on charging status
-                if (car.ev_info.charging or car.ev_info.car_running) and car.periodic_refresh_running != 0:
-                    period = now - datetime.timedelta(minutes=car.periodic_refresh_running)
-                else:
-                    if car.periodic_refresh == 0:
-                        continue
-                    period = now - datetime.timedelta(minutes=car.periodic_refresh)
-
-                if car.command_result == 2 and car.command_request_time is not None and car.command_request_time > period:
-                    print("Skip car, last execution timed out.")
-                    continue
-
-                # Check if update is actually needed
-                if car.last_connection is not None and car.last_connection < period:
-                    print(f"Car {car.vin}: Requesting update")
-                    try:
-                        car = send_command_using_provider(1, None, car)
-                    except Exception as e:
-                        print(f"Could not send SMS message: {e}")
-                        print(e)
-
-            except Exception as e:
-                self.stdout.write(
-                    self.style.ERROR(
-                        f"Error processing car VIN: {car.vin}: {str(e)}"
-                    )
-                )
+        for car in due_cars:
+            print(f"Car {car.vin}: Requesting update")
+        if due_cars:
+            report = submit_commands([(car, 1, None) for car in due_cars])
+            self.stdout.write(
+                self.style.SUCCESS(f"Refresh requests: {report}")
+            )
 
     def handle_timeouts(self):
         # Get current time
@@ -69,139 +104,106 @@ class Command(BaseCommand):
         # Add 3 minutes of response wait time
         resp_timeout_threshold = now - datetime.timedelta(minutes=settings.LEAF_COMMAND_TIMEOUT+3)
 
-        # Find cars with pending commands older than 5 minutes
-        timed_out_cars = Car.objects.filter(
-            command_requested=True,
-            command_result=-1,  # Waiting status
-            command_request_time__lte=timeout_threshold
-        )
-
-        # Find cars who wait for response
-        failed_resp_cars = Car.objects.filter(
-            command_result=3,  # Await response status
-            command_request_time__lte=resp_timeout_threshold
-        )
-
-        all_failed_cars = timed_out_cars.union(failed_resp_cars)
-
-        cars_count = all_failed_cars.count()
-
-        for car in all_failed_cars:
-            try:
-                # Update car status
-                try:
-                    cmd = CommandTimerSetting.objects.get(id=car.command_id)
-                    cmd.last_command_execution = timezone.now()
-                    cmd.last_command_result = 2
-                    if cmd.timer_type == 0:
-                        cmd.enabled = False
-                    cmd.save()
-                except CommandTimerSetting.DoesNotExist:
-                    ...
-                car.command_requested = False
-                car.command_result = 2  # Timeout status from COMMAND_RESULTS
-                car.save()
-
-                # Create timeout alert
-                AlertHistory.objects.create(
-                    type=98,  # Command timeout from ALERT_TYPES
-                    command_id=car.command_id,
-                    car=car,
-                    additional_data=f"Command '{car.get_command_type_display()}' timed out after 5 minutes"
-                )
-
-                self.stdout.write(
-                    self.style.SUCCESS(
-                        f"Processed timeout for car VIN: {car.vin} - Command: {car.get_command_type_display()}"
+        try:
+            with transaction.atomic():
+                timed_out = claim_timed_out_commands(timeout_threshold, resp_timeout_threshold)
+                if not timed_out:
+                    self.stdout.write(
+                        self.style.WARNING("No command timeouts found")
                     )
-                )
-
-            except Exception as e:
-                self.stdout.write(
-                    self.style.ERROR(
-                        f"Error processing car VIN: {car.vin}: {str(e)}"
+                    return
+
+                timer_ids = {car["command_payload"]["timer"] for car in timed_out
+                             if isinstance(car["command_payload"], dict) and car["command_payload"].get("timer")}
+                if timer_ids:
+                    CommandTimerSetting.objects.filter(pk__in=timer_ids).update(
+                        last_command_execution=now,
+                        last_command_result=2,
+                        # one-time timers are disabled after running
+                        enabled=Case(When(timer_type=0, then=Value(False)), default=F("enabled")),
+                        next_fire_at=Case(When(timer_type=0, then=Value(None)), default=F("next_fire_at")),
                     )
-                )
 
-        if cars_count == 0:
+                command_types = dict(COMMAND_TYPES)
+                alerts = AlertHistory.objects.bulk_create([
+                    AlertHistory(
+                        type=98,  # Command timeout from ALERT_TYPES
+                        command_id=car["command_id"],
+                        car_id=car["id"],
+                        additional_data=f"Command '{command_types.get(car['command_type'], car['command_type'])}' "
+                                        f"timed out after 5 minutes"
+                    ) for car in timed_out
+                ])
+                metrics.commands.inc(len(timed_out), result="timeout")
+
+                # Saved without signals, cars and alerts are broadcast once per car
+                broadcast_car_updates_on_commit([
+                    (car["owner_id"], car["id"], [alert.pk] if alert.pk is not None else [])
+                    for car, alert in zip(timed_out, alerts)
+                ])
+        except Exception as e:
             self.stdout.write(
-                self.style.WARNING("No command timeouts found")
+                self.style.ERROR(
+                    f"Error processing command timeouts: {str(e)}"
+                )
             )
-        else:
+            return
+
+        for car in timed_out:
             self.stdout.write(
-                self.style.SUCCESS(f"Processed {cars_count} command timeouts")
+                self.style.SUCCESS(
+                    f"Processed timeout for car VIN: {car['vin']} - "
+                    f"Command: {command_types.get(car['command_type'], car['command_type'])}"
+                )
             )
+        self.stdout.write(
+            self.style.SUCCESS(f"Processed {len(timed_out)} command timeouts")
+        )
 
     def handle_command_timers(self):
         try:
-            now = timezone.now().utcnow()
-            current_weekday = now.weekday()  # 0=Mon, 6=Sun
-            one_minute_later = (now + datetime.timedelta(minutes=1)).time()
-
-            # Weekday mapping to model fields
-            weekday_fields = {
-                0: 'weekday_mon',
-                1: 'weekday_tue',
-                2: 'weekday_wed',
-                3: 'weekday_thu',
-                4: 'weekday_fri',
-                5: 'weekday_sat',
-                6: 'weekday_sun',
-            }
-
-            # Get timers that are scheduled for current weekday or specific date
-            timers = CommandTimerSetting.objects.filter(
-                Q(**{weekday_fields[current_weekday]: True}) |
-                Q(date=now.date())
-            ).exclude(
-                Q(enabled=False) |
-                Q(last_command_execution__date=now.date()) |
-                Q(
-                    last_command_execution__week_day=current_weekday + 1,
-                    last_command_execution__day=now.day,
-                    last_command_execution__month=now.month,
-                    last_command_execution__year=now.year
-                )
-            )
+            now = timezone.now()
+            # Commands are sent TIMER_LEAD before the timer time, in one query with their cars
+            due = list(CommandTimerSetting.due_for_cars(now + TIMER_LEAD))
 
-            timers_count = timers.count()
-
-            if timers_count == 0:
+            if len(due) == 0:
                 self.stdout.write(
                     self.style.WARNING("No pending timers found")
                 )
             else:
                 self.stdout.write(
-                    self.style.SUCCESS(f"Processing {timers_count} timers")
+                    self.style.SUCCESS(f"Processing {len(due)} timer commands")
                 )
 
-            for timer in timers:
-                if (timer.time.hour == one_minute_later.hour and
-                        timer.time.minute == one_minute_later.minute):
-
-                    cars = Car.objects.filter(timer_commands=timer.id)
-
-                    for car in cars:
-                        try:
-                            print(f"Car {car.vin}: Requesting timer {timer.id}, cmd type: {timer.command_type}")
-                            try:
-                                car = send_command_using_provider(timer.command_type, {"timer": timer.id}, car)
-                            except Exception as e:
-                                print(f"Could not send SMS message: {e}")
-                                print(e)
-
-                            timer.last_command_execution = now
-                            timer.last_command_result = -1
-                            timer.save()
-                        except Exception as e:
-                            self.stdout.write(
-                                self.style.ERROR(
-                                      f"Error processing command for Car: {car}, Timer: {timer.name}: {str(e)}"
-                                )
-                            )
-                            timer.last_command_result = 1
-                            timer.save()
+            timers = {}
+            requests = []
+            for assignment in due:
+                timer, _ = timers.setdefault(assignment.commandtimersetting_id, (assignment.commandtimersetting, set()))
+                car = assignment.car
+                if timer.next_fire_at < now - TIMER_MISSED_GRACE:
+                    # The scheduler was not running at the timer time, saving reschedules it
+                    print(f"Car {car.vin}: Skipping timer {timer.id} missed at {timer.next_fire_at}")
+                    continue
+                print(f"Car {car.vin}: Requesting timer {timer.id}, cmd type: {timer.command_type}")
+                requests.append((car, timer.command_type, {"timer": timer.id}))
 
+            report = submit_commands(requests)
+            for (_, _, payload), outcome in zip(requests, report.outcomes):
+                timers[payload["timer"]][1].add(outcome)
+            if requests:
+                self.stdout.write(
+                    self.style.SUCCESS(f"Timer commands: {report}")
+                )
+
+            for timer, outcomes in timers.values():
+                if outcomes == {THROTTLED}:
+                    # Not sent to any car yet, the timer stays due for the next run
+                    continue
+                if outcomes:
+                    timer.last_command_execution = now
+                    timer.last_command_result = 1 if outcomes == {FAILED} else -1
+                # Saving moves next_fire_at past this run
+                timer.save()
 
         except Exception as e:
             self.stdout.write(
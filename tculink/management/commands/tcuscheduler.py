@@ -0,0 +1,111 @@
+import logging
+import signal
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from tculink.management.commands.tcuperiodicupdate import Command as PeriodicUpdateCommand
+from tculink.utils import metrics
+from tculink.utils.leader import get_leader_lock
+
+logger = logging.getLogger(__name__)
+
+scheduler_runs = metrics.Counter("opencarwings_scheduler_runs_total", "Scheduled task runs by result",
+                                 ("task", "result"))
+scheduler_leader = metrics.Gauge("opencarwings_scheduler_leader", "1 while this scheduler is the active one")
+
+
+class ScheduledTask:
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.next_run = 0
+
+    def run_if_due(self, now):
+        if now < self.next_run:
+            return False
+        self.next_run = now + self.interval
+        try:
+            self.func()
+        except Exception as e:
+            logger.exception("Scheduled task %s failed: %s", self.name, e)
+            scheduler_runs.inc(task=self.name, result="failed")
+        else:
+            scheduler_runs.inc(task=self.name, result="ok")
+        return True
+
+
+class Command(BaseCommand):
+    help = 'Run periodic updates, command timers and token cleanup, one active scheduler at a time'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=getattr(settings, "SCHEDULER_INTERVAL", 15),
+                            help="Seconds between command timeout and timer checks")
+
+    def build_tasks(self, interval, stdout=None, stderr=None):
+        periodic = PeriodicUpdateCommand(stdout=stdout or sys.stdout, stderr=stderr or sys.stderr)
+        return [
+            ScheduledTask("timeouts", interval, periodic.handle_timeouts),
+            # Timers fire one minute ahead, checking several times a minute never misses one
+            ScheduledTask("command_timers", interval, periodic.handle_command_timers),
+            ScheduledTask("datarefresh", max(interval, 60), periodic.handle_datarefresh),
+            ScheduledTask("flushexpiredtokens", 3600, lambda: call_command("flushexpiredtokens")),
+        ]
+
+    def handle(self, *args, **options):
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        interval = options["interval"]
+        self.tasks = self.build_tasks(interval, options.get("stdout"), options.get("stderr"))
+        self.leader = False
+        # A crashed leader is replaced once its lease expires
+        lock = get_leader_lock("tcuscheduler", ttl=max(int(interval * 4), 60))
+
+        stopping = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stopping.set())
+
+        logger.info("Scheduler started, checking every %.0f s", interval)
+        try:
+            while not stopping.is_set():
+                self.tick(lock, time.monotonic())
+                stopping.wait(interval)
+        finally:
+            if self.leader:
+                lock.release()
+            logger.info("Scheduler stopped")
+
+    def tick(self, lock, now):
+        self.keep_connection()
+        try:
+            leader = lock.acquire()
+        except Exception as e:
+            logger.warning("Leader election failed: %s", e)
+            leader = False
+
+        if leader != self.leader:
+            logger.info("Scheduler is now %s", "active" if leader else "on standby")
+            scheduler_leader.set(int(leader))
+            self.leader = leader
+            for task in self.tasks:
+                # A new leader does not know when the previous one ran the tasks
+                task.next_run = 0
+        if not leader:
+            return
+
+        # Tasks sending many SMS may run longer than the lease
+        with lock.keep_alive():
+            for task in self.tasks:
+                task.run_if_due(now)
+
+    @staticmethod
+    def keep_connection():
+        # The connection is kept between ticks and only replaced when broken, closing it would
+        # also release the advisory lock
+        if connection.connection is not None and not connection.is_usable():
+            connection.close()
@@ -1,50 +1,119 @@
 import asyncio
+import collections
 import decimal
 import logging
+import multiprocessing
 import os
+import signal
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Case, When, Value, F
 from django.utils import timezone
 
 from db.models import Car, AlertHistory, CommandTimerSetting
+from db.signals import coalesced_car_updates
 from tculink.gdc_proto import GIDS_NEW_24kWh, WH_PER_GID_GEN1
-from tculink.gdc_proto.parser import parse_gdc_packet
+from tculink.gdc_proto.framing import GDCStreamReassembler
+from tculink.gdc_proto.decoder import decode_gdc_packet
 from tculink.gdc_proto.responses import create_charge_status_response, create_charge_request_response, \
     create_ac_setting_response, create_ac_stop_response, create_config_read, auth_common_dest
-from tculink.utils.notifications import send_vehicle_alert_notification
+from tculink.utils.notification_queue import enqueue_vehicle_alert
+from tculink.utils import metrics
+from tculink.utils.capture import capture
+from tculink.utils.tcu_identity import get_tcu_identity
+from tculink.utils.tcu_logging import PayloadSampler, start_queue_logging, start_direct_logging
+from tculink.utils.workerstats import WorkerStats, create_shared_stats, aggregate_stats, format_stats
 from django.utils.translation import gettext as _
 
 
-# Configure logging
+# Logging is configured when the server starts, see tculink.utils.tcu_logging
 log_dir = 'logs'
 os.makedirs(log_dir, exist_ok=True)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(os.path.join(log_dir, 'tcuserver.log')),
-        logging.StreamHandler()  # This keeps console output as well
-    ]
-)
+log_file = os.path.join(log_dir, 'tcuserver.log')
 logger = logging.getLogger(__name__)
 
+# Seconds between aggregated worker stats log entries
+WORKER_STATS_INTERVAL = 60
+# Seconds to wait for a closed connection to be flushed and shut down
+CLOSE_TIMEOUT = 5
 
-@sync_to_async
-def get_car(vin_id):
-    return Car.objects.get(vin=vin_id)
 
-@sync_to_async
-def get_commandtimersetting(id):
-    return CommandTimerSetting.objects.get(pk=id)
+class DBWorkExecutor(ThreadPoolExecutor):
+    """
+    Thread pool for the per-packet database work, each thread keeps its own database connection.
+    The number of jobs waiting for a free thread is reported as the db_queue_depth stat, jobs
+    not yet completed as the opencarwings_tcu_db_queue_depth metric.
+    """
 
-@sync_to_async
-def get_car_owner_info(car):
-    return car.owner
+    def __init__(self, max_workers, stats):
+        super().__init__(max_workers=max_workers, thread_name_prefix="tcuserver-db")
+        self.stats = stats
+
+    def submit(self, fn, /, *args, **kwargs):
+        self.stats.incr("db_queue_depth")
+
+        def run():
+            self.stats.decr("db_queue_depth")
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                # Connection may be broken after a failure, the next job of this thread reconnects
+                connections.close_all()
+                raise
+
+        future = super().submit(run)
+        metrics.db_queue_depth.inc()
+        future.add_done_callback(lambda _: metrics.db_queue_depth.dec())
+        return future
+
+
+async def close_connection(writer):
+    """Close a connection, a peer which does not acknowledge within CLOSE_TIMEOUT is dropped"""
+    writer.close()
+    try:
+        await asyncio.wait_for(writer.wait_closed(), CLOSE_TIMEOUT)
+    except (asyncio.TimeoutError, OSError):
+        pass
+
+
+class ClientSession:
+    """State of a single TCU connection"""
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.vin = None
+
+
+class PacketResult:
+    """Outcome of a processed packet, applied on the event loop once the transaction has committed"""
+
+    def __init__(self):
+        self.responses = []
+        self.notifications = []
+        self.car = None
+        self.error = None
+        self.close = False
+
+
+def snapshot_fields(instance):
+    return {field.attname: getattr(instance, field.attname) for field in instance._meta.concrete_fields}
+
+def save_changed_fields(instance, snapshot):
+    """Save only the columns that differ from the snapshot, returns changed field names"""
+    changed = [attname for attname, value in snapshot.items() if getattr(instance, attname) != value]
+    if changed:
+        instance.save(update_fields=changed)
+    return changed
 
-@sync_to_async
 def set_evinfo(car, ev_info, tcu_info):
+    snapshot = snapshot_fields(car.ev_info)
     if car.ev_info.max_gids == 0:
         if tcu_info['vehicle_descriptor'] == 0x02 or tcu_info['vehicle_descriptor'] == 0x92:
             car.ev_info.max_gids = GIDS_NEW_24kWh
@@ -93,10 +162,10 @@ def set_evinfo(car, ev_info, tcu_info):
     else:
         car.ev_info.car_gear = 1 if ev_info.get("direction_forward", False) else 2
     car.ev_info.last_updated = timezone.now()
-    car.ev_info.save()
+    save_changed_fields(car.ev_info, snapshot)
 
-@sync_to_async
 def set_tcuconfig(car, car_config):
+    snapshot = snapshot_fields(car.tcu_configuration)
     car.tcu_configuration.dial_code = car_config.get("dial_code", None)
     car.tcu_configuration.apn = car_config.get("apn_name", None)
     car.tcu_configuration.apn_user = car_config.get("apn_user", None)
@@ -107,446 +176,689 @@ def set_tcuconfig(car, car_config):
     car.tcu_configuration.proxy_url = car_config.get("proxy_url", None)
     car.tcu_configuration.connection_type = car_config.get("gprs_type", None)
     car.tcu_configuration.last_updated = timezone.now()
-    car.tcu_configuration.save()
+    save_changed_fields(car.tcu_configuration, snapshot)
 
-@sync_to_async
 def set_gpsinfo(car, gps_info):
+    snapshot = snapshot_fields(car.location)
     car.location.lat = gps_info.get("latitude", None)
     car.location.lon = gps_info.get("longitude", None)
     car.location.home = gps_info.get("home_status", False)
     car.location.last_updated = timezone.now()
-    car.location.save()
-
-@sync_to_async
-def get_evinfo(car):
-    return car.ev_info
-
-@sync_to_async
-def get_location(car):
-    return car.location
+    save_changed_fields(car.location, snapshot)
 
 class Command(BaseCommand):
     help = "Start TCU socket server"
+    stats = WorkerStats()
+    db_executor = None
+    # Seconds to wait for the rest of a started packet and for the next packet
+    read_timeout = getattr(settings, "TCU_SERVER_READ_TIMEOUT", 30)
+    idle_timeout = getattr(settings, "TCU_SERVER_IDLE_TIMEOUT", 300)
+    max_sessions_per_vin = getattr(settings, "TCU_SERVER_MAX_SESSIONS_PER_VIN", 2)
+    # Packets waiting for a database thread before new ones are rejected
+    max_db_queue = getattr(settings, "TCU_SERVER_MAX_DB_QUEUE", 200)
+    payload_sampler = PayloadSampler()
+    # Seconds between reloads of the debug capture list
+    capture_refresh_interval = getattr(settings, "TCU_DEBUG_CAPTURE_REFRESH", 10)
 
     def add_arguments(self, parser):
         parser.add_argument("host", type=str)
-
-    async def handle_client(self, reader, writer):
-        """Handle individual client connections"""
-        try:
-            authenticated = False
-            while True:
-                data = await reader.read(1024)  # Read up to 1024 bytes
-                if not data:
-                    logger.info("Connection closed")
-                    break
-
-                try:
-                    parsed_data = parse_gdc_packet(data)
-
-                    if parsed_data.get("tcu", None) is None:
-                        raise CommandError("No TCU info received")
-
-                    tcu_info = parsed_data["tcu"]
-
-                    if tcu_info["vin"] is None:
-                        raise CommandError("No VIN received")
-
-                    logger.info(f"TCU Payload hex: {data.hex()}")
-                    logger.info(f"TCU Info: {tcu_info}")
-                    try:
-                        car = await get_car(tcu_info["vin"])
-                        if tcu_info.get("tcu_id", None) != car.tcu_model:
-                            writer.write(create_charge_status_response(False))
-                            await writer.drain()
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Number of worker processes sharing the port using SO_REUSEPORT")
+        parser.add_argument("--db-threads", type=int, default=getattr(settings, "TCU_SERVER_DB_THREADS", 8),
+                            help="Database threads per worker, each holds one database connection")
+        parser.add_argument("--max-connections", type=int,
+                            default=getattr(settings, "TCU_SERVER_MAX_CONNECTIONS", 1000),
+                            help="Concurrent connections per worker, further connections are closed")
+
+    def process_packet(self, parsed_data):
+        """
+        Apply a parsed packet to the database as one unit of work. Runs in a worker thread inside
+        a single transaction, responses and notifications are returned for the event loop.
+        """
+        result = PacketResult()
+        tcu_info = parsed_data["tcu"]
+        authenticated = False
+        # Decoded payloads are only recorded for VINs in debug capture
+        dump_level = logging.INFO if self.payload_sampler.is_captured(tcu_info["vin"]) else logging.DEBUG
+
+        # Unknown VINs are rejected from the identity cache without querying the database
+        identity = get_tcu_identity(tcu_info["vin"])
+        if identity is None:
+            metrics.auth_failures.inc(protocol="gdc", reason="unknown_car")
+            result.responses.append(create_charge_status_response(False))
+            result.error = "No car found"
+            return result
+
+        # No savepoint when already inside a transaction, a failed packet rolls back the caller
+        with transaction.atomic(savepoint=False):
+            try:
+                # owner credentials come from the identity, notifications load the owner themselves
+                car = Car.objects.select_related("ev_info", "location", "tcu_configuration").get(pk=identity["car_id"])
+            except Car.DoesNotExist:
+                result.responses.append(create_charge_status_response(False))
+                result.error = "No car found"
+                return result
+
+            result.car = car
+            car_snapshot = snapshot_fields(car)
+            with coalesced_car_updates(car):
+                if tcu_info.get("tcu_id", None) != identity["tcu_model"]:
+                    metrics.auth_failures.inc(protocol="gdc", reason="tcu_id")
+                    result.responses.append(create_charge_status_response(False))
+                    new_alert = AlertHistory()
+                    new_alert.type = 99
+                    new_alert.additional_data = _("TCU ID does not match with specified ID, please double check!")
+                    new_alert.car = car
+                    new_alert.command_id = car.command_id
+                    new_alert.save()
+                elif tcu_info.get("unit_id", None) != identity["tcu_serial"]:
+                    metrics.auth_failures.inc(protocol="gdc", reason="unit_id")
+                    result.responses.append(create_charge_status_response(False))
+                    new_alert = AlertHistory()
+                    new_alert.type = 99
+                    new_alert.additional_data = _("Navi ID does not match with specified ID, please double check!")
+                    new_alert.car = car
+                    new_alert.command_id = car.command_id
+                    new_alert.save()
+                elif tcu_info.get("iccid", None) != identity["iccid"]:
+                    metrics.auth_failures.inc(protocol="gdc", reason="iccid")
+                    result.responses.append(create_charge_status_response(False))
+                    new_alert = AlertHistory()
+                    new_alert.type = 99
+                    new_alert.additional_data = _("Sim ID does not match with specified ID, please double check!")
+                    new_alert.car = car
+                    new_alert.command_id = car.command_id
+                    new_alert.save()
+                else:
+                    # skip auth and set as authenticated if check is disabled
+                    authenticated = identity["disable_auth"]
+                    logger.debug("TCU Authentication check status: %s", authenticated)
+                    # auth before anything
+                    if parsed_data["message_type"][0] != 5 and not authenticated:
+                        auth_data = parsed_data.get("auth", None)
+
+                        if auth_data is None:
+                            metrics.auth_failures.inc(protocol="gdc", reason="missing_credentials")
+                            result.responses.append(create_charge_status_response(False))
                             new_alert = AlertHistory()
                             new_alert.type = 99
-                            new_alert.additional_data = _("TCU ID does not match with specified ID, please double check!")
+                            new_alert.additional_data = _(
+                                "Authentication failed, username or password is missing! Please sign in using navigation unit.")
                             new_alert.car = car
                             new_alert.command_id = car.command_id
-                            await sync_to_async(new_alert.save)()
-                        elif tcu_info.get("unit_id", None) != car.tcu_serial:
-                            writer.write(create_charge_status_response(False))
-                            await writer.drain()
-                            new_alert = AlertHistory()
-                            new_alert.type = 99
-                            new_alert.additional_data = _("Navi ID does not match with specified ID, please double check!")
-                            new_alert.car = car
-                            new_alert.command_id = car.command_id
-                            await sync_to_async(new_alert.save)()
-                        elif tcu_info.get("iccid", None) != car.iccid:
-                            writer.write(create_charge_status_response(False))
-                            await writer.drain()
-                            new_alert = AlertHistory()
-                            new_alert.type = 99
-                            new_alert.additional_data = _("Sim ID does not match with specified ID, please double check!")
-                            new_alert.car = car
-                            new_alert.command_id = car.command_id
-                            await sync_to_async(new_alert.save)()
+                            new_alert.save()
                         else:
-                            # skip auth and set as authenticated if check is disabled
-                            authenticated = car.disable_auth
-                            logger.info(f"TCU Authentication check status: {authenticated}")
-                            # auth before anything
-                            if parsed_data["message_type"][0] != 5 and not authenticated:
-                                auth_data = parsed_data.get("auth", None)
-
-                                if auth_data is None:
-                                    writer.write(create_charge_status_response(False))
-                                    await writer.drain()
-                                    new_alert = AlertHistory()
-                                    new_alert.type = 99
-                                    new_alert.additional_data = _(
-                                        "Authentication failed, username or password is missing! Please sign in using navigation unit.")
-                                    new_alert.car = car
-                                    new_alert.command_id = car.command_id
-                                    await sync_to_async(new_alert.save)()
-                                else:
-                                    username = auth_data["user"]
-                                    password_hash = auth_data["pass"]
-
-                                    car_owner = await get_car_owner_info(car)
-
-                                    if username == car_owner.username or password_hash == car_owner.tcu_pass_hash:
-                                        authenticated = True
-                                    else:
-                                        writer.write(create_charge_status_response(False))
-                                        await writer.drain()
-                                        new_alert = AlertHistory()
-                                        new_alert.type = 99
-                                        new_alert.additional_data = _(
-                                            "Authentication failed, username or password is incorrect! Please sign in using navigation unit.")
-                                        new_alert.car = car
-                                        new_alert.command_id = car.command_id
-                                        await sync_to_async(new_alert.save)()
-
-                        car.last_connection = timezone.now()
-
-                        car.vehicle_code1 = tcu_info["vehicle_descriptor"]
-                        car.vehicle_code2 = tcu_info["vehicle_code1"]
-                        car.vehicle_code3 = tcu_info["vehicle_code2"]
-                        car.vehicle_code4 = tcu_info["vehicle_code3"]
-                        car.tcu_ver = tcu_info["sw_version"]
-                    except Car.DoesNotExist:
-                        writer.write(create_charge_status_response(False))
-                        await writer.drain()
-                        raise CommandError("No car found")
-
-                    if not authenticated:
-                        car.command_result = 1
-                        car.command_requested = False
-                        await sync_to_async(car.save)()
-                        await writer.drain()
-                        return
-
-                    if parsed_data.get("gps", None) is not None:
-                        logger.info(f"GPS Data: {parsed_data['gps']}")
-                        await set_gpsinfo(car, parsed_data["gps"])
+                            username = auth_data["user"]
+                            password_hash = auth_data["pass"]
 
-                    if parsed_data["message_type"][0] == 1:
-                        logger.info(f"Auth Data: {parsed_data['auth']}")
-                        if car.command_requested and car.command_result == -1:
-                            logger.info(f"Command found: {car.command_id} {car.command_requested} {car.command_type} {car.command_payload} {car.command_request_time}")
-                            car.command_result = 3
-                            car.command_requested = False
-                            if car.command_type == 1:
-                                writer.write(create_charge_status_response(True))
-                            elif car.command_type == 2:
-                                writer.write(create_charge_request_response(True))
-                            elif car.command_type == 3:
-                                writer.write(create_ac_setting_response(True))
-                            elif car.command_type == 4:
-                                writer.write(create_ac_stop_response(True))
-                            elif car.command_type == 5:
-                                writer.write(create_config_read())
-                            elif car.command_type == 6:
-                                writer.write(auth_common_dest())
+                            if username == identity["owner_username"] or password_hash == identity["owner_tcu_pass_hash"]:
+                                authenticated = True
                             else:
-                                logger.info(f"Unknown command: {car.command_type}")
-                                writer.write(create_charge_status_response(False))
-                                logger.info("Write failure response and change request status")
-                                car.command_requested = False
-                                car.command_result = 1
-
-                        else:
-                            logger.info("No command or another in progress, send success false")
-                            writer.write(create_charge_status_response(False))
-                    elif parsed_data["message_type"][0] == 3:
-                        logger.info(f"Auth Data: {parsed_data['auth']}")
-                        body_type = parsed_data["body_type"]
-                        logger.info(f"Body Type: {body_type}")
-
-                        car.command_result = 0
-
-                        if parsed_data["body"] is not None:
-                            req_body = parsed_data["body"]
-                            if body_type != "config_read":
-                                await set_evinfo(car, req_body, tcu_info)
-
-                            if body_type == "cp_remind":
+                                metrics.auth_failures.inc(protocol="gdc", reason="credentials")
+                                result.responses.append(create_charge_status_response(False))
                                 new_alert = AlertHistory()
-                                new_alert.type = 3
+                                new_alert.type = 99
+                                new_alert.additional_data = _(
+                                    "Authentication failed, username or password is incorrect! Please sign in using navigation unit.")
                                 new_alert.car = car
                                 new_alert.command_id = car.command_id
-                                await sync_to_async(new_alert.save)()
-                                await send_vehicle_alert_notification(
-                                    car,
-                                    _("Vehicle is unplugged. Please check the situation if necessary."),
-                                    _("Charger unplugged notification")
-                                )
-
-                            if body_type == "ac_result":
-                                new_alert = AlertHistory()
-                                new_alert.type = 97
-
-                                alert_msg = _("The A/C preconditioning command could not be executed. One of the "
-                                             "reasons behind such error could be: a) low state of charge b) command already executed c) TCU error.")
-                                alert_subject = _("A/C preconditioning error")
+                                new_alert.save()
+
+                car.last_connection = timezone.now()
+
+                car.vehicle_code1 = tcu_info["vehicle_descriptor"]
+                car.vehicle_code2 = tcu_info["vehicle_code1"]
+                car.vehicle_code3 = tcu_info["vehicle_code2"]
+                car.vehicle_code4 = tcu_info["vehicle_code3"]
+                car.tcu_ver = tcu_info["sw_version"]
+
+                if not authenticated:
+                    car.command_result = 1
+                    car.command_requested = False
+                    save_changed_fields(car, car_snapshot)
+                    result.close = True
+                    return result
+
+                if parsed_data.get("gps", None) is not None:
+                    logger.log(dump_level, "GPS Data: %s", parsed_data["gps"])
+                    set_gpsinfo(car, parsed_data["gps"])
+
+                if parsed_data["message_type"][0] == 1:
+                    logger.log(dump_level, "Auth Data: %s", parsed_data["auth"])
+                    if car.command_requested and car.command_result == -1:
+                        logger.info("Command found: %s %s %s %s %s", car.command_id, car.command_requested,
+                                    car.command_type, car.command_payload, car.command_request_time)
+                        car.command_result = 3
+                        metrics.commands.inc(result="delivered")
+                        car.command_requested = False
+                        if car.command_type == 1:
+                            result.responses.append(create_charge_status_response(True))
+                        elif car.command_type == 2:
+                            result.responses.append(create_charge_request_response(True))
+                        elif car.command_type == 3:
+                            result.responses.append(create_ac_setting_response(True))
+                        elif car.command_type == 4:
+                            result.responses.append(create_ac_stop_response(True))
+                        elif car.command_type == 5:
+                            result.responses.append(create_config_read())
+                        elif car.command_type == 6:
+                            result.responses.append(auth_common_dest())
+                        else:
+                            logger.info("Unknown command: %s", car.command_type)
+                            result.responses.append(create_charge_status_response(False))
+                            logger.info("Write failure response and change request status")
+                            car.command_requested = False
+                            car.command_result = 1
 
-                                error_present = req_body["error_notification"] > 0
+                    else:
+                        logger.debug("No command or another in progress, send success false")
+                        result.responses.append(create_charge_status_response(False))
+                elif parsed_data["message_type"][0] == 3:
+                    logger.log(dump_level, "Auth Data: %s", parsed_data["auth"])
+                    body_type = parsed_data["body_type"]
+                    logger.debug("Body Type: %s", body_type)
+
+                    # Result of a delivered command
+                    if car.command_result == 3:
+                        metrics.commands.inc(result="success")
+                    car.command_result = 0
+
+                    if parsed_data["body"] is not None:
+                        req_body = parsed_data["body"]
+                        if body_type != "config_read":
+                            set_evinfo(car, req_body, tcu_info)
+
+                        if body_type == "cp_remind":
+                            new_alert = AlertHistory()
+                            new_alert.type = 3
+                            new_alert.car = car
+                            new_alert.command_id = car.command_id
+                            new_alert.save()
+                            result.notifications.append((
+                                _("Vehicle is unplugged. Please check the situation if necessary."),
+                                _("Charger unplugged notification")
+                            ))
 
-                                # ac on
+                        if body_type == "ac_result":
+                            new_alert = AlertHistory()
+                            new_alert.type = 97
+
+                            alert_msg = _("The A/C preconditioning command could not be executed. One of the "
+                                         "reasons behind such error could be: a) low state of charge b) command already executed c) TCU error.")
+                            alert_subject = _("A/C preconditioning error")
+
+                            error_present = req_body["error_notification"] > 0
+
+                            # ac on
+                            if req_body["pri_ac_req_result"] == 1:
+                                alert_subject = _("A/C preconditioning started")
+                                alert_msg = _("A/C preconditioning has been successfully switched on")
+                                new_alert.type = 4
+                            # unknown
+                            elif req_body["pri_ac_req_result"] == 2:
+                                alert_msg = _("The A/C preconditioning has finished unexpectedly")
+                                alert_subject = _("A/C precondition stopped")
+                                new_alert.type = 7
+                                new_alert.additional_data = alert_msg
+                            # timer off
+                            elif req_body["pri_ac_req_result"] == 3:
+                                alert_msg = _("The A/C preconditioning is finished and switched off"
+                                             " after running certain amount of time.")
+                                alert_subject = _("A/C precondition finished")
+                                new_alert.type = 7
+
+
+                            # ac off
+                            if req_body["pri_ac_stop_result"] == 2:
+                                alert_subject = _("A/C precondition stopped")
+                                alert_msg = _("A/C preconditioning has been successfully switched off")
+                                new_alert.type = 5
+                            # ac off, already off state
+                            elif req_body["pri_ac_stop_result"] == 1:
+                                alert_subject = _("A/C precondition notification")
+                                alert_msg = _("A/C preconditioning already switched off")
+                                new_alert.additional_data = alert_msg
+                                new_alert.type = 5
+
+
+                            if error_present:
+                                alert_subject = _("A/C preconditioning fault")
+                                # ac on failure
                                 if req_body["pri_ac_req_result"] == 1:
-                                    alert_subject = _("A/C preconditioning started")
-                                    alert_msg = _("A/C preconditioning has been successfully switched on")
-                                    new_alert.type = 4
-                                # unknown
+                                    alert_msg = _("The vehicle failed to start A/C preconditioning")
+                                # unknown failure
                                 elif req_body["pri_ac_req_result"] == 2:
-                                    alert_msg = _("The A/C preconditioning has finished unexpectedly")
-                                    alert_subject = _("A/C precondition stopped")
-                                    new_alert.type = 7
-                                    new_alert.additional_data = alert_msg
+                                    alert_msg = _("The A/C preconditioning has finished with error")
                                 # timer off
                                 elif req_body["pri_ac_req_result"] == 3:
                                     alert_msg = _("The A/C preconditioning is finished and switched off"
-                                                 " after running certain amount of time.")
-                                    alert_subject = _("A/C precondition finished")
-                                    new_alert.type = 7
-
-
+                                                  " because of an error")
                                 # ac off
-                                if req_body["pri_ac_stop_result"] == 2:
-                                    alert_subject = _("A/C precondition stopped")
-                                    alert_msg = _("A/C preconditioning has been successfully switched off")
-                                    new_alert.type = 5
+                                elif req_body["pri_ac_stop_result"] == 2:
+                                    alert_msg = _("A/C preconditioning could not be switched off")
                                 # ac off, already off state
                                 elif req_body["pri_ac_stop_result"] == 1:
-                                    alert_subject = _("A/C precondition notification")
                                     alert_msg = _("A/C preconditioning already switched off")
-                                    new_alert.additional_data = alert_msg
-                                    new_alert.type = 5
-
 
-                                if error_present:
-                                    alert_subject = _("A/C preconditioning fault")
-                                    # ac on failure
-                                    if req_body["pri_ac_req_result"] == 1:
-                                        alert_msg = _("The vehicle failed to start A/C preconditioning")
-                                    # unknown failure
-                                    elif req_body["pri_ac_req_result"] == 2:
-                                        alert_msg = _("The A/C preconditioning has finished with error")
-                                    # timer off
-                                    elif req_body["pri_ac_req_result"] == 3:
-                                        alert_msg = _("The A/C preconditioning is finished and switched off"
-                                                      " because of an error")
-                                    # ac off
-                                    elif req_body["pri_ac_stop_result"] == 2:
-                                        alert_msg = _("A/C preconditioning could not be switched off")
-                                    # ac off, already off state
-                                    elif req_body["pri_ac_stop_result"] == 1:
-                                        alert_msg = _("A/C preconditioning already switched off")
-
-                                    alert_msg += f" (ECODE {req_body['error_notification']})"
-                                    new_alert.additional_data = alert_msg
-                                    new_alert.type = 97
+                                alert_msg += f" (ECODE {req_body['error_notification']})"
+                                new_alert.additional_data = alert_msg
+                                new_alert.type = 97
 
-                                new_alert.car = car
-                                new_alert.command_id = car.command_id
-                                await sync_to_async(new_alert.save)()
+                            new_alert.car = car
+                            new_alert.command_id = car.command_id
+                            new_alert.save()
 
-                                await send_vehicle_alert_notification(
-                                    car,
-                                    alert_msg,
-                                    alert_subject
-                                )
+                            result.notifications.append((alert_msg, alert_subject))
 
-                            if body_type == "remote_stop":
-                                new_alert = AlertHistory()
-                                error_present = req_body["error_notification"] > 0
+                        if body_type == "remote_stop":
+                            new_alert = AlertHistory()
+                            error_present = req_body["error_notification"] > 0
+
+                            if req_body["charge_stop"] != 0:
+                                subject = _("Charging notification")
+                                new_alert.type = 96
+                                alert_message = f"charge_stop {req_body['charge_stop']}"
+
+                                if req_body["charge_stop"] == 1:
+                                    new_alert.type = 1
+                                    alert_message = _("Vehicle has finished charging.")
+                                    subject = _("Charge finish notification")
+                                elif req_body["charge_stop"] == 2:
+                                    new_alert.type = 8
+                                    alert_message = _("Vehicle has finished quick-charging.")
+                                    subject = _("Quick-charge finish notification")
 
-                                if req_body["charge_stop"] != 0:
-                                    subject = _("Charging notification")
-                                    new_alert.type = 96
-                                    alert_message = f"charge_stop {req_body['charge_stop']}"
+                                if error_present:
+                                    subject = _("Charge interruption notification")
 
                                     if req_body["charge_stop"] == 1:
-                                        new_alert.type = 1
-                                        alert_message = _("Vehicle has finished charging.")
-                                        subject = _("Charge finish notification")
+                                        alert_message = _("Charging has been stopped due to an interruption")
                                     elif req_body["charge_stop"] == 2:
-                                        new_alert.type = 8
-                                        alert_message = _("Vehicle has finished quick-charging.")
-                                        subject = _("Quick-charge finish notification")
-
-                                    if error_present:
-                                        subject = _("Charge interruption notification")
-
-                                        if req_body["charge_stop"] == 1:
-                                            alert_message = _("Charging has been stopped due to an interruption")
-                                        elif req_body["charge_stop"] == 2:
-                                            alert_message = _("Quick-charging has been stopped due to an interruption")
-
-                                        alert_message += f" (ECODE {req_body['error_notification']})"
-                                        new_alert.additional_data = alert_message
-                                        new_alert.type = 96
-                                else:
-                                    subject = _("A/C precondition notification")
-                                    new_alert.type = 97
-                                    alert_message = f"pri_ac_req_result {req_body['pri_ac_req_result']}"
+                                        alert_message = _("Quick-charging has been stopped due to an interruption")
 
-                                    if req_body["pri_ac_req_result"] == 3:
-                                        alert_message = _("The A/C preconditioning is finished and switched off"
-                                                      " after running certain amount of time.")
-                                        subject = _("A/C precondition finished")
-                                        new_alert.type = 7
+                                    alert_message += f" (ECODE {req_body['error_notification']})"
+                                    new_alert.additional_data = alert_message
+                                    new_alert.type = 96
+                            else:
+                                subject = _("A/C precondition notification")
+                                new_alert.type = 97
+                                alert_message = f"pri_ac_req_result {req_body['pri_ac_req_result']}"
 
-                                    if error_present:
-                                        subject = _("A/C preconditioning fault")
+                                if req_body["pri_ac_req_result"] == 3:
+                                    alert_message = _("The A/C preconditioning is finished and switched off"
+                                                  " after running certain amount of time.")
+                                    subject = _("A/C precondition finished")
+                                    new_alert.type = 7
 
-                                        if req_body["pri_ac_req_result"] == 3:
-                                            alert_message = _("The A/C preconditioning is finished and switched off"
-                                                          " because of an error")
+                                if error_present:
+                                    subject = _("A/C preconditioning fault")
 
-                                        alert_message += f" (ECODE {req_body['error_notification']})"
-                                        new_alert.additional_data = alert_message
-                                        new_alert.type = 97
+                                    if req_body["pri_ac_req_result"] == 3:
+                                        alert_message = _("The A/C preconditioning is finished and switched off"
+                                                      " because of an error")
 
+                                    alert_message += f" (ECODE {req_body['error_notification']})"
+                                    new_alert.additional_data = alert_message
+                                    new_alert.type = 97
 
-                                new_alert.car = car
-                                new_alert.command_id = car.command_id
-                                await sync_to_async(new_alert.save)()
-                                await send_vehicle_alert_notification(car, alert_message, subject)
 
-                            if body_type == "charge_result":
-                                new_alert = AlertHistory()
-                                new_alert.type = 2
-                                new_alert.car = car
-                                new_alert.command_id = car.command_id
+                            new_alert.car = car
+                            new_alert.command_id = car.command_id
+                            new_alert.save()
+                            result.notifications.append((alert_message, subject))
 
-                                if req_body["charge_request_result"] == 1:
-                                    subject = _("Charge start command executed")
-                                    message = _("Charging command has been sent successfully. If vehicle did not start charging, "
-                                         "please check that the charging cable is connected and power is available.")
-                                else:
-                                    subject = _("Charge start command executed with failure")
-                                    message = _("Charging command has been sent successfully, but the vehicle did not start charging.")
-                                    new_alert.type = 96
-                                    new_alert.additional_data = message
+                        if body_type == "charge_result":
+                            new_alert = AlertHistory()
+                            new_alert.type = 2
+                            new_alert.car = car
+                            new_alert.command_id = car.command_id
 
-                                if req_body["error_notification"] > 0:
-                                    subject = _("Charge start failure")
-                                    message = _("Charge start command failed to execute.")
-                                    message += f" (ECODE {req_body['error_notification']})"
-                                    new_alert.type = 96
-                                    new_alert.additional_data = message
+                            if req_body["charge_request_result"] == 1:
+                                subject = _("Charge start command executed")
+                                message = _("Charging command has been sent successfully. If vehicle did not start charging, "
+                                     "please check that the charging cable is connected and power is available.")
+                            else:
+                                subject = _("Charge start command executed with failure")
+                                message = _("Charging command has been sent successfully, but the vehicle did not start charging.")
+                                new_alert.type = 96
+                                new_alert.additional_data = message
+
+                            if req_body["error_notification"] > 0:
+                                subject = _("Charge start failure")
+                                message = _("Charge start command failed to execute.")
+                                message += f" (ECODE {req_body['error_notification']})"
+                                new_alert.type = 96
+                                new_alert.additional_data = message
+
+                            new_alert.save()
+                            result.notifications.append((message, subject))
+
+                        if body_type == "battery_heat":
+                            # TODO: capture resultstate to determine battery heater status
+                            logger.warning("Battery heat! Resultstate: %d, alertstate: %d", req_body["resultstate"], req_body["alertstate"])
+                            new_alert = AlertHistory()
+                            new_alert.additional_data = f"{req_body['resultstate']},{req_body['alertstate']}"
+                            new_alert.type = 9 if req_body.get('batt_heat_active', False) else 10
+                            new_alert.car = car
+                            new_alert.command_id = car.command_id
+                            new_alert.save()
+                            result.notifications.append((
+                                _("Battery heater notification"),
+                                _("Battery heater has turned on") if req_body.get('batt_heat_active', False) else _("Battery heater has turned off")
+                            ))
+                elif parsed_data["message_type"][0] == 5:
+                    if car.command_result == 3:
+                        metrics.commands.inc(result="success")
+                    car.command_result = 0
+
+                    new_alert = AlertHistory()
+                    new_alert.type = 6
+                    new_alert.car = car
+                    new_alert.command_id = car.command_id
+                    new_alert.save()
+
+                    car_config = parsed_data["body"]
+                    logger.log(dump_level, "Car Config: %s", car_config)
+                    set_tcuconfig(car, car_config)
+                else:
+                    raise Exception("Invalid message type")
+
+
+
+                timer_id = None
+                if car.command_payload is not None and car.command_payload.get("timer"):
+                    timer_id = car.command_payload.get("timer")
+                    car.command_payload = None
+
+                save_changed_fields(car, car_snapshot)
+                if timer_id is not None:
+                    CommandTimerSetting.objects.filter(pk=timer_id).update(
+                        last_command_execution=timezone.now(),
+                        last_command_result=car.command_result,
+                        # one-time timers are disabled after running
+                        enabled=Case(When(timer_type=0, then=Value(False)), default=F("enabled")),
+                    )
+        return result
+
+    def claim_vin(self, session, vin):
+        """Bind the connection to a VIN, returns False if the VIN has too many open sessions"""
+        if session.vin == vin:
+            return True
+        if self.vin_sessions[vin] >= self.max_sessions_per_vin:
+            return False
+        self.release_vin(session)
+        self.vin_sessions[vin] += 1
+        session.vin = vin
+        return True
+
+    def release_vin(self, session):
+        if session.vin is None:
+            return
+        self.vin_sessions[session.vin] -= 1
+        if self.vin_sessions[session.vin] <= 0:
+            del self.vin_sessions[session.vin]
+        session.vin = None
+
+    async def handle_packet(self, data, writer, session):
+        """Handle a single GDC packet, returns False if connection should be closed"""
+        self.stats.incr("packets")
+        try:
+            with metrics.parse_seconds.time(protocol="gdc"):
+                parsed_data = decode_gdc_packet(data)
+            metrics.packets.inc(message_type=parsed_data["message_type"][1], body_type=parsed_data["body_type"])
+
+            if parsed_data.get("tcu", None) is None:
+                raise CommandError("No TCU info received")
+
+            tcu_info = parsed_data["tcu"]
+
+            if tcu_info["vin"] is None:
+                raise CommandError("No VIN received")
+
+            # Full dumps are sampled, formatting every packet is a large share of the work
+            if self.payload_sampler.should_dump(tcu_info["vin"]):
+                logger.info("TCU Payload hex: %s", data.hex())
+                logger.info("TCU Info: %s", tcu_info)
+
+            if not self.claim_vin(session, tcu_info["vin"]):
+                logger.warning("Too many sessions for VIN %s, rejecting %s", tcu_info["vin"], session.peer)
+                self.stats.incr("rejected")
+                writer.write(create_charge_status_response(False))
+                await writer.drain()
+                return False
+
+            # Shed load instead of queueing work the database can not keep up with, TCU retries later
+            if self.stats.get("db_queue_depth") >= self.max_db_queue:
+                logger.warning("Database queue full, rejecting packet from %s", tcu_info["vin"])
+                self.stats.incr("shed")
+                writer.write(create_charge_status_response(False))
+                await writer.drain()
+                return False
+
+            # All database work of the packet is done in one thread hop. Django's async ORM methods
+            # run on a single shared thread, a sized pool lets connections work concurrently
+            with metrics.db_seconds.time(protocol="gdc"):
+                result = await sync_to_async(self.process_packet, thread_sensitive=False,
+                                             executor=self.db_executor)(parsed_data)
+
+            for response in result.responses:
+                writer.write(response)
+            await writer.drain()
+
+            if result.error is not None:
+                raise CommandError(result.error)
+
+            # Delivery is done by the notification workers, a slow mail server must not stall the TCUs
+            for alert_message, subject in result.notifications:
+                enqueue_vehicle_alert(result.car, alert_message, subject)
+
+            if result.close:
+                return False
+        except Exception as e:
+            self.stats.incr("errors")
+            logger.error("Processing packet failed")
+            logger.error(e)
+            logger.error(traceback.format_exc())
+            # GDC packets are generally under 1024 bytes, limit to prevent spam
+            if len(data) < 1024:
+                logger.info("Response logged to file for analysis")
+                dtnow = timezone.now().strftime("%Y-%m-%dT%H:%M:%S")
+                capture("datalog", f"datalog-unknownmsg-{dtnow}.bin", data)
+        return True
 
-                                await sync_to_async(new_alert.save)()
-                                await send_vehicle_alert_notification(
-                                    car,
-                                    message,
-                                    subject)
+    async def handle_client(self, reader, writer):
+        """Handle individual client connections"""
+        session = ClientSession(writer.get_extra_info("peername"))
+        if self.connection_slots.locked():
+            logger.warning("Connection limit reached, rejecting %s", session.peer)
+            self.stats.incr("rejected")
+            await close_connection(writer)
+            return
+
+        async with self.connection_slots:
+            await self.serve_client(reader, writer, session)
+
+    async def serve_client(self, reader, writer, session):
+        self.stats.incr("connections")
+        self.stats.incr("active_connections")
+        metrics.active_connections.inc()
+        try:
+            reassembler = GDCStreamReassembler()
+            while True:
+                # A started packet must be completed quickly, otherwise wait for the next one
+                timeout = self.read_timeout if reassembler.pending else self.idle_timeout
+                try:
+                    data = await asyncio.wait_for(reader.read(1024), timeout)  # Read up to 1024 bytes
+                except asyncio.TimeoutError:
+                    logger.info("Connection from %s timed out", session.peer)
+                    self.stats.incr("timeouts")
+                    break
+                if not data:
+                    if reassembler.pending:
+                        logger.warning("Connection closed with %d bytes of incomplete packet", reassembler.pending)
+                        reassembler.flush()
+                    logger.info("Connection closed")
+                    break
 
-                            if body_type == "battery_heat":
-                                # TODO: capture resultstate to determine battery heater status
-                                logger.warning("Battery heat! Resultstate: %d, alertstate: %d", req_body["resultstate"], req_body["alertstate"])
-                                new_alert = AlertHistory()
-                                new_alert.additional_data = f"{req_body['resultstate']},{req_body['alertstate']}"
-                                new_alert.type = 9 if req_body.get('batt_heat_active', False) else 10
-                                new_alert.car = car
-                                new_alert.command_id = car.command_id
-                                await sync_to_async(new_alert.save)()
-                                await send_vehicle_alert_notification(
-                                    car,
-                                    _("Battery heater notification"),
-                                    _("Battery heater has turned on") if req_body.get('batt_heat_active', False) else _("Battery heater has turned off")
-                                )
-                    elif parsed_data["message_type"][0] == 5:
-                        car.command_result = 0
-
-                        new_alert = AlertHistory()
-                        new_alert.type = 6
-                        new_alert.car = car
-                        new_alert.command_id = car.command_id
-                        await sync_to_async(new_alert.save)()
-
-                        car_config = parsed_data["body"]
-                        logger.info(f"Car Config: {car_config}")
-                        await set_tcuconfig(car, car_config)
-                    else:
-                        raise Exception("Invalid message type")
-
-
-                    timer_id = None
-                    if car.command_payload is not None and car.command_payload.get("timer"):
-                        timer_id = car.command_payload.get("timer")
-                        car.command_payload = None
-
-                    await sync_to_async(car.save)()
-                    try:
-                        if timer_id is not None:
-                            timer_command = await get_commandtimersetting(timer_id)
-                            timer_command.last_command_execution = timezone.now()
-                            timer_command.last_command_result = car.command_result
-                            if timer_command.timer_type == 0:
-                                timer_command.enabled = False
-                            await sync_to_async(timer_command.save)()
-                    except CommandTimerSetting.DoesNotExist:
-                        ...
-                    await writer.drain()
-                except Exception as e:
-                    logger.error("Processing packet failed")
-                    logger.error(e)
-                    logger.error(traceback.format_exc())
-                    # GDC packets are generally under 1024 bytes, limit to prevent spam
-                    if len(data) < 1024:
-                        logger.info("Response logged to file for analysis")
-                        dtnow = timezone.now().strftime("%Y-%m-%dT%H:%M:%S")
-                        with open(f"logs/datalog-unknownmsg-{dtnow}.bin", "wb") as file:
-                            file.write(data)
+                for packet in reassembler.feed(data):
+                    if not await self.handle_packet(packet, writer, session):
+                        return
 
         except Exception as e:
-            logger.error(f"Error handling client: {e}")
+            logger.error("Error handling client: %s", e)
             logger.error(traceback.format_exc())
         finally:
-            writer.close()
-            await writer.wait_closed()
-
-    async def start_server(self, host='127.0.0.1', port=55230):
+            self.release_vin(session)
+            self.stats.decr("active_connections")
+            metrics.active_connections.dec()
+            await close_connection(writer)
+
+    async def log_stats(self):
+        while True:
+            await asyncio.sleep(WORKER_STATS_INTERVAL)
+            logger.info("Stats: %s", format_stats(self.stats.as_dict()))
+
+    async def refresh_capture(self):
+        while True:
+            try:
+                await sync_to_async(self.payload_sampler.refresh_capture, thread_sensitive=False)()
+            except Exception as e:
+                logger.warning("Refreshing debug capture list failed: %s", e)
+            await asyncio.sleep(self.capture_refresh_interval)
+
+    async def start_server(self, host='127.0.0.1', port=55230, reuse_port=False):
         """Start the TCP server"""
+        self.db_executor = DBWorkExecutor(self.db_threads, self.stats)
+        self.connection_slots = asyncio.Semaphore(self.max_connections)
+        self.vin_sessions = collections.Counter()
         try:
             server = await asyncio.start_server(
-                self.handle_client, host, port
+                self.handle_client, host, port, reuse_port=reuse_port
             )
             addr = server.sockets[0].getsockname()
-            logger.info(f"Server running on {addr[0]}:{addr[1]}")
+            logger.info("Server running on %s:%s", addr[0], addr[1])
             self.stdout.write(self.style.SUCCESS(
                 f"Server running on {addr[0]}:{addr[1]}"
             ))
 
+            loop = asyncio.get_running_loop()
+            loop.create_task(self.refresh_capture())
+            # Workers are reported by the supervisor
+            if not reuse_port:
+                loop.create_task(self.log_stats())
+
             async with server:
                 await server.serve_forever()
 
         except Exception as e:
             raise CommandError(f"Server error: {e}")
+        finally:
+            self.db_executor.shutdown(wait=False)
+
+    def run_worker(self, host, port, shared_stats, slot):
+        """Entry point of a forked worker process"""
+        # Supervisor handles termination, workers exit on SIGTERM after flushing their log queue
+        signal.signal(signal.SIGTERM, self.terminate)
+        # Logging threads are only started after fork, the supervisor writes its records directly
+        listener = start_queue_logging(log_file)
+        try:
+            # SIGTERM was blocked across fork, it may only interrupt the worker from here on
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+            # Database connections are opened lazily by each worker, never inherited
+            connections.close_all()
+            self.stats = WorkerStats(shared_stats, slot)
+            logger.info("Worker %d started, pid %d", slot, os.getpid())
+            asyncio.run(self.start_server(host=host, port=port, reuse_port=True))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+            listener.stop()
+
+    @staticmethod
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    def run_workers(self, host, workers, port=55230, stopping=None, poll_interval=1):
+        """
+        Fork worker processes, restart crashed ones and log their aggregated stats until SIGTERM
+        or `stopping` is set. Returns the number of restarted workers.
+        """
+        context = multiprocessing.get_context("fork")
+        shared_stats = create_shared_stats(workers)
+        self.worker_processes = processes = {}
+        restarts = 0
+        stopping = stopping or threading.Event()
+
+        # Supervisor does not use the database, close before forking so no connection is shared
+        connections.close_all()
+
+        def spawn(slot):
+            WorkerStats(shared_stats, slot).reset_gauges()
+            process = context.Process(target=self.run_worker, args=(host, port, shared_stats, slot),
+                                      name=f"tcuserver-worker-{slot}", daemon=True)
+            # SIGTERM stays blocked in the child until it replaces the inherited supervisor handler
+            signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+            try:
+                process.start()
+            finally:
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+            processes[slot] = process
+
+        previous_handler = signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+
+        for slot in range(workers):
+            spawn(slot)
+
+        last_report = time.monotonic()
+        try:
+            while not stopping.wait(poll_interval):
+                for slot, process in list(processes.items()):
+                    if not process.is_alive():
+                        logger.error("Worker %d (pid %d) exited with code %s, restarting",
+                                     slot, process.pid, process.exitcode)
+                        restarts += 1
+                        spawn(slot)
+
+                if time.monotonic() - last_report >= WORKER_STATS_INTERVAL:
+                    last_report = time.monotonic()
+                    logger.info("Workers: %d, restarts: %d, %s", workers, restarts,
+                                format_stats(aggregate_stats(shared_stats, workers)))
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+            for process in processes.values():
+                process.terminate()
+            for process in processes.values():
+                process.join(5)
+        logger.info("Workers stopped")
+        return restarts
 
     def handle(self, *args, **options):
         """Handle the command execution"""
         host = options["host"]
+        workers = options["workers"]
+        if workers < 1:
+            raise CommandError("At least one worker is required")
+        self.db_threads = options["db_threads"]
+        if self.db_threads < 1:
+            raise CommandError("At least one database thread is required")
+        self.max_connections = options["max_connections"]
+        if self.max_connections < 1:
+            raise CommandError("At least one connection must be allowed")
+        # Workers start their own queue logging after fork
+        listener = start_queue_logging(log_file) if workers == 1 else None
         try:
-            asyncio.run(self.start_server(host=host))
+            if workers > 1:
+                start_direct_logging(log_file)
+                self.run_workers(host, workers)
+            else:
+                asyncio.run(self.start_server(host=host))
         except KeyboardInterrupt:
             logger.info("Server stopped by user")
             self.stdout.write("Server stopped by user")
         except Exception as e:
-            logger.error(f"Error: {e}")
-            raise CommandError(f"Error: {e}")
\ No newline at end of file
+            logger.error("Error: %s", e)
+            raise CommandError(f"Error: {e}")
+        finally:
+            if listener is not None:
+                listener.stop()
@@ -1,5 +1,4 @@
 import re
-import requests
 
 from tculink import VERSION
 from tculink.sms import BaseSMSProvider, SMSType
@@ -21,8 +20,8 @@ class Provider46elks(BaseSMSProvider):
 
         msn = re.sub('\D', '', configuration['msn'])
 
-        request = requests.post('https://api.46elks.com/a1/sms',
-                auth=(configuration['apikey_user'], configuration['apikey_password']), timeout=10,
+        request = self.post('https://api.46elks.com/a1/sms',
+                auth=(configuration['apikey_user'], configuration['apikey_password']),
                 data={
                     'from': 'CarWings',
                     'to': f'+{msn}',
@@ -1,21 +1,88 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
+import requests
 from django.conf import settings
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
 
+from tculink import VERSION
+from tculink.utils import metrics
 
-def send_using_provider(message, configuration, tcu_id):
-    parts = settings.SMS_PROVIDERS[configuration.get('provider', '')][1].split('.')
-    module = ".".join(parts[:-1])
-    m = __import__( module )
-    for comp in parts[1:]:
-        m = getattr(m, comp)
+# Connections kept open to each provider, unless set by the 'pool_size' or 'concurrency' options
+DEFAULT_POOL_SIZE = 4
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def provider_options(provider_id):
+    """Options of a provider, the optional third element of its SMS_PROVIDERS entry"""
+    entry = settings.SMS_PROVIDERS.get(provider_id, ())
+    return dict(entry[2]) if len(entry) > 2 else {}
+
+
+def get_provider_class(provider_id):
+    return import_string(settings.SMS_PROVIDERS[provider_id][1])
 
-    provider = m()
+
+def get_provider(provider_id):
+    """
+    Shared instance of a provider, created on first use. Instances are used by several threads
+    and keep their HTTP connections open between messages.
+    """
+    entry = settings.SMS_PROVIDERS[provider_id]
+    with _providers_lock:
+        cached = _providers.get(provider_id)
+        # Replaced when the settings change, e.g. in tests
+        if cached is None or cached[0] != entry:
+            options = provider_options(provider_id)
+            provider = get_provider_class(provider_id)(
+                timeout=options.get("timeout"),
+                pool_size=options.get("pool_size", options.get("concurrency", DEFAULT_POOL_SIZE)))
+            cached = (entry, provider)
+            _providers[provider_id] = cached
+        return cached[1]
+
+
+def send_using_provider(message, configuration, tcu_id):
+    provider = get_provider(configuration.get('provider', ''))
     if not isinstance(message, str):
         if SMSType.BINARY not in provider.SUPPORTED_TYPES:
             raise Exception("SMS provider does not support binary messages!")
     configuration['tcu_id'] = tcu_id
-    return provider.send(message, configuration)
+    service = f"sms_{configuration.get('provider', '')}"
+    with metrics.track_outbound(service):
+        sent = provider.send(message, configuration)
+    if not sent:
+        metrics.outbound_errors.inc(service=service)
+    return sent
+
+def send_batch_using_provider(provider_id, messages):
+    """
+    Send (message, configuration, tcu_id) triples with one provider, batched where its API allows.
+    Returns the result of each message, True when sent, False or the raised exception if not.
+    """
+    provider = get_provider(provider_id)
+    results = [None] * len(messages)
+    pending = []
+    for index, (message, configuration, tcu_id) in enumerate(messages):
+        if not isinstance(message, str) and SMSType.BINARY not in provider.SUPPORTED_TYPES:
+            results[index] = Exception("SMS provider does not support binary messages!")
+            continue
+        configuration['tcu_id'] = tcu_id
+        pending.append(index)
+
+    service = f"sms_{provider_id}"
+    with metrics.track_outbound(service):
+        sent = provider.send_batch([(messages[index][0], messages[index][1]) for index in pending])
+    for index, result in zip(pending, sent):
+        results[index] = result
+    failed = sum(1 for result in results if result is not True)
+    if failed:
+        metrics.outbound_errors.inc(failed, service=service)
+    return results
 
 class SMSType(Enum):
     TEXT = 0
@@ -25,6 +92,87 @@ class BaseSMSProvider:
     CONFIGURATION_FIELDS = []
     HELP_TEXT = None
     SUPPORTED_TYPES = []
+    # Seconds to wait for the provider API, the 'timeout' option of SMS_PROVIDERS overrides it
+    TIMEOUT = 10
+
+    def __init__(self, timeout=None, pool_size=DEFAULT_POOL_SIZE):
+        self.timeout = timeout or self.TIMEOUT
+        self.pool_size = pool_size
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """HTTP session of the provider, its connections are reused by later messages"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    session.headers["User-Agent"] = f"OpenCarWings/{VERSION}"
+                    self._session = session
+        return self._session
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.post(url, **kwargs)
 
     def send(self, message, configuration):
-        raise NotImplementedError()
\ No newline at end of file
+        raise NotImplementedError()
+
+    # Providers with an API sending one message to several recipients set the largest batch and
+    # implement batch_key and send_many
+    MAX_BATCH_SIZE = 1
+
+    def batch_key(self, message, configuration):
+        """Messages with equal keys may be sent by one send_many call, None if the message is sent alone"""
+        return None
+
+    def send_many(self, message, configurations):
+        """Send one message to the recipients of several configurations, returns the result of each"""
+        raise NotImplementedError()
+
+    def split_batches(self, messages):
+        """Group indexes of (message, configuration) pairs into batches sent by one request each"""
+        batches = []
+        groups = {}
+        for index, (message, configuration) in enumerate(messages):
+            key = self.batch_key(message, configuration) if self.MAX_BATCH_SIZE > 1 else None
+            if key is None:
+                batches.append([index])
+                continue
+            batch = groups.get(key)
+            if batch is None or len(batch) >= self.MAX_BATCH_SIZE:
+                batch = []
+                groups[key] = batch
+                batches.append(batch)
+            batch.append(index)
+        return batches
+
+    def _send_unit(self, messages):
+        try:
+            if len(messages) == 1:
+                return [self.send(*messages[0])]
+            return self.send_many(messages[0][0], [configuration for _, configuration in messages])
+        except Exception as e:
+            return [e] * len(messages)
+
+    def send_batch(self, messages):
+        """
+        Send (message, configuration) pairs, returns the result of each, True when sent, False or the
+        raised exception if not. Batches are sent concurrently.
+        """
+        batches = self.split_batches(messages)
+        units = [[messages[index] for index in batch] for batch in batches]
+        if len(units) <= 1:
+            unit_results = [self._send_unit(unit) for unit in units]
+        else:
+            with ThreadPoolExecutor(max_workers=min(len(units), self.pool_size)) as executor:
+                unit_results = list(executor.map(self._send_unit, units))
+        results = [None] * len(messages)
+        for batch, batch_results in zip(batches, unit_results):
+            for index, result in zip(batch, batch_results):
+                results[index] = result
+        return results
@@ -0,0 +1,211 @@
+"""
+Concurrent dispatch of TCU wake-up commands
+
+Commands of a scheduler run are sent by a shared thread pool. Every SMS provider has a token
+bucket limiting its send rate and a cap on concurrent requests, configured by the options of its
+SMS_PROVIDERS entry:
+
+    'hologram': ('Hologram SIM', 'tculink.sms.hologram.ProviderHologram', {'rate': 5, 'burst': 10, 'concurrency': 4}),
+
+Commands with the same message and provider account are sent by one request where the provider
+has a batch API, rate limits count requests. Commands which can not be sent before the deadline
+of the run are throttled, they are left for the next run.
+"""
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from tculink.coordinators import get_coordinator
+from tculink.sms import get_provider, provider_options, send_batch_using_provider
+from tculink.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+DISPATCHED = "dispatched"
+THROTTLED = "throttled"
+FAILED = "failed"
+
+# Limits of providers without their own, rate in requests per second
+DEFAULT_LIMITS = {"rate": 10, "burst": 10, "concurrency": 4}
+
+sms_dispatch = metrics.Counter("opencarwings_sms_dispatch_total", "TCU wake-up commands by provider and result",
+                               ("provider", "result"))
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, deadline):
+        """Take a token, sleeping until it is available. Returns False without one if that is after `deadline`"""
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            # Reserved tokens may go negative, later callers wait for them to be refilled
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+        return True
+
+
+class ProviderLimiter:
+    def __init__(self, rate, burst, concurrency):
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = threading.BoundedSemaphore(max(concurrency, 1))
+
+
+class DispatchReport:
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+        self.counts = collections.Counter(outcomes)
+
+    @property
+    def dispatched(self):
+        return self.counts[DISPATCHED]
+
+    @property
+    def throttled(self):
+        return self.counts[THROTTLED]
+
+    @property
+    def failed(self):
+        return self.counts[FAILED]
+
+    def __str__(self):
+        return f"{self.dispatched} dispatched, {self.throttled} throttled, {self.failed} failed"
+
+
+def provider_limits(provider_id):
+    options = provider_options(provider_id)
+    return {name: options.get(name, default) for name, default in DEFAULT_LIMITS.items()}
+
+
+class CommandDispatcher:
+    def __init__(self, max_workers):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sms-dispatch")
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def limiter(self, provider_id):
+        with self.lock:
+            limiter = self.limiters.get(provider_id)
+            if limiter is None:
+                limiter = ProviderLimiter(**provider_limits(provider_id))
+                self.limiters[provider_id] = limiter
+            return limiter
+
+    def dispatch(self, requests, max_wait=None):
+        """
+        Send (car, command, payload) requests concurrently, returns a DispatchReport with the
+        outcome of every request in order. Requests of providers with a batch API are sent
+        together when their messages and accounts match.
+        """
+        if max_wait is None:
+            max_wait = getattr(settings, "SMS_DISPATCH_MAX_WAIT", 30)
+        deadline = time.monotonic() + max_wait
+        outcomes = [None] * len(requests)
+
+        prepared_requests = []
+        for index, (car, command, payload) in enumerate(requests):
+            try:
+                prepared = get_coordinator(car.tcu_type).prepare_command(command, payload, car)
+            except Exception as e:
+                logger.warning("Car %s: Could not prepare command %s: %s", car.vin, command, e)
+                outcomes[index] = self._count(car, FAILED)
+                continue
+            prepared_requests.append((index, car, prepared))
+
+        results = self.send_messages([((car.sms_config or {}).get("provider", ""), prepared.message,
+                                       car.sms_config, car.tcu_model) for _, car, prepared in prepared_requests],
+                                     deadline)
+        for (index, car, prepared), result in zip(prepared_requests, results):
+            if result == THROTTLED:
+                outcome = THROTTLED
+            elif result is True:
+                try:
+                    prepared.apply(car)
+                    outcome = DISPATCHED
+                except Exception as e:
+                    logger.warning("Car %s: Could not save command %s: %s", car.vin, prepared.command_type, e)
+                    outcome = FAILED
+            else:
+                logger.warning("Car %s: Could not send command %s: %s", car.vin, prepared.command_type,
+                               result or "SMS provider did not accept the message")
+                outcome = FAILED
+            outcomes[index] = self._count(car, outcome)
+        return DispatchReport(outcomes)
+
+    @staticmethod
+    def _count(car, outcome):
+        sms_dispatch.inc(provider=(car.sms_config or {}).get("provider", ""), result=outcome)
+        return outcome
+
+    def send_messages(self, messages, deadline):
+        """
+        Send (provider id, message, configuration, tcu id) tuples concurrently, batched where the
+        provider allows. Returns the result of each message, True when sent, THROTTLED when the
+        deadline passed first, False or the raised exception if sending failed.
+        """
+        results = [None] * len(messages)
+        by_provider = collections.defaultdict(list)
+        for index, message in enumerate(messages):
+            by_provider[message[0]].append(index)
+
+        futures = []
+        for provider_id, indexes in by_provider.items():
+            try:
+                provider = get_provider(provider_id)
+            except KeyError:
+                for index in indexes:
+                    results[index] = Exception(f"Unknown SMS provider {provider_id!r}")
+                continue
+            for batch in provider.split_batches([messages[index][1:3] for index in indexes]):
+                unit = [indexes[i] for i in batch]
+                futures.append((unit, self.executor.submit(
+                    self._send_unit, provider_id, [messages[index][1:] for index in unit], deadline)))
+
+        for unit, future in futures:
+            for index, result in zip(unit, future.result()):
+                results[index] = result
+        return results
+
+    def _send_unit(self, provider_id, messages, deadline):
+        """Send (message, configuration, tcu id) triples with one provider request"""
+        limiter = self.limiter(provider_id)
+        if not limiter.bucket.reserve(deadline):
+            return [THROTTLED] * len(messages)
+        if not limiter.slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            return [THROTTLED] * len(messages)
+        try:
+            return send_batch_using_provider(provider_id, messages)
+        except Exception as e:
+            return [e] * len(messages)
+        finally:
+            limiter.slots.release()
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def dispatch_commands(requests, max_wait=None):
+    """Send (car, command, payload) requests with the shared dispatcher"""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = CommandDispatcher(getattr(settings, "SMS_DISPATCH_WORKERS", 16))
+    return _dispatcher.dispatch(requests, max_wait)
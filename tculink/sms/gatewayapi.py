@@ -2,8 +2,6 @@ import base64
 import re
 from typing import Any
 
-import requests
-
 from tculink import VERSION
 from tculink.sms import BaseSMSProvider, SMSType
 from django.utils.translation import gettext_lazy as _
@@ -16,6 +14,14 @@ class ProviderGatewayAPI(BaseSMSProvider):
     HELP_TEXT = _("API credentials are available in gatewayapi.com API section.")
     SUPPORTED_TYPES = [SMSType.TEXT, SMSType.BINARY]
 
+    # Recipients of one message request
+    MAX_BATCH_SIZE = 1000
+
+    def batch_key(self, message, configuration):
+        if "apikey" not in configuration or len(re.sub('\D', '', configuration.get('msn', ''))) < 1:
+            return None
+        return configuration['apikey'], message
+
     def send(self, message, configuration):
         if "apikey" not in configuration or "msn" not in configuration:
             raise Exception("Configuration is incomplete")
@@ -25,8 +31,15 @@ class ProviderGatewayAPI(BaseSMSProvider):
         if len(msn) < 1:
             raise Exception("Phone number is not valid")
 
+        return self._send_mtsms(message, [msn], configuration['apikey'])
+
+    def send_many(self, message, configurations):
+        msns = [re.sub('\D', '', configuration['msn']) for configuration in configurations]
+        return [self._send_mtsms(message, msns, configurations[0]['apikey'])] * len(configurations)
+
+    def _send_mtsms(self, message, msns, apikey):
         payload: dict[str, Any] = {
-            "recipients": [{"msisdn": int(msn)}]
+            "recipients": [{"msisdn": int(msn)} for msn in msns]
         }
 
         if isinstance(message, str):
@@ -35,11 +48,11 @@ class ProviderGatewayAPI(BaseSMSProvider):
             payload['payload'] = base64.b64encode(message).decode()
             payload['encoding'] = "BINARY"
 
-        request = requests.post('https://gatewayapi.com/rest/mtsms',
-                timeout=10, json=payload, headers={
+        request = self.post('https://gatewayapi.com/rest/mtsms',
+                json=payload, headers={
                 "User-Agent": f"OpenCarWings/{VERSION}",
                 "Content-Type": "application/json",
-                "Authorization": f"Token {configuration['apikey']}"
+                "Authorization": f"Token {apikey}"
             }
         )
 
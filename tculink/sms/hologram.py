@@ -1,5 +1,3 @@
-import requests
-
 from tculink import VERSION
 from tculink.sms import BaseSMSProvider, SMSType
 from django.utils.translation import gettext_lazy as _
@@ -13,17 +11,41 @@ class ProviderHologram(BaseSMSProvider):
     HELP_TEXT = _("API credentials are available in Hologram dashboard Settings.")
     SUPPORTED_TYPES = [SMSType.TEXT]
 
+    # Devices of one message request
+    MAX_BATCH_SIZE = 100
+
+    def batch_key(self, message, configuration):
+        if "apikey" not in configuration or "device_id" not in configuration:
+            return None
+        return configuration['apikey'], message
+
     def send(self, message, configuration):
         if "apikey" not in configuration or "device_id" not in configuration:
             raise Exception("Configuration is incomplete")
 
 
-        request = requests.post('https://dashboard.hologram.io/api/1/sms/incoming',
-                auth=('apikey', configuration['apikey']), timeout=10,
+        request = self.post('https://dashboard.hologram.io/api/1/sms/incoming',
+                auth=('apikey', configuration['apikey']),
                 json={
                     'deviceid': configuration['device_id'],
                     'body': message
                 }, headers={'User-Agent': f"OpenCarWings/{VERSION}", "Content-Type": "application/json"}
         )
 
-        return request.status_code == 200
\ No newline at end of file
+        return request.status_code == 200
+
+    def send_many(self, message, configurations):
+        """
+        Hologram only reports whether the whole request was accepted, not a result per device, so
+        the result of every device is that of the request.
+        """
+        request = self.post('https://dashboard.hologram.io/api/1/sms/incoming',
+                auth=('apikey', configurations[0]['apikey']),
+                json={
+                    'deviceids': [configuration['device_id'] for configuration in configurations],
+                    'body': message
+                }, headers={'User-Agent': f"OpenCarWings/{VERSION}", "Content-Type": "application/json"}
+        )
+
+        sent = request.status_code == 200 and request.json().get('success', True) is not False
+        return [sent] * len(configurations)
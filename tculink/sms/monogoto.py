@@ -1,4 +1,3 @@
-import requests
 from datetime import datetime, timedelta
 
 from tculink import VERSION
@@ -15,15 +14,17 @@ class ProviderMonogoto(BaseSMSProvider):
     HELP_TEXT = _("Credentials are available in Monogoto dashboard. Thing ID can be found in the URL when viewing your SIM. It has this structure: ThingId_ICCID_9999999999999999999")
     SUPPORTED_TYPES = [SMSType.TEXT]
 
-    def __init__(self):
-        self.token = None
-        self.token_expiry = None
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # The instance is shared by all cars, tokens are kept per account
+        self.tokens = {}
 
     def _get_token(self, username, password):
         """Authenticate and get token if needed"""
         now = datetime.now()
-        if self.token and self.token_expiry and now < self.token_expiry:
-            return self.token
+        token, token_expiry = self.tokens.get(username, (None, None))
+        if token and token_expiry and now < token_expiry:
+            return token
 
         auth_url = 'https://console.monogoto.io/Auth'
         auth_data = {
@@ -35,13 +36,13 @@ class ProviderMonogoto(BaseSMSProvider):
             'User-Agent': f"OpenCarWings/{VERSION}"
         }
 
-        response = requests.post(auth_url, json=auth_data, headers=headers, timeout=10)
+        response = self.post(auth_url, json=auth_data, headers=headers)
         if response.status_code == 200:
             data = response.json()
-            self.token = data.get('token')
+            token = data.get('token')
             # Token lasts 4 hours
-            self.token_expiry = now + timedelta(hours=4)
-            return self.token
+            self.tokens[username] = (token, now + timedelta(hours=4))
+            return token
         else:
             raise Exception(f"Authentication failed: {response.status_code} - {response.text}")
 
@@ -69,13 +70,13 @@ class ProviderMonogoto(BaseSMSProvider):
             'User-Agent': f"OpenCarWings/{VERSION}"
         }
 
-        response = requests.post(sms_url, json=sms_data, headers=headers, timeout=10)
+        response = self.post(sms_url, json=sms_data, headers=headers)
 
         # If token is expired (401), try to refresh it and retry once
         if response.status_code == 401:
-            self.token = None  # Force token refresh
+            self.tokens.pop(username, None)  # Force token refresh
             token = self._get_token(username, password)
             headers['Authorization'] = f'Bearer {token}'
-            response = requests.post(sms_url, json=sms_data, headers=headers, timeout=10)
+            response = self.post(sms_url, json=sms_data, headers=headers)
 
         return response.status_code == 200
@@ -0,0 +1,190 @@
+"""
+Durable outbox of wake-up SMS
+
+With SMS_OUTBOX enabled, the SMS of a command is stored in the database and the command is
+acknowledged right away. `manage.py smsworker` sends due messages with the rate limits and
+batching of the dispatcher, and retries failed ones with exponential backoff until the command
+completes, times out or SMS_OUTBOX_MAX_ATTEMPTS is reached. Failing the last attempt fails the
+command.
+"""
+import datetime
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from db.models import Car, SMSOutboxMessage, AlertHistory, CommandTimerSetting
+from db.signals import broadcast_car_updates_on_commit
+from tculink.coordinators import get_coordinator
+from tculink.sms.dispatch import DispatchReport, DISPATCHED, THROTTLED, FAILED, dispatch_commands
+from tculink.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# SMS_OUTBOX_STATUS
+STATUS_PENDING = 0
+STATUS_SENT = 1
+STATUS_FAILED = 2
+STATUS_CANCELLED = 3
+
+# Claimed messages are left to other workers for this long, in case this one dies while sending
+CLAIM_LEASE = datetime.timedelta(minutes=2)
+
+outbox_messages = metrics.Counter("opencarwings_sms_outbox_total", "Outbox SMS send attempts by provider and result",
+                                  ("provider", "result"))
+outbox_latency = metrics.Histogram("opencarwings_sms_outbox_latency_seconds",
+                                   "Time from queueing an SMS to the provider accepting it", ("provider",),
+                                   buckets=(0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+
+
+def outbox_enabled():
+    return getattr(settings, "SMS_OUTBOX", False)
+
+
+def retry_delay(attempts):
+    """Seconds before the next attempt after `attempts` failed ones, with jitter"""
+    delay = min(getattr(settings, "SMS_OUTBOX_RETRY_DELAY", 5) * 2 ** (attempts - 1),
+                getattr(settings, "SMS_OUTBOX_MAX_DELAY", 60))
+    return random.uniform(delay / 2, delay)
+
+
+def _queue(cars_prepared):
+    """Apply prepared commands to their cars and queue their messages, superseding queued ones"""
+    with transaction.atomic():
+        SMSOutboxMessage.objects.filter(car__in=[car for car, _ in cars_prepared], status=STATUS_PENDING) \
+            .update(status=STATUS_CANCELLED)
+        messages = []
+        for car, prepared in cars_prepared:
+            prepared.apply(car)
+            message = SMSOutboxMessage(car=car, provider=(car.sms_config or {}).get("provider", ""),
+                                       command_id=prepared.command_id)
+            message.set_message(prepared.message)
+            messages.append(message)
+        SMSOutboxMessage.objects.bulk_create(messages)
+
+
+def enqueue_command(car, prepared):
+    _queue([(car, prepared)])
+    return car
+
+
+def enqueue_commands(requests):
+    """Queue (car, command, payload) requests, returns a DispatchReport of queued and failed ones"""
+    outcomes = []
+    cars_prepared = []
+    for car, command, payload in requests:
+        try:
+            cars_prepared.append((car, get_coordinator(car.tcu_type).prepare_command(command, payload, car)))
+            outcomes.append(DISPATCHED)
+        except Exception as e:
+            logger.warning("Car %s: Could not prepare command %s: %s", car.vin, command, e)
+            outcomes.append(FAILED)
+    if cars_prepared:
+        _queue(cars_prepared)
+    return DispatchReport(outcomes)
+
+
+def submit_commands(requests):
+    """Queue the wake-up SMS of (car, command, payload) requests, or send them right away"""
+    if outbox_enabled():
+        return enqueue_commands(requests)
+    return dispatch_commands(requests)
+
+
+class OutboxWorker:
+    def __init__(self, dispatcher, batch_size=100):
+        self.dispatcher = dispatcher
+        self.batch_size = batch_size
+
+    def claim(self, now):
+        """Due messages with their cars, leased to this worker"""
+        with transaction.atomic():
+            messages = list(SMSOutboxMessage.objects
+                            .filter(status=STATUS_PENDING, next_attempt_at__lte=now)
+                            .order_by("next_attempt_at")
+                            .select_related("car")
+                            .select_for_update(skip_locked=True, of=("self",))[:self.batch_size])
+            SMSOutboxMessage.objects.filter(pk__in=[message.pk for message in messages]) \
+                .update(next_attempt_at=now + CLAIM_LEASE)
+        return messages
+
+    def process(self):
+        """Send due messages, returns how many were processed"""
+        now = timezone.now()
+        messages = self.claim(now)
+        sending = []
+        for message in messages:
+            car = message.car
+            if car.command_requested and car.command_id == message.command_id:
+                sending.append(message)
+            else:
+                # Timed out or replaced by another command meanwhile
+                message.status = STATUS_CANCELLED
+                message.save(update_fields=["status"])
+                outbox_messages.inc(provider=message.provider, result="cancelled")
+
+        deadline = time.monotonic() + getattr(settings, "SMS_DISPATCH_MAX_WAIT", 30)
+        results = self.dispatcher.send_messages(
+            [((message.car.sms_config or {}).get("provider", ""), message.get_message(), message.car.sms_config,
+              message.car.tcu_model) for message in sending], deadline)
+        for message, result in zip(sending, results):
+            self.record(message, result)
+        return len(messages)
+
+    def record(self, message, result):
+        now = timezone.now()
+        if result == THROTTLED:
+            message.next_attempt_at = now
+            message.save(update_fields=["next_attempt_at"])
+            outbox_messages.inc(provider=message.provider, result="throttled")
+            return
+
+        message.attempts += 1
+        if result is True:
+            message.status = STATUS_SENT
+            message.sent_at = now
+            outbox_latency.observe((now - message.created_at).total_seconds(), provider=message.provider)
+            outbox_messages.inc(provider=message.provider, result="sent")
+        else:
+            message.last_error = str(result or "SMS provider did not accept the message")
+            if message.attempts >= getattr(settings, "SMS_OUTBOX_MAX_ATTEMPTS", 6):
+                message.status = STATUS_FAILED
+                outbox_messages.inc(provider=message.provider, result="failed")
+                logger.warning("Car %s: Giving up SMS of command %s after %d attempts: %s", message.car.vin,
+                               message.command_id, message.attempts, message.last_error)
+            else:
+                message.next_attempt_at = now + datetime.timedelta(seconds=retry_delay(message.attempts))
+                outbox_messages.inc(provider=message.provider, result="retry")
+                logger.info("Car %s: SMS attempt %d failed, retrying at %s: %s", message.car.vin,
+                            message.attempts, message.next_attempt_at, message.last_error)
+
+        with transaction.atomic():
+            message.save(update_fields=["status", "attempts", "sent_at", "next_attempt_at", "last_error"])
+            if message.status == STATUS_FAILED:
+                self.fail_command(message)
+
+    @staticmethod
+    def fail_command(message):
+        car = message.car
+        # Unless the car completed or another command replaced it meanwhile
+        if not Car.objects.filter(pk=car.pk, command_id=message.command_id, command_requested=True) \
+                .update(command_requested=False, command_result=1):
+            return
+        payload = car.command_payload
+        if isinstance(payload, dict) and payload.get("timer"):
+            CommandTimerSetting.objects.filter(pk=payload["timer"]).update(last_command_result=1)
+        AlertHistory.objects.create(type=99, command_id=message.command_id, car=car,
+                                    additional_data=f"Could not send wake-up SMS: {message.last_error}")
+        metrics.commands.inc(result="sms_failed")
+        broadcast_car_updates_on_commit([(car.owner_id, car.pk, [])])
+
+    @staticmethod
+    def purge(now):
+        """Delete finished messages older than SMS_OUTBOX_RETENTION days"""
+        return SMSOutboxMessage.objects.filter(
+            status__in=(STATUS_SENT, STATUS_FAILED, STATUS_CANCELLED),
+            created_at__lt=now - datetime.timedelta(days=getattr(settings, "SMS_OUTBOX_RETENTION", 7))
+        ).delete()[0]
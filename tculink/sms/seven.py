@@ -1,8 +1,6 @@
 import re
 from typing import Any
 
-import requests
-
 from tculink import VERSION
 from tculink.sms import BaseSMSProvider, SMSType
 from django.utils.translation import gettext_lazy as _
@@ -15,6 +13,14 @@ class ProviderSevenIO(BaseSMSProvider):
     HELP_TEXT = _("API credentials are available in dashboard.seven.io Developer section. Remember to add 'OCW' as Sender ID under account settings!")
     SUPPORTED_TYPES = [SMSType.TEXT, SMSType.BINARY]
 
+    # Recipients of one message request
+    MAX_BATCH_SIZE = 500
+
+    def batch_key(self, message, configuration):
+        if "apikey" not in configuration or len(re.sub('\D', '', configuration.get('msn', ''))) < 1:
+            return None
+        return configuration['apikey'], message
+
     def send(self, message, configuration):
         if "apikey" not in configuration or "msn" not in configuration:
             raise Exception("Configuration is incomplete")
@@ -24,10 +30,29 @@ class ProviderSevenIO(BaseSMSProvider):
         if len(msn) < 1:
             raise Exception("Phone number is not valid")
 
+        request = self._send_sms(message, [msn], configuration['apikey'])
+        return request.status_code == 200 and request.json().get('status', '') == '100'
+
+    def send_many(self, message, configurations):
+        msns = [re.sub('\D', '', configuration['msn']) for configuration in configurations]
+        request = self._send_sms(message, msns, configurations[0]['apikey'])
+        if request.status_code != 200:
+            return [False] * len(msns)
+        response = request.json()
+        if response.get('status', '') == '100':
+            return [True] * len(msns)
+
+        # Sending failed for some recipients, each has its own result in messages
+        sent = {}
+        for result in response.get('messages') or []:
+            sent[re.sub('\D', '', str(result.get('recipient', '')))] = bool(result.get('success'))
+        return [sent.get(msn, False) for msn in msns]
+
+    def _send_sms(self, message, msns, apikey):
         payload: dict[str, Any] = {
             # without sender, sms doesn't get delivered
             "from": "OCW",
-            "to": msn,
+            "to": ",".join(msns),
         }
 
         if isinstance(message, str):
@@ -36,12 +61,10 @@ class ProviderSevenIO(BaseSMSProvider):
             payload['is_binary'] = 1
             payload['text'] = message.hex()
 
-        request = requests.post('https://gateway.seven.io/api/sms',
-                timeout=10, data=payload, headers={
+        return self.post('https://gateway.seven.io/api/sms',
+                data=payload, headers={
                 "User-Agent": f"OpenCarWings/{VERSION}",
                 "Accept": "application/json",
-                "X-Api-Key": configuration['apikey']
+                "X-Api-Key": apikey
             }
         )
-
-        return request.status_code == 200 and request.json().get('status', '') == '100'
\ No newline at end of file
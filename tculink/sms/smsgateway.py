@@ -1,8 +1,66 @@
+"""
+SMS gateway app relay
+
+Messages are relayed to the gateway app through the `sms_<device_id>` channel group, and the
+consumer in api.consumers sends them to the app in encrypted parcels. Each message has an id.
+Apps connecting with `batch=1` receive the messages to one device in one 'batch' parcel, and may
+confirm delivery with an `{"type": "ack", "acks": [{"id": ..., "status": "sent" | "failed",
+"error": ...}]}` parcel, encrypted like the parcels it receives.
+
+Consumers of earlier versions only handle the per-message relay_sms and relay_pdu events. During a
+rolling upgrade, keep SMS_GATEWAY_RELAY_PARCELS off until every web process runs this version, then
+turn it on.
+"""
+import asyncio
+from secrets import token_hex
+
 from tculink.gdc_proto.ficosa import pdu
 from tculink.sms import BaseSMSProvider, SMSType
+from tculink.utils import metrics
 from django.utils.translation import gettext_lazy as _
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
+from django.conf import settings
+
+gateway_acks = metrics.Counter("opencarwings_sms_gateway_acks_total",
+                               "Delivery acknowledgements of SMS gateway apps by status", ("status",))
+gateway_ack_latency = metrics.Histogram("opencarwings_sms_gateway_ack_latency_seconds",
+                                        "Time from relaying an SMS to the gateway app acknowledging it", (),
+                                        buckets=(0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+
+
+def gateway_group(device_id):
+    return f'sms_{device_id}'
+
+
+def relay_events(parcels):
+    """Channel layer events relaying parcels to one device"""
+    if getattr(settings, "SMS_GATEWAY_RELAY_PARCELS", True):
+        return [{'type': 'relay_parcels', 'parcels': parcels}]
+    # Events of earlier versions, one per message
+    return [{**{key: value for key, value in parcel.items() if key != 'id'}, 'type': f"relay_{parcel['type']}"}
+            for parcel in parcels]
+
+
+def gateway_parcel(message, phone):
+    """Parcel of one message as the gateway app receives it"""
+    if isinstance(message, str):
+        return {
+            'type': 'sms',
+            'id': token_hex(8),
+            'sms': message,
+            'phone': phone,
+        }
+    pdu_data, pdu_len = pdu.data_pdu(phone, message)
+    return {
+        'type': 'pdu',
+        'id': token_hex(8),
+        'data': message.hex(),
+        'pdu': pdu_data.hex(),
+        'length': pdu_len,
+        'phone': phone,
+    }
+
 
 class ProviderSMSGateway(BaseSMSProvider):
     CONFIGURATION_FIELDS = [
@@ -15,36 +73,56 @@ class ProviderSMSGateway(BaseSMSProvider):
     LINK = "https://github.com/developerfromjokela/opencarwings-sms"
     SUPPORTED_TYPES = [SMSType.TEXT, SMSType.BINARY]
 
+    # Messages to one device relayed in one batch
+    MAX_BATCH_SIZE = 100
+
+    def batch_key(self, message, configuration):
+        if "device_id" not in configuration or "phone" not in configuration:
+            return None
+        return configuration['device_id']
+
     def send(self, message, configuration):
         if "device_id" not in configuration or "phone" not in configuration:
             raise Exception("Configuration is incomplete")
 
-        pdu_data = None
-        pdu_len = 0
-        if isinstance(message, str):
-            msg_type = SMSType.TEXT
-        else:
-            msg_type = SMSType.BINARY
-            pdu_data, pdu_len = pdu.data_pdu(configuration["phone"], message)
-            pdu_data = pdu_data.hex()
-            message = message.hex()
+        parcel = gateway_parcel(message, configuration['phone'])
+        error = async_to_sync(self._relay)([(configuration["device_id"], [(0, parcel)])])[0]
+        if error is not None:
+            raise error
+        return True
+
+    def send_batch(self, messages):
+        """Relay messages grouped by gateway device, all of them within one event loop call"""
+        results = [None] * len(messages)
+        batches = {}
+        for index, (message, configuration) in enumerate(messages):
+            if "device_id" not in configuration or "phone" not in configuration:
+                results[index] = Exception("Configuration is incomplete")
+                continue
+            try:
+                parcel = gateway_parcel(message, configuration['phone'])
+            except Exception as e:
+                results[index] = e
+                continue
+            device_batches = batches.setdefault(configuration["device_id"], [[]])
+            if len(device_batches[-1]) >= self.MAX_BATCH_SIZE:
+                device_batches.append([])
+            device_batches[-1].append((index, parcel))
+
+        frames = [(device_id, batch) for device_id, device_batches in batches.items() for batch in device_batches]
+        sent = async_to_sync(self._relay)(frames)
+        for (device_id, batch), result in zip(frames, sent):
+            for index, parcel in batch:
+                results[index] = True if result is None else result
+        return results
 
+    @staticmethod
+    async def _relay(frames):
         channel_layer = get_channel_layer()
 
+        async def relay(device_id, batch):
+            for event in relay_events([parcel for index, parcel in batch]):
+                await channel_layer.group_send(gateway_group(device_id), event)
 
-        if msg_type == SMSType.TEXT:
-            payload = {
-                'type': 'relay_sms',
-                'sms': message,
-                'phone': configuration['phone'],
-            }
-        else:
-            payload = {
-                'type': 'relay_pdu',
-                'data': message,
-                'pdu': pdu_data,
-                'length': pdu_len,
-                'phone': configuration['phone'],
-            }
-        async_to_sync(channel_layer.group_send)(f'sms_{configuration["device_id"]}', payload)
-        return True
\ No newline at end of file
+        return await asyncio.gather(*(relay(device_id, batch) for device_id, batch in frames),
+                                    return_exceptions=True)
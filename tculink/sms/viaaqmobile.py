@@ -1,4 +1,3 @@
-import requests
 from django.conf import settings
 
 from tculink import VERSION
@@ -21,13 +20,13 @@ class ProviderViaaqMobileGlobal(BaseSMSProvider):
             msg_type = SMSType.BINARY.value
             message = message.hex()
 
-        request = requests.post("https://mobile.viaaq.eu/api/v1/sms", json={
+        request = self.post("https://mobile.viaaq.eu/api/v1/sms", json={
             "tcu_id": configuration['tcu_id'],
             "data": message,
             "type": "binary" if msg_type == 1 else "text"
-        }, timeout=10, headers={"User-Agent": f"OpenCarWings/{VERSION}",
-                                "Content-Type": "application/json",
-                                "X-Api-Token": apikey})
+        }, headers={"User-Agent": f"OpenCarWings/{VERSION}",
+                    "Content-Type": "application/json",
+                    "X-Api-Token": apikey})
         if request.status_code == 400:
             raise SMSError(_("Could not find mobile subscription in viaaq mobile. Are you sure it's active?"))
         if request.status_code == 403:
@@ -1,5 +1,3 @@
-import requests
-
 from tculink import VERSION
 from tculink.gdc_proto.ficosa import pdu
 from tculink.sms import BaseSMSProvider, SMSType
@@ -30,6 +28,6 @@ class ProviderWebhook(BaseSMSProvider):
             pdu_data = pdu_data.hex()
             message = message.hex()
 
-        request = requests.post(configuration['url'], json={'message': message, "type": msg_type, "pdu": pdu_data, "pdu_length": pdu_len}, timeout=10,
-                                headers={"User-Agent": f"OpenCarWings/{VERSION}", "Content-Type": "application/json"})
+        request = self.post(configuration['url'], json={'message': message, "type": msg_type, "pdu": pdu_data, "pdu_length": pdu_len},
+                            headers={"User-Agent": f"OpenCarWings/{VERSION}", "Content-Type": "application/json"})
         return request.status_code == 200
\ No newline at end of file
@@ -1,35 +1,76 @@
+import asyncio
+import collections
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import queue
+import random
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import zoneinfo
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
+from unittest import mock
 
-from django.test import TestCase
+from aioapns.common import NotificationResult
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad, unpad
+from PIL import Image
+from pyfcm.errors import FCMNotRegisteredError
+import requests
+
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from api.models import TokenMetadata
+from api.routing import websocket_urlpatterns
+from db.models import Car, User, TCUConfiguration, LocationInfo, EVInfo, AlertHistory, CommandTimerSetting, \
+    SMSOutboxMessage, next_timer_fire, vin_refresh_phase
 
 from tculink.carwings_proto.autodj.opencarwings import create_consumption_slide, create_ecorecord_slide, \
     create_ecoforest_slide, create_info_slide
+from tculink.gdc_proto.framing import GDCStreamReassembler
+from tculink.management.commands import tcuserver, tculoadtest, tcuscheduler, tcuperiodicupdate
 from tculink.gdc_proto.parser import parse_gdc_packet
+from tculink.gdc_proto.decoder import decode_gdc_packet
+from tculink.gdc_proto.samples import SAMPLE_PACKETS, SAMPLE_INIT, SAMPLE_DATA, SAMPLE_CONFIG, sample_packet
 from tculink.gdc_proto.responses import create_charge_status_response, create_charge_request_response, \
     create_ac_setting_response, create_ac_stop_response, create_config_read
+from tculink.coordinators import get_coordinator, get_supported_commands
+from tculink.coordinators.stub import send_command_using_provider
+from tculink.sms import dispatch as sms_dispatch, outbox as sms_outbox, smsgateway, get_provider, send_using_provider, send_batch_using_provider
+from tculink.utils import tcu_identity, tcu_logging, metrics, capture, benchmark, notification_queue, notifications, \
+    leader, upstream
+from tculink import views as tculink_views
+from tculink.httpgateway import ficosa as ficosa_gateway
+from tculink.carwings_proto.applications import gls
+from tculink.carwings_proto.applications.cp import handle_cp
 
 from django.utils import timezone, formats
 
+
 class DataPacketParse(TestCase):
 
     def test_data_parse(self):
         """Animals that can speak are correctly identified"""
-        packets = [
-            "01 02 00 99 20 5E B1 70 51 4A 4E 31 46 41 41 5A 45 30 55 30 30 30 39 33 36 36 4C 32 30 31 33 30 30 30 32 36 30 37 38 4F 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 4C 31 30 30 32 30 30 30 30 35 30 33 35 54 38 39 33 35 38 30 36 32 33 30 39 31 34 35 37 38 34 39 35 00 4A 30 36 2E 32 37 00 00 00 00 00 27 00 04 8C A0 FB 12 09 C0 3C 21 0D 9F 18 38 13 28 20 22 50 64 65 76 66 72 6F 6D 6A 6F 6B 6C 61 00 00 00 00 50 35 34 41 37 34 44 44 43 00 00 00 00 00 00 00 00",
-            "03 02 00 AD 20 5E B1 70 51 4A 4E 31 46 41 41 5A 45 30 55 30 30 30 39 33 36 36 4C 32 30 31 33 30 30 30 32 36 30 37 38 4F 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 4C 31 30 30 32 30 30 30 30 35 30 33 35 54 38 39 33 35 38 30 36 32 33 30 39 31 34 35 37 38 34 39 35 00 4A 30 36 2E 32 37 00 00 00 00 00 29 00 04 8C A1 31 24 09 C0 3C 21 0D 9F 18 38 13 28 20 22 50 64 65 76 66 72 6F 6D 6A 6F 6B 6C 61 00 00 00 00 50 35 34 41 37 34 44 44 43 00 00 00 00 00 00 00 00 04 00 2A 00 34 02 10 00 0B 0C 1A 45 A0 32 1F A3 4E E0 29 D2",
-            "03 02 00 AD 20 5E B1 70 51 4A 4E 31 46 41 41 5A 45 30 55 30 30 30 39 33 36 36 4C 32 30 31 33 30 30 30 32 36 30 37 38 4F 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 4C 31 30 30 32 30 30 30 30 35 30 33 35 54 38 39 33 35 38 30 36 32 33 30 39 31 34 35 37 38 34 39 35 00 4A 30 36 2E 32 37 00 00 00 00 00 28 00 04 8C F2 DB 97 09 C0 3C 21 0D 9A 18 38 13 34 20 22 50 64 65 76 66 72 6F 6D 6A 6F 6B 6C 61 00 00 00 00 50 35 34 41 37 34 44 44 43 00 00 00 00 00 00 00 00 04 00 2A 00 37 02 00 00 0B 0C 12 C6 90 32 1D 23 49 20 29 92",
-            "03 02 00 AD 20 5E B1 70 51 4A 4E 31 46 41 41 5A 45 30 55 30 30 30 39 33 36 36 4C 32 30 31 33 30 30 30 32 36 30 37 38 4F 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 4C 31 30 30 32 30 30 30 30 35 30 33 35 54 38 39 33 35 38 30 36 32 33 30 39 31 34 35 37 38 34 39 35 00 4A 30 36 2E 32 37 00 00 00 00 00 2C 00 04 8C F2 DB 97 09 C0 3C 21 0D 9A 18 38 13 34 20 22 50 64 65 76 66 72 6F 6D 6A 6F 6B 6C 61 00 00 00 00 50 35 34 41 37 34 44 44 43 00 00 00 00 00 00 00 00 04 00 2A 00 36 02 00 40 0B 0E 12 C6 90 32 1C E3 49 00 29 92",
-            "03 02 00 AD 20 5E B1 70 51 4A 4E 31 46 41 41 5A 45 30 55 30 30 30 39 33 36 36 4C 32 30 31 33 30 30 30 32 36 30 37 38 4F 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 4C 31 30 30 32 30 30 30 30 35 30 33 35 54 38 39 33 35 38 30 36 32 33 30 39 31 34 35 37 38 34 39 35 00 4A 30 36 2E 32 37 00 00 00 00 00 2C 00 04 8C F2 DB 97 09 C0 3C 21 0D 9A 18 38 13 34 20 22 50 64 65 76 66 72 6F 6D 6A 6F 6B 6C 61 00 00 00 00 50 35 34 41 37 34 44 44 43 00 00 00 00 00 00 00 00 04 00 2A 00 36 02 00 20 0B CC 12 C6 90 32 1C E3 47 C0 29 92",
-            "03 02 00 AD 20 5E B1 70 51 4A 4E 31 46 41 41 5A 45 30 55 30 30 30 39 33 36 36 4C 32 30 31 33 30 30 30 32 36 30 37 38 4F 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 4C 31 30 30 32 30 30 30 30 35 30 33 35 54 38 39 33 35 38 30 36 32 33 30 39 31 34 35 37 38 34 39 35 00 4A 30 36 2E 32 37 00 00 00 00 00 2A 00 04 8C A6 1D 0A 09 C0 3C 21 0D 9F 18 38 13 28 20 22 50 64 65 76 66 72 6F 6D 6A 6F 6B 6C 61 00 00 00 00 50 35 34 41 37 34 44 44 43 00 00 00 00 00 00 00 00 04 00 2C 00 37 02 04 00 0B CD 0F 02 D0 32 28 A3 64 00 2A D2",
-            "05 02 02 55 20 5E B1 70 51 4A 4E 31 46 41 41 5A 45 30 55 30 30 30 39 33 36 36 4C 32 30 31 33 30 30 30 32 36 30 37 38 4F 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 4C 31 30 30 32 30 30 30 30 35 30 33 35 54 38 39 33 35 38 30 36 32 33 30 39 31 34 35 37 38 34 39 35 00 4A 30 36 2E 32 37 00 00 00 00 00 2E 00 01 62 23 6B 12 60 20 2A 39 39 23 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 60 30 69 6E 74 65 72 6E 65 74 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 60 20 7A 65 72 6F 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 60 20 65 6D 69 73 73 69 6F 6E 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 60 20 61 75 74 6F 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 60 20 61 75 74 6F 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 61 00 6E 69 73 73 61 6E 2D 65 75 2D 64 63 6D 2D 62 69 7A 2E 76 69 61 61 71 2E 65 75 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 61 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 45 00 00 00 00 00 43 49 50 00",
-            "03 02 00 AD 20 5E B1 70 51 4A 4E 31 46 41 41 5A 45 30 55 30 30 30 39 33 36 36 4C 32 30 31 33 30 30 30 32 36 30 37 38 4F 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 4C 31 30 30 32 30 30 30 30 35 30 33 35 54 38 39 33 35 38 30 36 32 33 30 39 31 34 35 37 38 34 39 35 00 4A 30 36 2E 32 37 00 00 00 00 00 28 00 04 8C F5 0D EB 09 C8 3C 21 0F 48 18 39 05 1A 20 22 50 64 65 76 66 72 6F 6D 6A 6F 6B 6C 61 00 00 00 00 50 35 34 41 37 34 44 44 43 00 00 00 00 00 00 00 00 04 00 31 00 3D 02 00 00 0B 28 12 C6 90 14 1D 23 48 60 29 92",
-            "03 02 00 AD 20 5E B1 70 51 4A 4E 31 46 41 41 5A 45 30 55 30 30 30 39 33 36 36 4C 32 30 31 33 30 30 30 32 36 30 37 38 4F 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 4C 31 30 30 32 30 30 30 30 35 30 33 35 54 38 39 33 35 38 30 36 32 33 30 39 31 34 35 37 38 34 39 35 00 4A 30 36 2E 32 37 00 00 00 00 00 28 00 04 8C F5 09 F1 09 C0 3C 21 0D 98 18 38 13 35 20 22 50 64 65 76 66 72 6F 6D 6A 6F 6B 6C 61 00 00 00 00 50 35 34 41 37 34 44 44 43 00 00 00 00 00 00 00 00 04 00 2E 00 3A 02 00 00 0B 2C 0F 05 28 30 21 63 52 60 29 D2",
-            "03 02 00 AD 20 5E B1 70 51 4A 4E 31 46 41 41 5A 45 30 55 30 30 30 39 33 36 36 4C 32 30 31 33 30 30 30 32 36 30 37 38 4F 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 4C 31 30 30 32 30 30 30 30 35 30 33 35 54 38 39 33 35 38 30 36 32 33 30 39 31 34 35 37 38 34 39 35 00 4A 30 36 2E 32 37 00 00 00 00 00 28 00 04 8C F5 09 F1 09 C0 3C 21 0D 98 18 38 13 35 20 22 50 64 65 76 66 72 6F 6D 6A 6F 6B 6C 61 00 00 00 00 50 35 34 41 37 34 44 44 43 00 00 00 00 00 00 00 00 04 00 2E 00 3A 02 00 00 0B 2C 0F 05 28 30 21 63 52 60 29 D2",
-            "03 02 00 AD 20 5E B1 70 51 4A 4E 31 46 41 41 5A 45 30 55 30 30 30 39 33 36 36 4C 32 30 31 33 30 30 30 32 36 30 37 38 4F 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 4C 31 30 30 32 30 30 30 30 35 30 33 35 54 38 39 33 35 38 30 36 32 33 30 39 31 34 35 37 38 34 39 35 00 4A 30 36 2E 32 37 00 00 00 00 00 28 00 04 8C F5 62 EF 09 C0 3C 21 0D 98 18 38 13 27 20 22 50 64 65 76 66 72 6F 6D 6A 6F 6B 6C 61 00 00 00 00 50 35 34 41 37 34 44 44 43 00 00 00 00 00 00 00 00 04 00 31 00 3D 02 00 00 0B 0C 0F 03 48 32 27 E3 61 A0 2A 52",
-            "03 02 00 AD 20 5E B1 70 51 4A 4E 31 46 41 41 5A 45 30 55 30 30 30 39 33 36 36 4C 32 30 31 33 30 30 30 32 36 30 37 38 4F 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 4C 31 30 30 32 30 30 30 30 35 30 33 35 54 38 39 33 35 38 30 36 32 33 30 39 31 34 35 37 38 34 39 35 00 4A 30 36 2E 32 37 00 00 00 00 00 28 00 04 8C F7 14 A5 09 C0 3C 21 0D 98 18 38 13 27 20 22 50 64 65 76 66 72 6F 6D 6A 6F 6B 6C 61 00 00 00 00 50 35 34 41 37 34 44 44 43 00 00 00 00 00 00 00 00 04 00 31 00 3D 02 00 00 0B 2C 0F 03 48 32 27 E3 61 A0 2A 52"
-        ]
-
-        for idx, packet in enumerate(packets):
+        for idx, packet in enumerate(SAMPLE_PACKETS):
             hex_string = packet.replace(" ", "")
             print(f"> Packet {idx}: length {len(hex_string)} bytes")
             byte_data = bytes.fromhex(hex_string)
@@ -49,6 +90,1553 @@ class DataPacketParse(TestCase):
         print("Read config", create_config_read().hex(' ').upper())
 
 
+class GDCDecoderTests(TestCase):
+
+    def setUp(self):
+        self.packets = [bytes.fromhex(packet.replace(" ", "")) for packet in SAMPLE_PACKETS]
+
+    def test_golden_samples(self):
+        """Decoder returns exactly what the parser returns"""
+        for idx, packet in enumerate(self.packets):
+            # ZE0 cars send 0x02 as second byte, their data has no AZE0 fields
+            ze0_packet = packet[:1] + b"\x02" + packet[2:]
+            for variant in (packet, ze0_packet, bytearray(packet), memoryview(packet)):
+                self.assertEqual(decode_gdc_packet(variant).as_dict(), parse_gdc_packet(bytes(variant)), idx)
+
+    def test_dict_view(self):
+        decoded = decode_gdc_packet(self.packets[SAMPLE_DATA])
+        parsed = parse_gdc_packet(self.packets[SAMPLE_DATA])
+        self.assertEqual(decoded["tcu"]["vin"], parsed["tcu"]["vin"])
+        self.assertEqual(decoded["auth"]["pass"], parsed["auth"]["pass"])
+        self.assertEqual(decoded["body"]["6kw_chg"], parsed["body"]["6kw_chg"])
+        self.assertEqual(decoded.get("gps").get("latitude"), parsed["gps"]["latitude"])
+        self.assertIsNone(decoded["body"].get("unknown"))
+        self.assertEqual(list(decoded["body"]), list(parsed["body"]))
+        with self.assertRaises(KeyError):
+            decoded["unknown"]
+        self.assertFalse(hasattr(decoded["tcu"], "__dict__"))
+
+    def test_invalid_packets(self):
+        packet = self.packets[SAMPLE_DATA]
+        for invalid in (packet[:4], packet[:99], packet[:120], b"\x07" + packet[1:], packet * 7):
+            with self.assertRaises(Exception):
+                parse_gdc_packet(invalid)
+            with self.assertRaises(ValueError):
+                decode_gdc_packet(invalid)
+
+    def test_decode_benchmark(self):
+        """Benchmark: decoder against parser over all sample packets"""
+        rounds = 2000
+        timings = {}
+        for name, decode in (("parse_gdc_packet", parse_gdc_packet), ("decode_gdc_packet", decode_gdc_packet)):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for packet in self.packets:
+                    decode(packet)
+            timings[name] = (time.perf_counter() - start) / (rounds * len(self.packets))
+        for name, elapsed in timings.items():
+            print(f"{name}: {elapsed * 1000000:.2f} us per packet")
+        print(f"Decoder speedup: {timings['parse_gdc_packet'] / timings['decode_gdc_packet']:.2f}x")
+
+
+class GDCStreamReassemblyTests(TestCase):
+
+    def setUp(self):
+        self.packets = [bytes.fromhex(packet.replace(" ", "")) for packet in SAMPLE_PACKETS]
+        self.stream = b"".join(self.packets)
+
+    def test_single_packet_reads(self):
+        reassembler = GDCStreamReassembler()
+        for packet in self.packets:
+            frames = reassembler.feed(packet)
+            self.assertEqual(frames, [packet])
+            # whole-packet reads are passed through without copying
+            self.assertIs(frames[0], packet)
+        self.assertEqual(reassembler.pending, 0)
+
+    def test_pipelined_packets(self):
+        reassembler = GDCStreamReassembler()
+        self.assertEqual(reassembler.feed(self.stream), self.packets)
+        self.assertEqual(reassembler.pending, 0)
+
+    def test_random_segments(self):
+        rng = random.Random(1234)
+        for _ in range(200):
+            reassembler = GDCStreamReassembler()
+            frames = []
+            offset = 0
+            while offset < len(self.stream):
+                segment_size = rng.randint(1, 1024)
+                frames += reassembler.feed(self.stream[offset:offset + segment_size])
+                offset += segment_size
+            self.assertEqual(frames, self.packets)
+            self.assertEqual(reassembler.pending, 0)
+            for frame in frames:
+                parse_gdc_packet(frame)
+
+    def test_partial_packet(self):
+        reassembler = GDCStreamReassembler()
+        self.assertEqual(reassembler.feed(self.packets[1][:50]), [])
+        self.assertEqual(reassembler.pending, 50)
+        self.assertEqual(reassembler.flush(), self.packets[1][:50])
+        self.assertEqual(reassembler.pending, 0)
+
+    def test_invalid_data_flushed(self):
+        reassembler = GDCStreamReassembler()
+        garbage = b"\xff" * 20
+        self.assertEqual(reassembler.feed(self.packets[0] + garbage), [self.packets[0], garbage])
+        self.assertEqual(reassembler.pending, 0)
+        # zero length must not stall the stream
+        self.assertEqual(reassembler.feed(b"\x03\x02\x00\x00\x00"), [b"\x03\x02\x00\x00\x00"])
+
+
+TEST_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+TEST_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+def create_test_car(vin="JN1FAAZE0U0009366", username="devfromjokla"):
+    """Car matching the TCU of SAMPLE_PACKETS"""
+    owner = User.objects.create_user(username=username, password="testpass", tcu_pass_hash="54A74DDC")
+    return Car.objects.create(
+        vin=vin, sms_config={"provider": "manual"}, owner=owner,
+        tcu_model="201300026078", tcu_serial="100200005035", iccid="8935806230914578495",
+        tcu_configuration=TCUConfiguration.objects.create(),
+        location=LocationInfo.objects.create(),
+        ev_info=EVInfo.objects.create(),
+    )
+
+
+@override_settings(CACHES=TEST_CACHES, CHANNEL_LAYERS=TEST_CHANNEL_LAYERS)
+class TCUIdentityCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        tcu_identity.local_cache.clear()
+
+    def test_identity_lookup(self):
+        car = create_test_car()
+        identity = tcu_identity.get_tcu_identity(car.vin)
+        self.assertEqual(identity["car_id"], car.pk)
+        self.assertEqual(identity["tcu_serial"], "100200005035")
+        self.assertEqual(identity["owner_username"], "devfromjokla")
+        self.assertEqual(identity["owner_tcu_pass_hash"], "54A74DDC")
+        with self.assertNumQueries(0):
+            tcu_identity.get_tcu_identity(car.vin)
+
+    def test_unknown_vin_cached(self):
+        self.assertIsNone(tcu_identity.get_tcu_identity("JN1FAAZE0U0000000"))
+        with self.assertNumQueries(0):
+            self.assertIsNone(tcu_identity.get_tcu_identity("JN1FAAZE0U0000000"))
+        # registering the car clears the negative entry
+        create_test_car(vin="JN1FAAZE0U0000000")
+        self.assertIsNotNone(tcu_identity.get_tcu_identity("JN1FAAZE0U0000000"))
+
+    def test_invalidation(self):
+        car = create_test_car()
+        tcu_identity.get_tcu_identity(car.vin)
+
+        # unrelated changes keep the entry
+        car.last_connection = timezone.now()
+        car.save()
+        with self.assertNumQueries(0):
+            tcu_identity.get_tcu_identity(car.vin)
+
+        car.iccid = "8935806230914578496"
+        car.save()
+        self.assertEqual(tcu_identity.get_tcu_identity(car.vin)["iccid"], "8935806230914578496")
+
+        car.owner.tcu_pass_hash = "NEWHASH"
+        car.owner.save()
+        self.assertEqual(tcu_identity.get_tcu_identity(car.vin)["owner_tcu_pass_hash"], "NEWHASH")
+
+        # both the previous and the new VIN are invalidated, also for a car loaded again
+        old_vin = car.vin
+        self.assertIsNone(tcu_identity.get_tcu_identity("JN1FAAZE0U0000001"))
+        car = Car.objects.get(pk=car.pk)
+        car.vin = "JN1FAAZE0U0000001"
+        car.save()
+        self.assertIsNone(tcu_identity.get_tcu_identity(old_vin))
+        self.assertEqual(tcu_identity.get_tcu_identity(car.vin)["car_id"], car.pk)
+
+        tcu_identity.get_tcu_identity(old_vin)
+        car.vin = old_vin
+        car.save(update_fields=["vin"])
+        self.assertEqual(tcu_identity.get_tcu_identity(old_vin)["car_id"], car.pk)
+        self.assertIsNone(tcu_identity.get_tcu_identity("JN1FAAZE0U0000001"))
+
+        vin = car.vin
+        car.delete()
+        self.assertIsNone(tcu_identity.get_tcu_identity(vin))
+
+    def test_ficosa_authentication(self):
+        car = create_test_car()
+        tcu_identity.get_tcu_identity(car.vin)
+        tcu_identity.get_tcu_identity("JN1FAAZE0U0000000")
+
+        # rejected from the cache, the car is only loaded once the TCU matches
+        with self.assertNumQueries(0):
+            self.assertIsNone(ficosa_gateway.authenticate_car({"vin": "JN1FAAZE0U0000000", "dcm": car.tcu_model}, 1))
+            self.assertIsNone(ficosa_gateway.authenticate_car({"vin": car.vin, "dcm": "OTHERDCM"}, 1))
+        with self.assertNumQueries(1):
+            self.assertEqual(ficosa_gateway.authenticate_car({"vin": car.vin, "dcm": car.tcu_model}, 1), car)
+
+
+@override_settings(CACHES=TEST_CACHES, CHANNEL_LAYERS=TEST_CHANNEL_LAYERS)
+class PacketPersistenceTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        tcu_identity.local_cache.clear()
+        self.car = create_test_car()
+        self.command = tcuserver.Command()
+
+    def test_data_packet_unit_of_work(self):
+        parsed_data = parse_gdc_packet(bytes.fromhex(SAMPLE_PACKETS[1].replace(" ", "")))
+        result = self.command.process_packet(parsed_data)
+        self.assertIsNone(result.error)
+        self.assertEqual(len(result.notifications), 1)
+
+        self.car.refresh_from_db()
+        self.assertEqual(self.car.command_result, 0)
+        self.assertEqual(self.car.tcu_ver, "06.27")
+        self.assertEqual(AlertHistory.objects.filter(car=self.car, type=3).count(), 1)
+
+    def test_decoded_packet(self):
+        result = self.command.process_packet(decode_gdc_packet(bytes.fromhex(SAMPLE_PACKETS[1].replace(" ", ""))))
+        self.assertIsNone(result.error)
+        self.car.refresh_from_db()
+        self.assertEqual(self.car.tcu_ver, "06.27")
+
+    def test_unknown_car(self):
+        parsed_data = parse_gdc_packet(bytes.fromhex(SAMPLE_PACKETS[1].replace(" ", "")))
+        parsed_data["tcu"]["vin"] = "JN1FAAZE0U0000000"
+        result = self.command.process_packet(parsed_data)
+        self.assertEqual(result.error, "No car found")
+        self.assertEqual(result.responses, [create_charge_status_response(False)])
+
+    def test_sessions_per_vin(self):
+        self.command.vin_sessions = collections.Counter()
+        sessions = [tcuserver.ClientSession(("127.0.0.1", port)) for port in range(3)]
+        self.assertTrue(self.command.claim_vin(sessions[0], self.car.vin))
+        self.assertTrue(self.command.claim_vin(sessions[1], self.car.vin))
+        self.assertFalse(self.command.claim_vin(sessions[2], self.car.vin))
+        # claiming again from the same connection does not count twice
+        self.assertTrue(self.command.claim_vin(sessions[0], self.car.vin))
+        self.command.release_vin(sessions[0])
+        self.assertTrue(self.command.claim_vin(sessions[2], self.car.vin))
+        self.command.release_vin(sessions[1])
+        self.command.release_vin(sessions[2])
+        self.assertEqual(self.command.vin_sessions, collections.Counter())
+
+    def replay_packets(self, packets):
+        """Statements of each packet and the mean time per packet in ms"""
+        statements = []
+        start = time.perf_counter()
+        for parsed_data in packets:
+            with CaptureQueriesContext(connection) as queries:
+                self.command.process_packet(parsed_data)
+            statements.append([query["sql"] for query in queries])
+        return statements, (time.perf_counter() - start) / len(packets) * 1000
+
+    def test_queries_per_packet(self):
+        """Benchmark: database statements and time per sample packet, before and after"""
+        packets = [parse_gdc_packet(bytes.fromhex(packet.replace(" ", ""))) for packet in SAMPLE_PACKETS]
+        # warm up identity cache
+        self.command.process_packet(packets[0])
+
+        # the per-save path process_packet replaced: lazily loaded related rows, full saves and
+        # per-object broadcasts which look up the car again, no transaction
+        with mock.patch.object(Car.objects, "select_related", lambda *fields: Car.objects.all()), \
+                mock.patch.object(tcuserver, "save_changed_fields", lambda instance, snapshot: instance.save()), \
+                mock.patch.object(tcuserver, "coalesced_car_updates", lambda car: contextlib.nullcontext()), \
+                mock.patch.object(tcuserver.transaction, "atomic", lambda **kwargs: contextlib.nullcontext()):
+            before, before_ms = self.replay_packets(packets)
+        after, after_ms = self.replay_packets(packets)
+
+        for statements in after:
+            # car select, then one write per changed row: location, EV info or configuration, alert and car
+            self.assertTrue(statements[0].startswith("SELECT"), statements)
+            self.assertFalse(any(sql.startswith("SELECT") for sql in statements[1:]), statements)
+            self.assertLessEqual(len(statements), 5, statements)
+        before_mean = sum(map(len, before)) / len(packets)
+        after_mean = sum(map(len, after)) / len(packets)
+        self.assertLess(after_mean, before_mean / 2)
+        print(f"Packet persistence: {before_mean:.1f} -> {after_mean:.1f} statements, "
+              f"{before_ms:.2f} -> {after_ms:.2f} ms per packet")
+
+
+@override_settings(CACHES=TEST_CACHES, METRICS_FLUSH_INTERVAL=0)
+class TCUServerWorkersTests(SimpleTestCase):
+
+    def setUp(self):
+        # Workers log to their own file, not the repository's logs directory
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patcher = mock.patch.object(tcuserver, "log_file", os.path.join(directory, "tcuserver.log"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def test_restarts_crashed_worker(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+
+        command = tcuserver.Command(stdout=io.StringIO())
+        command.db_threads = 1
+        command.max_connections = 10
+        stopping = threading.Event()
+        pids = {}
+
+        def accepting():
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                return True
+            except OSError:
+                return False
+
+        def crash_worker():
+            try:
+                self.assertTrue(self.wait_for(lambda: len(getattr(command, "worker_processes", {})) == 2))
+                self.assertTrue(self.wait_for(accepting))
+                pids["crashed"] = command.worker_processes[0].pid
+                os.kill(pids["crashed"], signal.SIGKILL)
+                self.assertTrue(self.wait_for(lambda: command.worker_processes[0].pid != pids["crashed"]
+                                              and command.worker_processes[0].is_alive()))
+                pids["restarted"] = command.worker_processes[0].pid
+            finally:
+                stopping.set()
+
+        thread = threading.Thread(target=crash_worker)
+        thread.start()
+        restarts = command.run_workers("127.0.0.1", 2, port=port, stopping=stopping, poll_interval=0.05)
+        thread.join()
+
+        self.assertEqual(restarts, 1)
+        self.assertIn("restarted", pids)
+        # Workers exit on SIGTERM from the supervisor
+        self.assertTrue(all(not process.is_alive() and process.exitcode == 0
+                            for process in command.worker_processes.values()))
+        self.assertFalse(accepting())
+
+    def test_rejected_connection_closed(self):
+        command = tcuserver.Command(stdout=io.StringIO())
+        command.stats = tcuserver.WorkerStats()
+        writer = mock.Mock()
+        writer.wait_closed = mock.AsyncMock()
+
+        async def reject():
+            command.connection_slots = asyncio.Semaphore(1)
+            async with command.connection_slots:
+                await command.handle_client(mock.Mock(), writer)
+
+        asyncio.run(reject())
+        writer.close.assert_called_once()
+        writer.wait_closed.assert_awaited_once()
+        self.assertEqual(command.stats.get("rejected"), 1)
+
+        # a peer that never finishes the shutdown does not hold up the handler
+        async def never_closed():
+            await asyncio.sleep(60)
+
+        writer.wait_closed = mock.AsyncMock(side_effect=never_closed)
+        with mock.patch.object(tcuserver, "CLOSE_TIMEOUT", 0.05):
+            asyncio.run(asyncio.wait_for(tcuserver.close_connection(writer), 5))
+
+
+@override_settings(CACHES=TEST_CACHES, CHANNEL_LAYERS=TEST_CHANNEL_LAYERS)
+class LoadTestFleetTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        tcu_identity.local_cache.clear()
+        self.loadtest = tculoadtest.Command()
+
+    def test_seeded_cars_accept_packets(self):
+        vins = [tculoadtest.random_vin(random.Random(seed)) for seed in range(3)]
+        self.loadtest.seed_cars(vins)
+        command = tcuserver.Command()
+        for vin in vins:
+            for index in (SAMPLE_INIT, SAMPLE_DATA, SAMPLE_CONFIG):
+                parsed_data = parse_gdc_packet(tculoadtest.with_vin(sample_packet(index), vin))
+                self.assertEqual(parsed_data["tcu"]["vin"], vin)
+                result = command.process_packet(parsed_data)
+                self.assertIsNone(result.error)
+                self.assertFalse(result.close)
+        self.assertEqual(self.loadtest.cleanup(), 3)
+        self.assertFalse(Car.objects.filter(vin__in=vins).exists())
+
+    def test_percentiles(self):
+        values = sorted(range(1, 101))
+        self.assertEqual(tculoadtest.percentile(values, 50), 50)
+        self.assertEqual(tculoadtest.percentile(values, 99), 99)
+        self.assertEqual(tculoadtest.percentile([7], 95), 7)
+        self.assertIsNone(tculoadtest.percentile([], 50))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TCULoggingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_payload_sampling(self):
+        sampler = tcu_logging.PayloadSampler(interval=3600)
+        self.assertTrue(sampler.should_dump("JN1FAAZE0U0009366"))
+        self.assertFalse(sampler.should_dump("JN1FAAZE0U0009366"))
+        self.assertTrue(sampler.should_dump("JN1FAAZE0U0000000"))
+        self.assertFalse(tcu_logging.PayloadSampler(interval=0).should_dump("JN1FAAZE0U0009366"))
+
+    def test_debug_capture(self):
+        sampler = tcu_logging.PayloadSampler(interval=0)
+        call_command("tcucapture", "add", "JN1FAAZE0U0009366", stdout=io.StringIO())
+        sampler.refresh_capture()
+        self.assertTrue(sampler.is_captured("JN1FAAZE0U0009366"))
+        self.assertTrue(sampler.should_dump("JN1FAAZE0U0009366"))
+        self.assertFalse(sampler.should_dump("JN1FAAZE0U0000000"))
+
+        call_command("tcucapture", "remove", "JN1FAAZE0U0009366", stdout=io.StringIO())
+        sampler.refresh_capture()
+        self.assertFalse(sampler.should_dump("JN1FAAZE0U0009366"))
+
+    def test_formatting_deferred(self):
+        log_queue = queue.Queue()
+        handler = tcu_logging.DeferredQueueHandler(log_queue)
+        record = logging.LogRecord("tcuserver", logging.INFO, __file__, 0, "TCU Info: %s", ({"vin": "x"},), None)
+        handler.handle(record)
+        queued = log_queue.get_nowait()
+        self.assertEqual(queued.msg, "TCU Info: %s")
+        self.assertEqual(queued.getMessage(), "TCU Info: {'vin': 'x'}")
+
+
+@override_settings(CACHES=TEST_CACHES, METRICS_FLUSH_INTERVAL=0, METRICS_TOKEN="secret")
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def create_process(self):
+        """Registry with the same metrics as another worker process would have"""
+        registry = metrics.MetricsRegistry()
+        registry.instance = f"test-{len(self.registries)}"
+        self.registries.append(registry)
+        return (metrics.Counter("test_packets_total", "Packets", ("type",), registry=registry),
+                metrics.Histogram("test_parse_seconds", "Parse time", buckets=(0.01, 0.1), registry=registry),
+                metrics.Gauge("test_connections", "Connections", registry=registry))
+
+    def test_processes_merged(self):
+        self.registries = []
+        for _ in range(2):
+            packets, parse_time, connections = self.create_process()
+            packets.inc(type="INIT")
+            packets.inc(2, type="DATA")
+            parse_time.observe(0.005)
+            parse_time.observe(0.05)
+            parse_time.observe(1)
+            connections.inc()
+        for registry in self.registries:
+            registry.flush()
+
+        output = self.registries[0].render()
+        self.assertIn("# TYPE test_packets_total counter", output)
+        self.assertIn('test_packets_total{type="INIT"} 2', output)
+        self.assertIn('test_packets_total{type="DATA"} 4', output)
+        self.assertIn('test_parse_seconds_bucket{le="0.01"} 2', output)
+        self.assertIn('test_parse_seconds_bucket{le="0.1"} 4', output)
+        self.assertIn('test_parse_seconds_bucket{le="+Inf"} 6', output)
+        self.assertIn("test_parse_seconds_count 6", output)
+        self.assertIn("test_parse_seconds_sum 2.11", output)
+        self.assertIn("test_connections 2", output)
+
+        # counters are kept when a process goes away, its gauges expire
+        cache.delete(metrics.GAUGES_KEY_PREFIX + self.registries[1].instance)
+        output = self.registries[0].render()
+        self.assertIn('test_packets_total{type="DATA"} 4', output)
+        self.assertIn("test_connections 1", output)
+
+    def test_db_queue_depth(self):
+        def depth():
+            metrics.REGISTRY.flush()
+            for line in metrics.REGISTRY.render().splitlines():
+                if line.startswith("opencarwings_tcu_db_queue_depth "):
+                    return int(line.split()[1])
+
+        executor = tcuserver.DBWorkExecutor(1, tcuserver.WorkerStats())
+        release = threading.Event()
+        try:
+            futures = [executor.submit(release.wait, 10) for _ in range(3)]
+            # one job running, two waiting for the thread
+            self.assertEqual(depth(), 3)
+            release.set()
+            for future in futures:
+                future.result(10)
+            self.assertEqual(depth(), 0)
+        finally:
+            release.set()
+            executor.shutdown()
+
+    def test_scrape_endpoint(self):
+        metrics.packets.inc(message_type="INIT", body_type="logon")
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        response = self.client.get("/metrics", headers={"Authorization": "Bearer secret"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('opencarwings_tcu_packets_total{message_type="INIT",body_type="logon"}',
+                      response.content.decode())
+        with self.settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+
+@override_settings(METRICS_FLUSH_INTERVAL=0)
+class CaptureSinkTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def captured_files(self):
+        return sorted(os.path.relpath(os.path.join(root, name), self.directory)
+                      for root, _, names in os.walk(self.directory) for name in names)
+
+    def test_deduplication_and_paths(self):
+        sink = capture.CaptureSink(self.directory, max_bytes=10000, max_files=100)
+        sink.capture("dj", "NAVI1/202501010000/INVALID-1", b"payload")
+        sink.capture("dj", "NAVI1/202501010000/INVALID-2", b"payload")
+        sink.capture("dj", "NAVI1/202501010000/INVALID-1", b"other payload")
+        sink.capture("probe", "../../../etc/passwd", b"escape")
+        sink.flush()
+        files = self.captured_files()
+        self.assertEqual(len(files), 3)
+        self.assertIn(os.path.join("dj", "NAVI1", "202501010000", "INVALID-1"), files)
+        self.assertTrue(any(name.startswith(os.path.join("dj", "NAVI1", "202501010000", "dupl-")) for name in files))
+        self.assertIn(os.path.join("probe", "etc", "passwd"), files)
+
+    def test_quota_rotation(self):
+        sink = capture.CaptureSink(self.directory, max_bytes=250, max_files=100)
+        for i in range(20):
+            sink.capture("datalog", f"datalog-unknownmsg-{i}.bin", bytes([i]) * 100)
+        sink.flush()
+        files = self.captured_files()
+        self.assertEqual(files, [os.path.join("datalog", "datalog-unknownmsg-18.bin"),
+                                 os.path.join("datalog", "datalog-unknownmsg-19.bin")])
+
+        # captures left by other processes count against the quota
+        sink = capture.CaptureSink(self.directory, max_bytes=10000, max_files=2)
+        sink.capture("datalog", "datalog-unknownmsg-20.bin", b"new")
+        sink.flush()
+        self.assertEqual(len(self.captured_files()), 2)
+
+    def test_full_queue_drops(self):
+        sink = capture.CaptureSink(self.directory, queue_size=1)
+        sink._writer = threading.Thread()  # no writer, queue is never drained
+        self.assertTrue(sink.capture("datalog", "first.bin", b"1"))
+        self.assertFalse(sink.capture("datalog", "second.bin", b"2"))
+
+    def test_compressed_capture(self):
+        sink = capture.CaptureSink(self.directory, compress=True)
+        payloads = [(f"NAVI1/PROBE-{i}", bytes([i]) * 50) for i in range(5)]
+        for name, data in payloads:
+            sink.capture("probe", name, data)
+        sink.close()
+        files = self.captured_files()
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].endswith(capture.ARCHIVE_SUFFIX))
+        self.assertEqual(list(capture.read_capture_file(os.path.join(self.directory, files[0]))), payloads)
+
+    def test_compressed_quota_rotation(self):
+        # the open segment counts against the quota, it is closed and rotated once it is exceeded
+        sink = capture.CaptureSink(self.directory, max_bytes=70000, compress=True, segment_bytes=30000)
+        payloads = [(f"NAVI1/PROBE-{i}", os.urandom(10000)) for i in range(20)]
+        for name, data in payloads:
+            sink.capture("probe", name, data)
+        sink.close()
+        files = [os.path.join(self.directory, name) for name in self.captured_files()]
+        self.assertLessEqual(sum(os.path.getsize(path) for path in files), 70000)
+        captured = [payload for path in files for payload in capture.read_capture_file(path)]
+        self.assertEqual(captured, payloads[-len(captured):])
+        self.assertGreaterEqual(len(captured), 4)
+
+
+@override_settings(CACHES=TEST_CACHES, CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, METRICS_FLUSH_INTERVAL=0,
+                   NOTIFICATION_RETRY_DELAY=0)
+class NotificationQueueTests(TransactionTestCase):
+
+    def setUp(self):
+        self.car = create_test_car()
+        self.car.owner.email = "owner@example.com"
+        self.car.owner.save()
+
+    def test_local_delivery(self):
+        dispatcher = notification_queue.NotificationDispatcher()
+        dispatcher.enqueue(notification_queue.create_jobs(self.car, "Vehicle is unplugged.", "Charger unplugged"))
+        dispatcher.flush()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, "Charger unplugged - OpenCARWINGS")
+        self.assertEqual(mail.outbox[0].to, ["owner@example.com"])
+
+    def test_unreachable_redis_falls_back(self):
+        with self.settings(NOTIFICATION_QUEUE_REDIS="redis://127.0.0.1:1/0"):
+            dispatcher = notification_queue.NotificationDispatcher()
+            dispatcher.enqueue(notification_queue.create_jobs(self.car, "Charging finished.", "Charge finish"))
+            dispatcher.flush()
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_retries(self):
+        job = notification_queue.create_jobs(self.car, "Charging finished.", "Charge finish")[0]
+        outcomes = [ConnectionError("SMTP unavailable"), None]
+
+        async def deliver(_):
+            outcome = outcomes.pop(0)
+            if outcome is not None:
+                raise outcome
+
+        with mock.patch.object(notification_queue, "deliver", deliver):
+            asyncio.run(notification_queue.deliver_with_retries(job))
+        self.assertEqual(job["attempts"], 1)
+        self.assertEqual(outcomes, [])
+
+        with mock.patch.object(notification_queue, "deliver", side_effect=ConnectionError("SMTP unavailable")):
+            with self.settings(NOTIFICATION_MAX_ATTEMPTS=3):
+                asyncio.run(notification_queue.deliver_with_retries(job))
+        self.assertEqual(job["attempts"], 3)
+
+
+class FakeAPNs:
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.sent = []
+
+    async def send_notification(self, request):
+        self.sent.append(request)
+        await asyncio.sleep(0.05)
+        status, description = self.statuses.get(request.device_token, ("200", None))
+        return NotificationResult(request.notification_id, status, description)
+
+
+class FakeFCM:
+    def __init__(self, dead_tokens):
+        self.dead_tokens = dead_tokens
+        self.sent = []
+
+    def notify(self, fcm_token, notification_title, notification_body, timeout):
+        self.sent.append((fcm_token, notification_title, notification_body))
+        time.sleep(0.05)
+        if fcm_token in self.dead_tokens:
+            raise FCMNotRegisteredError("Token not registered")
+        return {"name": "projects/test/messages/1"}
+
+
+@override_settings(CACHES=TEST_CACHES, CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, METRICS_FLUSH_INTERVAL=0)
+class PushNotificationTests(TransactionTestCase):
+
+    def setUp(self):
+        self.car = create_test_car()
+        self.owner = self.car.owner
+        self.executor = ThreadPoolExecutor(max_workers=4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def add_token(self, device_type, key, lang="en"):
+        TokenMetadata.objects.create(user=self.owner, token=f"refresh-{key}", device_type=device_type,
+                                     push_notification_key=key, lang=lang)
+
+    def send(self, apns, fcm):
+        with mock.patch.object(notifications, "get_apns_client", return_value=apns), \
+                mock.patch.object(notifications, "get_fcm_client", return_value=(fcm, self.executor)):
+            start = time.monotonic()
+            asyncio.run(notifications.send_push_notification_for_user(self.car, self.owner,
+                                                                      "Charging finished.", "Charge finish"))
+            return time.monotonic() - start
+
+    def test_fan_out_and_pruning(self):
+        apple_keys = [f"apple{i:020d}" for i in range(4)]
+        fcm_keys = [f"fcm{i:022d}" for i in range(4)]
+        for key in apple_keys:
+            self.add_token("apple", key)
+        for key in fcm_keys:
+            self.add_token("fcm", key, lang="fi")
+        apns = FakeAPNs({apple_keys[0]: ("410", "Unregistered"), apple_keys[1]: ("400", "BadDeviceToken")})
+        fcm = FakeFCM({fcm_keys[0]})
+
+        elapsed = self.send(apns, fcm)
+        self.assertEqual(len(apns.sent), 4)
+        self.assertEqual(len(fcm.sent), 4)
+        # Sequential sends would take 8 * 0.05 s
+        self.assertLess(elapsed, 0.3)
+        self.assertTrue(all(title.startswith(self.car.nickname) for _, title, _ in fcm.sent))
+
+        remaining = set(TokenMetadata.objects.exclude(push_notification_key="")
+                        .values_list("push_notification_key", flat=True))
+        self.assertEqual(remaining, set(apple_keys[2:]) | set(fcm_keys[1:]))
+        # Login tokens of pruned devices are kept
+        self.assertEqual(TokenMetadata.objects.count(), 8)
+
+    def test_failures(self):
+        self.add_token("apple", "apple" + "0" * 20)
+        self.add_token("apple", "apple" + "1" * 20)
+        apns = FakeAPNs({"apple" + "0" * 20: ("503", "ServiceUnavailable")})
+        # One device got the notification, retrying would notify it twice
+        self.send(apns, None)
+
+        apns = FakeAPNs({"apple" + "0" * 20: ("503", "ServiceUnavailable"),
+                         "apple" + "1" * 20: ("503", "ServiceUnavailable")})
+        with self.assertRaises(RuntimeError):
+            self.send(apns, None)
+        self.assertEqual(TokenMetadata.objects.filter(push_notification_key="").count(), 0)
+
+
+@override_settings(CACHES=TEST_CACHES, CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, METRICS_FLUSH_INTERVAL=0,
+                   LEAF_COMMAND_TIMEOUT=5)
+class SchedulerTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_cache_leader_lock(self):
+        first = leader.CacheLeaderLock("test", ttl=60)
+        second = leader.CacheLeaderLock("test", ttl=60)
+        second.owner = "other-host-1"
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        # Renewing keeps the lease
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        first.release()
+        self.assertTrue(second.acquire())
+        self.assertFalse(first.acquire())
+
+    def test_tasks_run_on_leader_only(self):
+        lock = leader.CacheLeaderLock("tcuscheduler", ttl=60)
+        command = tcuscheduler.Command(stdout=io.StringIO())
+        command.leader = False
+        calls = []
+        command.tasks = [tcuscheduler.ScheduledTask("fast", 15, lambda: calls.append("fast")),
+                         tcuscheduler.ScheduledTask("slow", 60, lambda: calls.append("slow")),
+                         tcuscheduler.ScheduledTask("broken", 15, lambda: 1 / 0)]
+
+        cache.add(lock.key, "other-host-1", 60)
+        command.tick(lock, 1000)
+        self.assertEqual(calls, [])
+
+        cache.delete(lock.key)
+        with self.assertLogs("tculink.management.commands.tcuscheduler", level="ERROR") as logs:
+            command.tick(lock, 1000)
+            self.assertEqual(calls, ["fast", "slow"])
+            command.tick(lock, 1010)
+            self.assertEqual(calls, ["fast", "slow"])
+            command.tick(lock, 1015)
+            self.assertEqual(calls, ["fast", "slow", "fast"])
+            command.tick(lock, 1060)
+            self.assertEqual(calls, ["fast", "slow", "fast", "fast", "slow"])
+        # A failing task does not stop the others
+        self.assertEqual(len(logs.records), 3)
+
+    def test_lease_renewed_during_long_task(self):
+        lock = leader.CacheLeaderLock("tcuscheduler", ttl=1)
+        standby = leader.CacheLeaderLock("tcuscheduler", ttl=1)
+        standby.owner = "other-host-1"
+        command = tcuscheduler.Command(stdout=io.StringIO())
+        command.leader = False
+        taken_over = []
+
+        def long_task():
+            # outlives the lease, which the heartbeat keeps renewing
+            time.sleep(1.5)
+            taken_over.append(standby.acquire())
+
+        command.tasks = [tcuscheduler.ScheduledTask("long", 15, long_task)]
+        command.tick(lock, 1000)
+        self.assertEqual(taken_over, [False])
+        # Renewing stops with the task, the lease expires without the leader
+        time.sleep(1.2)
+        self.assertTrue(standby.acquire())
+
+    def test_command_timeout(self):
+        car = create_test_car()
+        car.command_requested = True
+        car.command_result = -1
+        car.command_type = 1
+        car.command_request_time = timezone.now() - datetime.timedelta(minutes=6)
+        car.save()
+
+        command = tcuscheduler.Command(stdout=io.StringIO())
+        command.leader = False
+        command.tasks = command.build_tasks(15, stdout=io.StringIO())
+        command.tick(leader.CacheLeaderLock("tcuscheduler", ttl=60), 1000)
+
+        car.refresh_from_db()
+        self.assertFalse(car.command_requested)
+        self.assertEqual(car.command_result, 2)
+        self.assertTrue(AlertHistory.objects.filter(car=car, type=98).exists())
+
+
+@override_settings(CACHES=TEST_CACHES, CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, METRICS_FLUSH_INTERVAL=0)
+class CommandTimerScheduleTests(TestCase):
+
+    def create_timer(self, car, **kwargs):
+        timer = CommandTimerSetting.objects.create(name="Morning", enabled=True, command_type=1,
+                                                  time=datetime.time(22, 0), **kwargs)
+        car.timer_commands.add(timer)
+        timer.refresh_from_db()
+        return timer
+
+    def test_next_fire(self):
+        helsinki = zoneinfo.ZoneInfo("Europe/Helsinki")
+        # Monday 12:00 UTC
+        after = datetime.datetime(2026, 10, 19, 12, 0, tzinfo=datetime.timezone.utc)
+        timer = CommandTimerSetting(enabled=True, time=datetime.time(22, 0), weekday_tue=True)
+        # 22:00 UTC on Monday is Tuesday 01:00 in Helsinki
+        self.assertEqual(next_timer_fire(timer, after, helsinki),
+                         datetime.datetime(2026, 10, 19, 22, 0, tzinfo=datetime.timezone.utc))
+        self.assertEqual(next_timer_fire(timer, after, datetime.timezone.utc),
+                         datetime.datetime(2026, 10, 20, 22, 0, tzinfo=datetime.timezone.utc))
+        self.assertEqual(next_timer_fire(timer, after.replace(hour=22), helsinki),
+                         datetime.datetime(2026, 10, 26, 22, 0, tzinfo=datetime.timezone.utc))
+
+        once = CommandTimerSetting(enabled=True, time=datetime.time(22, 0), date=datetime.date(2027, 3, 2))
+        self.assertEqual(next_timer_fire(once, after, helsinki),
+                         datetime.datetime(2027, 3, 1, 22, 0, tzinfo=datetime.timezone.utc))
+        self.assertIsNone(next_timer_fire(once, datetime.datetime(2027, 3, 1, 22, 0, tzinfo=datetime.timezone.utc),
+                                          helsinki))
+        timer.enabled = False
+        self.assertIsNone(next_timer_fire(timer, after, helsinki))
+
+    def test_next_fire_follows_owner(self):
+        car = create_test_car()
+        timer = self.create_timer(car, weekday_mon=True, weekday_tue=True, weekday_wed=True, weekday_thu=True,
+                                  weekday_fri=True, weekday_sat=True, weekday_sun=True)
+        self.assertEqual(timer.next_fire_at.time(), datetime.time(22, 0))
+        self.assertGreater(timer.next_fire_at, timezone.now())
+
+        timer.enabled = False
+        timer.save()
+        self.assertIsNone(timer.next_fire_at)
+
+        once = self.create_timer(car, date=(timezone.now() + datetime.timedelta(days=3)).date())
+        car.owner.timezone = "Pacific/Kiritimati"
+        car.owner.save()
+        once.refresh_from_db()
+        # 22:00 UTC is 12:00 the next day at UTC+14
+        self.assertEqual(once.next_fire_at.date(), once.date - datetime.timedelta(days=1))
+
+    def test_due_timers(self):
+        car = create_test_car()
+        other_car = create_test_car(vin="JN1FAAZE0U0009367", username="second")
+        due = self.create_timer(car, weekday_mon=True, weekday_tue=True, weekday_wed=True, weekday_thu=True,
+                                weekday_fri=True, weekday_sat=True, weekday_sun=True)
+        other_car.timer_commands.add(due)
+        later = self.create_timer(car, weekday_mon=True)
+        missed = self.create_timer(car, weekday_mon=True)
+        fire_at = timezone.now() + datetime.timedelta(seconds=30)
+        CommandTimerSetting.objects.filter(pk=due.pk).update(next_fire_at=fire_at)
+        CommandTimerSetting.objects.filter(pk=later.pk).update(next_fire_at=fire_at + datetime.timedelta(minutes=5))
+        CommandTimerSetting.objects.filter(pk=missed.pk).update(next_fire_at=fire_at - datetime.timedelta(hours=1))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(len(CommandTimerSetting.due_for_cars(timezone.now() + datetime.timedelta(minutes=1))), 3)
+        self.assertEqual(len(queries), 1)
+
+        command = tcuperiodicupdate.Command(stdout=io.StringIO())
+        with mock.patch.object(sms_dispatch, "send_batch_using_provider", wraps=send_batch_using_provider) as send, \
+                mock.patch("builtins.print"):
+            command.handle_command_timers()
+            requested = Car.objects.filter(command_requested=True)
+            self.assertEqual(sorted(requested.values_list("vin", flat=True)), [car.vin, other_car.vin])
+            self.assertTrue(all(requested_car.command_payload == {"timer": due.pk} for requested_car in requested))
+
+            due.refresh_from_db()
+            self.assertEqual(due.last_command_result, -1)
+            self.assertGreater(due.next_fire_at, fire_at)
+            self.assertEqual(due.next_fire_at.time(), datetime.time(22, 0))
+            missed.refresh_from_db()
+            self.assertIsNone(missed.last_command_execution)
+            self.assertGreater(missed.next_fire_at, timezone.now())
+
+            # Fired timers are not due again
+            send.reset_mock()
+            command.handle_command_timers()
+            send.assert_not_called()
+
+
+@override_settings(CACHES=TEST_CACHES, CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, METRICS_FLUSH_INTERVAL=0,
+                   LEAF_COMMAND_TIMEOUT=5)
+class CommandTimeoutTests(TestCase):
+
+    def create_cars(self):
+        now = timezone.now()
+        timer = CommandTimerSetting.objects.create(name="Once", enabled=True, command_type=1, timer_type=0,
+                                                  time=datetime.time(22, 0), date=now.date())
+        cars = {}
+        for name, result, requested, age, payload in (
+                ("waiting", -1, True, 6, {"timer": timer.pk}),
+                ("no_response", 3, False, 9, None),
+                ("recent", -1, True, 2, None),
+                ("responding", 3, False, 6, None),
+                ("done", 1, False, 60, None)):
+            car = create_test_car(vin=f"JN1FAAZE0U{len(cars):07d}", username=name)
+            Car.objects.filter(pk=car.pk).update(command_result=result, command_requested=requested, command_type=1,
+                                                 command_request_time=now - datetime.timedelta(minutes=age),
+                                                 command_payload=payload, command_id=10 + len(cars))
+            cars[name] = car
+        return cars, timer
+
+    def check_timeouts(self, max_queries):
+        cars, timer = self.create_cars()
+        command = tcuperiodicupdate.Command(stdout=io.StringIO())
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks() as callbacks:
+            command.handle_timeouts()
+        # Claiming, timers and alerts, independent of the number of cars
+        self.assertLessEqual(len([q for q in queries if "SAVEPOINT" not in q["sql"]]), max_queries)
+        self.assertEqual(len(callbacks), 1)
+
+        results = dict(Car.objects.values_list("owner__username", "command_result"))
+        self.assertEqual(results, {"waiting": 2, "no_response": 2, "recent": -1, "responding": 3, "done": 1})
+        self.assertFalse(Car.objects.get(pk=cars["waiting"].pk).command_requested)
+        alerts = AlertHistory.objects.filter(type=98)
+        self.assertEqual(sorted(alerts.values_list("car__owner__username", flat=True)), ["no_response", "waiting"])
+        self.assertEqual(alerts.get(car=cars["waiting"]).command_id, 10)
+
+        timer.refresh_from_db()
+        self.assertEqual(timer.last_command_result, 2)
+        self.assertFalse(timer.enabled)
+        self.assertIsNone(timer.next_fire_at)
+
+        # Already processed timeouts are not processed again
+        command.handle_timeouts()
+        self.assertEqual(alerts.count(), 2)
+
+    def test_timeouts_returning(self):
+        self.check_timeouts(max_queries=3)
+
+    def test_timeouts_without_returning(self):
+        with mock.patch.object(connection, "vendor", "mysql"):
+            self.check_timeouts(max_queries=4)
+
+
+def refresh_due(car, now):
+    """The per-car check handle_datarefresh did before selecting due cars in SQL"""
+    if car.periodic_refresh == 0 and car.periodic_refresh_running == 0:
+        return False
+    if car.command_requested and car.command_result == -1:
+        return False
+    if (car.ev_info.charging or car.ev_info.car_running) and car.periodic_refresh_running != 0:
+        period = now - datetime.timedelta(minutes=car.periodic_refresh_running)
+    else:
+        if car.periodic_refresh == 0:
+            return False
+        period = now - datetime.timedelta(minutes=car.periodic_refresh)
+    if car.command_result == 2 and car.command_request_time is not None and car.command_request_time > period:
+        return False
+    return car.last_connection is not None and car.last_connection < period
+
+
+@override_settings(CACHES=TEST_CACHES, CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, METRICS_FLUSH_INTERVAL=0,
+                   PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class PeriodicRefreshTests(TestCase):
+
+    def test_due_cars(self):
+        rng = random.Random(18)
+        now = timezone.now()
+        for i in range(80):
+            car = create_test_car(vin=f"JN1FAAZE0U{i:07d}", username=f"refresh{i}")
+            EVInfo.objects.filter(pk=car.ev_info_id).update(charging=rng.random() < 0.3,
+                                                            car_running=rng.random() < 0.2)
+            last_connection = rng.choice([None, 3, 10, 30, 90, 2000])
+            requested, result, request_age = rng.choice([(False, 1, 600), (True, -1, 1), (False, 2, 5),
+                                                         (False, 2, 600), (False, 2, None)])
+            Car.objects.filter(pk=car.pk).update(
+                periodic_refresh=rng.choice([0, 15, 60, 1440]),
+                periodic_refresh_running=rng.choice([0, 5, 20]),
+                last_connection=None if last_connection is None else now - datetime.timedelta(minutes=last_connection),
+                command_requested=requested, command_result=result,
+                command_request_time=None if request_age is None else now - datetime.timedelta(minutes=request_age),
+            )
+
+        expected = sorted(car.vin for car in Car.objects.select_related("ev_info") if refresh_due(car, now))
+        self.assertGreater(len(expected), 5)
+        with self.assertNumQueries(1):
+            due = Car.due_for_refresh(now)
+            self.assertEqual(sorted(car.vin for car in due), expected)
+            # Loaded with the car, no query per car
+            [(car.ev_info.charging, car.owner.username) for car in due]
+
+        command = tcuperiodicupdate.Command(stdout=io.StringIO())
+        with mock.patch("builtins.print"):
+            command.handle_datarefresh()
+        requested = Car.objects.filter(command_request_time__gte=timezone.now() - datetime.timedelta(seconds=30))
+        self.assertEqual(sorted(requested.values_list("vin", flat=True)), expected)
+
+    def test_spread(self):
+        now = timezone.now().replace(second=0, microsecond=0)
+        vins = [f"JN1FAAZE0U{i:07d}" for i in range(90)]
+        for i, vin in enumerate(vins):
+            create_test_car(vin=vin, username=f"spread{i}")
+        # A fleet which connected at once
+        Car.objects.update(periodic_refresh=30, last_connection=now - datetime.timedelta(minutes=1))
+        self.assertEqual(Car.objects.get(vin=vins[0]).refresh_phase, vin_refresh_phase(vins[0]))
+
+        # Without spreading the whole fleet is due at once, one interval later
+        self.assertEqual(Car.due_for_refresh(now + datetime.timedelta(minutes=29)).count(), 0)
+        self.assertEqual(Car.due_for_refresh(now + datetime.timedelta(minutes=30)).count(), len(vins))
+
+        woken = collections.Counter()
+        per_minute = []
+        for minute in range(30):
+            at = now + datetime.timedelta(minutes=minute)
+            due = list(Car.due_for_refresh(at, spread=True))
+            for car in due:
+                # Due within a minute of its slot
+                self.assertLess((int(at.timestamp()) - car.refresh_phase % 1800) % 1800, 60)
+            woken.update(car.vin for car in due)
+            per_minute.append(len(due))
+            Car.objects.filter(pk__in=[car.pk for car in due]).update(last_connection=at)
+
+        self.assertEqual(set(woken), set(vins))
+        self.assertEqual(set(woken.values()), {1})
+        self.assertLessEqual(max(per_minute), 12)
+
+    @override_settings(PERIODIC_REFRESH_MAX_PER_MINUTE=5)
+    def test_wakeup_budget(self):
+        now = timezone.now()
+        for i in range(8):
+            car = create_test_car(vin=f"JN1FAAZE0U{i:07d}", username=f"budget{i}")
+            Car.objects.filter(pk=car.pk).update(periodic_refresh=60,
+                                                 last_connection=now - datetime.timedelta(minutes=100 - i))
+
+        command = tcuperiodicupdate.Command(stdout=io.StringIO())
+        with mock.patch("builtins.print"):
+            command.handle_datarefresh()
+        # Longest waiting first, the others are left for the next run
+        self.assertEqual(sorted(Car.objects.filter(command_requested=True).values_list("vin", flat=True)),
+                         [f"JN1FAAZE0U{i:07d}" for i in range(5)])
+        self.assertIn("Deferring 3 car refreshes", command.stdout.getvalue())
+
+
+def fake_response(status_code=200, data=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = b"{}" if data is None else json.dumps(data).encode()
+    return response
+
+
+@override_settings(METRICS_FLUSH_INTERVAL=0, SMS_PROVIDERS={
+    "hologram": ("Hologram SIM", "tculink.sms.hologram.ProviderHologram", {"timeout": 3, "concurrency": 8}),
+    "monogoto": ("Monogoto", "tculink.sms.monogoto.ProviderMonogoto"),
+})
+class SMSProviderRegistryTests(TestCase):
+
+    def test_shared_provider(self):
+        provider = get_provider("hologram")
+        self.assertIs(get_provider("hologram"), provider)
+        self.assertEqual(provider.timeout, 3)
+        self.assertEqual(provider.session.get_adapter("https://dashboard.hologram.io")._pool_maxsize, 8)
+        self.assertEqual(get_provider("monogoto").timeout, 10)
+
+        configuration = {"provider": "hologram", "apikey": "key", "device_id": "1"}
+        with mock.patch.object(requests.Session, "post", return_value=fake_response()) as post:
+            self.assertTrue(send_using_provider("WAKE", configuration, "tcu1"))
+            self.assertTrue(send_using_provider("WAKE", configuration, "tcu1"))
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(post.call_args.kwargs["timeout"], 3)
+        # Connections are kept in the same session
+        self.assertIs(get_provider("hologram").session, provider.session)
+
+        with override_settings(SMS_PROVIDERS={"hologram": ("Hologram SIM", "tculink.sms.hologram.ProviderHologram")}):
+            self.assertIsNot(get_provider("hologram"), provider)
+            self.assertEqual(get_provider("hologram").timeout, 10)
+
+    def test_tokens_per_account(self):
+        provider = get_provider("monogoto")
+
+        def post(url, **kwargs):
+            if url.endswith("/Auth"):
+                return fake_response(data={"token": f"token-{kwargs['json']['UserName']}"})
+            return fake_response()
+
+        with mock.patch.object(requests.Session, "post", side_effect=post) as session_post:
+            for username in ("first", "second", "first"):
+                provider.send("WAKE", {"username": username, "password": "pass", "thing_id": "1"})
+        sms_calls = [call for call in session_post.call_args_list if call.args[0].endswith("/sms")]
+        self.assertEqual([call.kwargs["headers"]["Authorization"] for call in sms_calls],
+                         ["Bearer token-first", "Bearer token-second", "Bearer token-first"])
+        # The first account's token was reused
+        self.assertEqual(session_post.call_count, 5)
+
+    @override_settings(SMS_PROVIDERS={"seven": ("seven.io", "tculink.sms.seven.ProviderSevenIO"),
+                                      "hologram": ("Hologram SIM", "tculink.sms.hologram.ProviderHologram")})
+    def test_per_recipient_results(self):
+        provider = get_provider("seven")
+        configurations = [{"apikey": "key", "msn": f"+358 40 000 00{i:02d}"} for i in range(3)]
+        # status 101: sending to at least one recipient failed
+        response = fake_response(data={"status": "101", "messages": [
+            {"recipient": "358400000000", "success": True},
+            {"recipient": "358400000001", "success": False, "error_text": "Invalid recipient"},
+            {"recipient": "358400000002", "success": True},
+        ]})
+        with mock.patch.object(requests.Session, "post", return_value=response) as post:
+            self.assertEqual(provider.send_many("WAKE", configurations), [True, False, True])
+        self.assertEqual(post.call_args.kwargs["data"]["to"], "358400000000,358400000001,358400000002")
+
+        with mock.patch.object(requests.Session, "post", return_value=fake_response(data={"status": "100"})):
+            self.assertEqual(provider.send_many("WAKE", configurations), [True] * 3)
+        with mock.patch.object(requests.Session, "post", return_value=fake_response(status_code=401)):
+            self.assertEqual(provider.send_many("WAKE", configurations), [False] * 3)
+
+        # Hologram accepts or rejects the request as a whole
+        configurations = [{"apikey": "key", "device_id": str(i)} for i in range(3)]
+        with mock.patch.object(requests.Session, "post",
+                               return_value=fake_response(data={"success": False, "error": "Invalid device"})):
+            self.assertEqual(get_provider("hologram").send_many("WAKE", configurations), [False] * 3)
+
+    def test_shared_coordinator(self):
+        coordinator = get_coordinator("continental2012")
+        self.assertIs(get_coordinator("continental2012"), coordinator)
+        self.assertEqual(get_supported_commands("continental2012"), coordinator.SUPPORTED_COMMANDS)
+
+
+class FakeSMSCar:
+    tcu_type = "continental2012"
+    tcu_model = "201300026078"
+
+    def __init__(self, vin, provider):
+        self.vin = vin
+        self.sms_config = {"provider": provider, "vin": vin}
+
+    def save(self):
+        pass
+
+
+@override_settings(METRICS_FLUSH_INTERVAL=0, SMS_PROVIDERS={
+    "slow": ("Slow", "tculink.sms.manual.ProviderManual", {"rate": 20, "burst": 2, "concurrency": 2}),
+    "fast": ("Fast", "tculink.sms.manual.ProviderManual"),
+})
+class SMSDispatchTests(TestCase):
+
+    def test_token_bucket(self):
+        bucket = sms_dispatch.TokenBucket(rate=10, burst=2)
+        deadline = time.monotonic() + 0.15
+        start = time.monotonic()
+        # Burst, then one token every 0.1 s until the deadline
+        self.assertEqual([bucket.reserve(deadline) for _ in range(4)], [True, True, True, False])
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertTrue(sms_dispatch.TokenBucket(rate=0, burst=0).reserve(0))
+
+    def test_dispatch(self):
+        active = collections.Counter()
+        peak = collections.Counter()
+        lock = threading.Lock()
+
+        def send(provider, messages):
+            with lock:
+                active[provider] += 1
+                peak[provider] = max(peak[provider], active[provider])
+            time.sleep(0.03)
+            with lock:
+                active[provider] -= 1
+            return [ConnectionError("Provider unavailable") if configuration["vin"] == "broken" else True
+                    for _, configuration, _ in messages]
+
+        requests = [(FakeSMSCar(f"slow{i}", "slow"), 1, None) for i in range(12)]
+        requests += [(FakeSMSCar(f"fast{i}", "fast"), 1, None) for i in range(8)]
+        requests.append((FakeSMSCar("broken", "fast"), 1, None))
+        dispatcher = sms_dispatch.CommandDispatcher(max_workers=16)
+        with mock.patch.object(sms_dispatch, "send_batch_using_provider", side_effect=send):
+            start = time.monotonic()
+            report = dispatcher.dispatch(requests, max_wait=0.3)
+            elapsed = time.monotonic() - start
+
+        # 2 burst + 20/s for 0.3 s
+        self.assertIn(report.counts["dispatched"], range(12, 17))
+        self.assertEqual(report.failed, 1)
+        self.assertEqual(report.throttled, len(requests) - report.dispatched - 1)
+        self.assertTrue(all(outcome == "dispatched" for outcome in report.outcomes[12:20]))
+        self.assertEqual(report.outcomes[-1], "failed")
+        self.assertLessEqual(peak["slow"], 2)
+        self.assertGreater(peak["fast"], 2)
+        self.assertLess(elapsed, 0.6)
+        self.assertEqual(str(report), f"{report.dispatched} dispatched, {report.throttled} throttled, 1 failed")
+        self.assertTrue(requests[12][0].command_requested)
+
+    @override_settings(SMS_PROVIDERS={"gatewayapi": ("gatewayapi.com", "tculink.sms.gatewayapi.ProviderGatewayAPI")})
+    def test_batches(self):
+        cars = [FakeSMSCar(f"batch{i}", "gatewayapi") for i in range(5)]
+        for i, car in enumerate(cars):
+            car.sms_config.update(apikey="first" if i < 4 else "second", msn=f"+358 40 000 00{i:02d}")
+        incomplete = FakeSMSCar("incomplete", "gatewayapi")
+        incomplete.sms_config["apikey"] = "first"
+        dispatcher = sms_dispatch.CommandDispatcher(max_workers=4)
+        with mock.patch.object(requests.Session, "post", return_value=fake_response()) as post:
+            report = dispatcher.dispatch([(car, 1, None) for car in cars + [incomplete]], max_wait=1)
+
+        # One request per account, the incomplete configuration is sent alone and fails
+        self.assertEqual(report.outcomes, ["dispatched"] * 5 + ["failed"])
+        recipients = sorted(len(call.kwargs["json"]["recipients"]) for call in post.call_args_list)
+        self.assertEqual(recipients, [1, 4])
+        self.assertTrue(all(car.command_requested and car.command_result == -1 for car in cars))
+        self.assertFalse(hasattr(incomplete, "command_requested"))
+
+
+@override_settings(CACHES=TEST_CACHES, CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, METRICS_FLUSH_INTERVAL=0,
+                   SMS_OUTBOX=True, SMS_OUTBOX_MAX_ATTEMPTS=3, SMS_OUTBOX_RETRY_DELAY=4, SMS_PROVIDERS={
+                       "gatewayapi": ("gatewayapi.com", "tculink.sms.gatewayapi.ProviderGatewayAPI"),
+                   })
+class SMSOutboxTests(TestCase):
+
+    def setUp(self):
+        self.car = create_test_car()
+        self.car.sms_config = {"provider": "gatewayapi", "apikey": "key", "msn": "+358400000000"}
+        self.car.save()
+        self.worker = sms_outbox.OutboxWorker(sms_dispatch.CommandDispatcher(max_workers=2))
+
+    def process(self, *responses):
+        with mock.patch.object(requests.Session, "post", side_effect=list(responses)) as post:
+            processed = self.worker.process()
+        self.assertEqual(post.call_count, len(responses))
+        return processed
+
+    def test_queued_command(self):
+        with mock.patch.object(requests.Session, "post") as post:
+            car = send_command_using_provider(1, None, self.car)
+        # Acknowledged before anything was sent
+        post.assert_not_called()
+        self.assertTrue(car.command_requested)
+        message = SMSOutboxMessage.objects.get(car=car)
+        self.assertEqual((message.status, message.command_id), (sms_outbox.STATUS_PENDING, car.command_id))
+
+        # A new command replaces the queued one
+        send_command_using_provider(2, None, self.car)
+        self.assertEqual(sorted(SMSOutboxMessage.objects.values_list("status", flat=True)),
+                         [sms_outbox.STATUS_PENDING, sms_outbox.STATUS_CANCELLED])
+
+        self.assertEqual(self.process(fake_response()), 1)
+        message = SMSOutboxMessage.objects.get(status=sms_outbox.STATUS_SENT)
+        self.assertEqual((message.attempts, message.command_id), (1, Car.objects.get().command_id))
+        self.assertIsNotNone(message.sent_at)
+        self.assertEqual(self.worker.process(), 0)
+
+    def test_retry_with_backoff(self):
+        send_command_using_provider(1, None, self.car)
+        before = timezone.now()
+        self.process(fake_response(500))
+        message = SMSOutboxMessage.objects.get()
+        self.assertEqual((message.status, message.attempts), (sms_outbox.STATUS_PENDING, 1))
+        # 4 s with jitter
+        self.assertGreaterEqual(message.next_attempt_at, before + datetime.timedelta(seconds=2))
+        self.assertLessEqual(message.next_attempt_at, timezone.now() + datetime.timedelta(seconds=4))
+        self.assertIn("did not accept", message.last_error)
+        self.assertEqual(self.worker.process(), 0)
+
+        SMSOutboxMessage.objects.update(next_attempt_at=timezone.now())
+        self.process(fake_response())
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), (sms_outbox.STATUS_SENT, 2))
+        self.assertTrue(Car.objects.get().command_requested)
+
+        for attempts in range(1, 10):
+            self.assertLessEqual(sms_outbox.retry_delay(attempts), 60)
+
+    def test_gives_up(self):
+        timer = CommandTimerSetting.objects.create(name="Timer", enabled=True, command_type=1, timer_type=1,
+                                                   time=datetime.time(22, 0), weekday_mon=True)
+        submit = sms_outbox.submit_commands([(self.car, 1, {"timer": timer.pk})])
+        self.assertEqual(submit.dispatched, 1)
+        for _ in range(3):
+            SMSOutboxMessage.objects.update(next_attempt_at=timezone.now())
+            self.process(ConnectionError("Provider unavailable"))
+
+        message = SMSOutboxMessage.objects.get()
+        self.assertEqual((message.status, message.attempts), (sms_outbox.STATUS_FAILED, 3))
+        car = Car.objects.get()
+        self.assertEqual((car.command_requested, car.command_result), (False, 1))
+        self.assertEqual(AlertHistory.objects.get(car=car).type, 99)
+        timer.refresh_from_db()
+        self.assertEqual(timer.last_command_result, 1)
+
+    def test_cancelled_after_timeout(self):
+        send_command_using_provider(1, None, self.car)
+        Car.objects.update(command_requested=False, command_result=2)
+        self.assertEqual(self.process(), 1)
+        self.assertEqual(SMSOutboxMessage.objects.get().status, sms_outbox.STATUS_CANCELLED)
+
+        SMSOutboxMessage.objects.update(created_at=timezone.now() - datetime.timedelta(days=8))
+        self.assertEqual(self.worker.purge(timezone.now()), 1)
+
+
+@override_settings(CACHES=TEST_CACHES, CHANNEL_LAYERS=TEST_CHANNEL_LAYERS, METRICS_FLUSH_INTERVAL=0)
+class SMSGatewayTests(TestCase):
+    KEY = bytes(range(16))
+
+    def setUp(self):
+        self.cars = [create_test_car(vin=f"JN1FAAZE0U00093{i:02d}", username=f"gateway{i}") for i in range(2)]
+        for i, car in enumerate(self.cars):
+            car.sms_config = {"provider": "smsgateway", "device_id": "phone1", "encryption_key": self.KEY.hex(),
+                              "phone": f"+35840000000{i}"}
+            car.save()
+
+    def decrypt(self, frame):
+        cipher = AES.new(self.KEY, AES.MODE_CBC, frame[:16])
+        return json.loads(unpad(cipher.decrypt(frame[16:]), AES.block_size))
+
+    def encrypt(self, parcel):
+        iv = os.urandom(16)
+        return iv + AES.new(self.KEY, AES.MODE_CBC, iv).encrypt(pad(json.dumps(parcel).encode(), AES.block_size))
+
+    async def connect(self, path, headers=()):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path, headers=list(headers))
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(self.decrypt(await communicator.receive_from()), {"type": "connect"})
+        return communicator
+
+    def test_device_lookup(self):
+        self.assertEqual(Car.for_gateway_device("phone1").count(), 2)
+        self.assertFalse(Car.for_gateway_device("phone2").exists())
+        # SQLite only matches expression indexes without bound parameters
+        if connection.vendor == "postgresql":
+            query, params = Car.for_gateway_device("phone1").query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute(f"EXPLAIN {query}", params)
+                self.assertIn("car_sms_device_idx", str(cursor.fetchall()))
+
+    async def test_batched_relay(self):
+        communicator = await self.connect("/ws/smsgateway/?device_id=phone1&batch=1")
+        configurations = [car.sms_config for car in self.cars]
+        provider = await sync_to_async(get_provider)("smsgateway")
+        results = await sync_to_async(provider.send_batch)([("WAKE", configuration)
+                                                            for configuration in configurations])
+        self.assertEqual(results, [True, True])
+
+        # Messages to one device in one parcel
+        parcel = self.decrypt(await communicator.receive_from())
+        self.assertEqual(parcel["type"], "batch")
+        self.assertEqual([(sms["type"], sms["sms"], sms["phone"]) for sms in parcel["parcels"]],
+                         [("sms", "WAKE", "+358400000000"), ("sms", "WAKE", "+358400000001")])
+        self.assertTrue(await communicator.receive_nothing())
+
+        with mock.patch.object(smsgateway.gateway_acks, "inc") as acks:
+            await communicator.send_to(bytes_data=self.encrypt({"type": "ack", "acks": [
+                {"id": parcel["parcels"][0]["id"], "status": "sent"},
+                {"id": parcel["parcels"][1]["id"], "status": "failed", "error": "No network"},
+                {"id": "unknown", "status": "sent"},
+            ]}))
+            # parcels which don't decrypt are ignored
+            await communicator.send_to(bytes_data=os.urandom(48))
+            await communicator.send_to(text_data="ping")
+            self.assertEqual(await communicator.receive_from(), "pong")
+        self.assertEqual([call.kwargs["status"] for call in acks.call_args_list], ["sent", "failed"])
+        await communicator.disconnect()
+
+    async def test_unbatched_relay(self):
+        communicator = await self.connect("/ws/smsgateway/", headers=[(b"x-device-id", b"phone1")])
+        provider = await sync_to_async(get_provider)("smsgateway")
+        await sync_to_async(provider.send_batch)([(bytes.fromhex("0102"), car.sms_config) for car in self.cars])
+        # Apps without batch support get one parcel per message
+        for i in range(2):
+            parcel = self.decrypt(await communicator.receive_from())
+            self.assertEqual((parcel["type"], parcel["data"], parcel["phone"]), ("pdu", "0102", f"+35840000000{i}"))
+        await communicator.disconnect()
+
+    async def test_previous_relay_messages(self):
+        communicator = await self.connect("/ws/smsgateway/?device_id=phone1&batch=1")
+        await get_channel_layer().group_send(smsgateway.gateway_group("phone1"), {
+            "type": "relay_sms", "sms": "WAKE", "phone": "+358400000000"})
+        parcel = self.decrypt(await communicator.receive_from())
+        self.assertEqual((parcel["type"], parcel["sms"], parcel["phone"]), ("sms", "WAKE", "+358400000000"))
+        self.assertIn("id", parcel)
+        await communicator.disconnect()
+
+    @override_settings(SMS_PROVIDERS={"smsgateway": ("SMS gateway", "tculink.sms.smsgateway.ProviderSMSGateway")})
+    def test_dispatched_batches(self):
+        cars = []
+        for i in range(5):
+            car = FakeSMSCar(f"gateway{i}", "smsgateway")
+            car.sms_config.update(device_id="phone1" if i < 3 else "phone2", encryption_key=self.KEY.hex(),
+                                  phone=f"+35840000000{i}")
+            cars.append(car)
+        channel_layer = mock.Mock(group_send=mock.AsyncMock(return_value=None))
+        with mock.patch.object(smsgateway, "get_channel_layer", return_value=channel_layer):
+            report = sms_dispatch.CommandDispatcher(max_workers=4).dispatch([(car, 1, None) for car in cars],
+                                                                            max_wait=1)
+
+        self.assertEqual(report.dispatched, 5)
+        # One frame per device with all of its messages
+        frames = {call.args[0]: call.args[1] for call in channel_layer.group_send.call_args_list}
+        self.assertEqual(channel_layer.group_send.call_count, 2)
+        self.assertEqual({group: (frame["type"], [parcel["phone"] for parcel in frame["parcels"]])
+                          for group, frame in frames.items()},
+                         {"sms_phone1": ("relay_parcels", ["+358400000000", "+358400000001", "+358400000002"]),
+                          "sms_phone2": ("relay_parcels", ["+358400000003", "+358400000004"])})
+
+    async def test_previous_version_events(self):
+        communicator = await self.connect("/ws/smsgateway/?device_id=phone1&batch=1")
+        provider = await sync_to_async(get_provider)("smsgateway")
+        # relay_sms and relay_pdu events during a rolling upgrade, one per message
+        with override_settings(SMS_GATEWAY_RELAY_PARCELS=False):
+            await sync_to_async(provider.send_batch)([("WAKE", self.cars[0].sms_config),
+                                                      (bytes.fromhex("0102"), self.cars[1].sms_config)])
+        first = self.decrypt(await communicator.receive_from())
+        second = self.decrypt(await communicator.receive_from())
+        self.assertEqual((first["type"], first["sms"]), ("sms", "WAKE"))
+        self.assertEqual((second["type"], second["data"]), ("pdu", "0102"))
+        await communicator.disconnect()
+
+    async def test_unknown_device(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/smsgateway/?device_id=phone2")
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+
+@override_settings(CACHES=TEST_CACHES, METRICS_FLUSH_INTERVAL=0)
+class CarwingsGatewayTests(TestCase):
+
+    async def test_upstream_client(self):
+        async def chargers(request):
+            return web.json_response({"result": [{"id": 1}], "lat": request.query["lat"]})
+
+        app = web.Application()
+        app.router.add_get("/chargers", chargers)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            url = str(server.make_url("/chargers"))
+            response = await upstream.get(url, "test", params={"lat": "60.1"})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), {"result": [{"id": 1}], "lat": "60.1"})
+            # Connections of the event loop are pooled
+            self.assertIs(upstream.get_session(), upstream.get_session())
+
+            # Sync code waits for the shared background loop
+            response = await sync_to_async(upstream.request_sync)("GET", url, "test", params={"lat": "61"})
+            self.assertEqual(response.json()["lat"], "61")
+        finally:
+            await upstream.close()
+            await server.close()
+
+    async def test_upstream_sessions_closed(self):
+        session = upstream.get_session()
+        messages = asyncio.Queue()
+        for message in ({"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}):
+            messages.put_nowait(message)
+        sent = []
+
+        async def send(message):
+            sent.append(message["type"])
+
+        from carwings.asgi import application
+        await application({"type": "lifespan"}, messages.get, send)
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+        self.assertTrue(session.closed)
+
+        # Sessions of closed loops are dropped instead of reused
+        async def get_session():
+            return upstream.get_session()
+
+        def get_stale_session():
+            stale_loop = asyncio.new_event_loop()
+            stale_session = stale_loop.run_until_complete(get_session())
+            stale_loop.close()
+            return stale_loop, stale_session
+
+        loop, stale = await sync_to_async(get_stale_session, thread_sensitive=False)()
+        self.assertIsNot(upstream.get_session(), stale)
+        self.assertTrue(stale.closed)
+        self.assertNotIn(loop, upstream._sessions)
+        await upstream.close()
+
+    async def test_concurrent_chargepoint_info(self):
+        active = 0
+        peak = 0
+
+        async def get(url, service, params=None, **kwargs):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.05)
+            active -= 1
+            return upstream.UpstreamResponse(200, b"[]")
+
+        charger_ids = b"".join(i.to_bytes(4, "big") for i in range(300))
+        request = bytes(4) + (276).to_bytes(2, "big") + (300).to_bytes(4, "big") + charger_ids
+        xml_data = {"service_info": {"application": {"send_data": [{"id_type": "file", "id": "CPREQ"}]}}}
+        with mock.patch.object(upstream, "get", side_effect=get) as upstream_get:
+            response = await handle_cp(xml_data, [{"name": "CPREQ", "content": request}])
+        self.assertIsNotNone(response)
+        # Two chunks of 150 chargers, requested at the same time
+        self.assertEqual(upstream_get.call_count, 2)
+        self.assertEqual(peak, 2)
+
+    async def test_gls_thumbnail(self):
+        image = io.BytesIO()
+        Image.new("RGB", (200, 100)).save(image, format="JPEG")
+        query = b"type=GLS3&url=https://example.com/photo.jpg&width=40&height=30"
+        request = bytes(4) + (0x301).to_bytes(2, "big") + len(query).to_bytes(2, "big") + query
+        xml_data = {"service_info": {"application": {"send_data": [{"id_type": "file", "id": "GLSREQ"}]}}}
+        make_thumbnail = gls.make_thumbnail
+
+        def thumbnail_off_loop(*args):
+            # Image processing must not run on the event loop
+            with self.assertRaises(RuntimeError):
+                asyncio.get_running_loop()
+            return make_thumbnail(*args)
+
+        with mock.patch.object(upstream, "get", return_value=upstream.UpstreamResponse(200, image.getvalue())), \
+                mock.patch.object(gls, "make_thumbnail", side_effect=thumbnail_off_loop) as thumbnail:
+            response = await gls.handle_gls(xml_data, [{"name": "GLSREQ", "content": request}])
+        self.assertIsNotNone(response)
+        thumbnail.assert_called_once_with(image.getvalue(), 40, 30)
+        self.assertEqual(Image.open(io.BytesIO(make_thumbnail(image.getvalue(), 40, 30))).size, (40, 20))
+
+    async def test_app_dispatch(self):
+        def sync_handler(xml_data, files):
+            # Database handlers must not run on the event loop
+            with self.assertRaises(RuntimeError):
+                asyncio.get_running_loop()
+            return b"response"
+
+        with mock.patch.dict(tculink_views.CARWINGS_APPS, {"XX": sync_handler}):
+            self.assertEqual(await tculink_views.handle_carwings_app("XX", {}, []), b"response")
+        self.assertIsNone(await tculink_views.handle_carwings_app("UNKNOWN", {}, []))
+
+    def test_gateway_headers(self):
+        response = self.client.post("/WARCondelivbas/it-m_gw10/", b"data", content_type="application/octet-stream")
+        self.assertEqual(response.status_code, 302)
+
+
+class ParserBenchmarkTests(TestCase):
+
+    def test_all_cases_run(self):
+        results = benchmark.run_benchmarks(min_time=0.001, rounds=1)
+        self.assertEqual(list(results), list(benchmark.benchmark_cases()))
+        for result in results.values():
+            self.assertGreater(result["ops"], 0)
+            self.assertGreaterEqual(result["peak_bytes"], 0)
+
+    def test_baseline_regressions(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "baseline.json")
+        benchmark.save_baseline(path, {"gdc.parse_data": {"ops": 1000.0, "peak_bytes": 100},
+                                       "probe.parse_dot": {"ops": 1000.0, "peak_bytes": 100}})
+        baseline = benchmark.load_baseline(path)
+        results = {"gdc.parse_data": {"ops": 850.0, "peak_bytes": 100},
+                   "probe.parse_dot": {"ops": 700.0, "peak_bytes": 100},
+                   "autodj.build_payload": {"ops": 1.0, "peak_bytes": 100}}
+        self.assertEqual(benchmark.find_regressions(results, baseline, 0.2), [("probe.parse_dot", 1000.0, 700.0)])
+
+        stdout = io.StringIO()
+        call_command("tcubenchmark", "gdc.parse_data", min_time=0.001, rounds=1, save=path, stdout=stdout)
+        self.assertIn("gdc.parse_data", stdout.getvalue())
+        self.assertEqual(list(benchmark.load_baseline(path)), ["gdc.parse_data"])
+
+
 class AutoDJImageGenerationTests(TestCase):
 
     def test_consumption(self):
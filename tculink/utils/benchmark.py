@@ -0,0 +1,305 @@
+"""
+Benchmarks of the wire format parsers and builders, run with `manage.py tcubenchmark`.
+
+GDC cases use the packets recorded in tculink.gdc_proto.samples. No Ficosa, CARWINGS or probe
+recordings are kept in the tree, those fixtures are composed deterministically with the
+encoders of the protocols so every run measures the same bytes.
+
+Every case reports operations per second (best of several timed rounds) and the peak memory
+allocated by one operation. Results can be saved as a JSON baseline and later runs compared to
+it, cases slower than the baseline by more than a threshold are reported as regressions.
+"""
+import datetime
+import gc
+import json
+import logging
+import platform
+import time
+import tracemalloc
+
+from tculink.carwings_proto.autodj import NOT_FOUND_AUTODJ_ITEM
+from tculink.carwings_proto.databuffer import construct_carwings_filepacket, compress_carwings, decompress_body, \
+    parse_carwings_files
+from tculink.carwings_proto.dataobjects import build_autodj_payload
+from tculink.carwings_proto.probe_crm import parse_crmfile
+from tculink.carwings_proto.probe_dot import parse_dotfile
+from tculink.carwings_proto.xml import parse_carwings_xml
+from tculink.gdc_proto.acp245 import composer
+from tculink.gdc_proto.decoder import decode_gdc_packet
+from tculink.gdc_proto.ficosa import acp as ficosa_acp
+from tculink.gdc_proto.parser import parse_gdc_packet
+from tculink.gdc_proto.samples import sample_packet, SAMPLE_DATA, SAMPLE_CONFIG
+
+BASELINE_VERSION = 1
+# compress_carwings prefixes responses with resume_id:<20 bytes>, requests arrive without it
+RESUME_ID_LENGTH = len(b"resume_id:") + 20
+
+FIXTURE_VIN = "SJNFAAZE0U6000000"
+FIXTURE_TIME = datetime.datetime(2024, 5, 17, 8, 30, 15)
+
+FIXTURE_XML = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<carwings version="2.2">
+<aut_inf navi_id="100200005035" tel="" dcm_id="201300026078" sim_id="8935806230914578495" vin="SJNFAAZE0U6000000" user_id="benchmark" password="benchmark"/>
+<bs_inf>
+<sftwr_ver navi="B7121" map="EU2014" dcm="06.27"/>
+<vcl spd="0" drc="270" sts="parking" rss="-71" odo="51234" dst="12" crr="24407" e_mlg="146">
+<crd datum="wgs84" lat="60.1699" lon="24.9384"/>
+</vcl>
+<navi_set t_zone="GMT+02:00" lang="eng" dst_d="km" tmp_d="C" e_mlg_d="km/kWh" spd_d="km/h"/>
+</bs_inf>
+<srv_inf>
+<app name="DJ">
+<send_data id_type="file" id="DJ_REQ.bin"/>
+<send_data id_type="file" id="PROBE.bin"/>
+</app>
+</srv_inf>
+<op_inf>
+<via_dst set_number="0" gid_sts="0"/>
+<rd_point full="0" max="200" usd_num="12"/>
+<tinf_cnd auto_cm="1" cm_intrvl="5" probe="1" vics="0" dynmc_cal="1" sts_inf="0"/>
+<app_id is="1"/>
+</op_inf>
+</carwings>
+"""
+
+
+def _timestamp(value):
+    return bytes([value.year - 2000, value.month, value.day, value.hour, value.minute, value.second])
+
+
+def _location(lat, lon):
+    # Inverse of parse_std_location, 1/512 arc seconds
+    return round(lat * 3600 * 512).to_bytes(4, "big", signed=True) + \
+        round(lon * 3600 * 512).to_bytes(4, "big", signed=True)
+
+
+def build_crm_fixture(trips=20):
+    """Probe CRM file with the latest and lifetime records and a number of trips"""
+    data = bytearray(38)
+    data += bytes([0xE1]) + (12).to_bytes(2, "big")
+    data += bytes([0xE2]) + (40).to_bytes(2, "big")
+    data += bytes([0xEA]) + (51234).to_bytes(4, "big")
+    data += bytes([0xE6]) + (3600).to_bytes(4, "big")
+    data += bytes([0xE7]) + (7200).to_bytes(4, "big")
+    data += bytes([0xE8]) + (421).to_bytes(2, "big")
+    data += bytes([0xE9]) + (15000).to_bytes(4, "big") + (98000).to_bytes(4, "big")
+    data += bytes([0xEB]) + (86400).to_bytes(4, "big")
+    data += bytes([0xED]) + (5123400).to_bytes(4, "big")
+    for trip in range(trips):
+        start = FIXTURE_TIME + datetime.timedelta(hours=trip)
+        data += bytes([0x80]) + _timestamp(start) + b"\x00"
+        data += bytes([0x81]) + _timestamp(start + datetime.timedelta(minutes=25)) + b"\x00"
+        data += bytes([0x82]) + _location(60.1699, 24.9384)
+        data += bytes([0x83]) + _location(60.2055, 24.6559)
+        data += bytes([0x85]) + (18500 + trip).to_bytes(4, "big")
+        for label in (0x86, 0x87, 0x88, 0x89, 0x8A, 0x8B, 0x8C):
+            data += bytes([label]) + (trip % 7).to_bytes(2, "big")
+        data += bytes([0x90, 18, 0x91, 21])
+        data += bytes([0x92]) + (1500).to_bytes(2, "big")
+        data += bytes([0x95]) + b"".join(value.to_bytes(4, "big") for value in (320, 150, 80, 2900))
+        data += bytes([0x96]) + (0).to_bytes(2, "big")
+        data += bytes([0x97, 3])
+        data += bytes([0x98]) + (51000 + trip).to_bytes(4, "big")
+        data += bytes([0x9A]) + (1123).to_bytes(2, "big")
+    return bytes(data)
+
+
+def build_dot_fixture(points=50):
+    """Probe DOT file with an absolute first point followed by relative points"""
+    data = bytearray()
+    data += bytes([0x02, 0x01])
+    data += bytes([0x03, 0x00, 0x01])
+    data += bytes([0x04]) + b"EU2014".ljust(32, b"\x00")
+    data += bytes([0x05]) + _timestamp(FIXTURE_TIME)
+    data += bytes([0x06]) + _location(60.1699, 24.9384) + b"\x00"
+    data += bytes([0x07]) + (2700).to_bytes(3, "big")
+    data += bytes([0x08]) + (450).to_bytes(3, "big")
+    data += bytes([0x09]) + (12).to_bytes(3, "big")
+    data += bytes([0x0C]) + _location(60.1699, 24.9384)
+    data += bytes([0x0D]) + (2700).to_bytes(2, "big")
+    data += bytes([0x0E]) + (450).to_bytes(2, "big")
+    data += bytes([0x0F]) + (512340).to_bytes(4, "big")
+    data += bytes([0x10, 0x30, 0x11, 0x30, 0x12, 0b110])
+    data += bytes([0x40]) + (4500).to_bytes(3, "big")
+    for point in range(points):
+        data += bytes([0x25, point % 60])
+        data += bytes([0x0A]) + _location(60.1699 + point / 10000, 24.9384 + point / 10000)
+        data += bytes([0x0B]) + (2700 + point).to_bytes(2, "big")
+        data += bytes([0x0C]) + _location(60.1699 + point / 10000, 24.9384 + point / 10000)
+        data += bytes([0x0E]) + (450 + point).to_bytes(2, "big")
+        data += bytes([0x12, 0b101])
+        data += bytes([0x40]) + (4500 + point).to_bytes(3, "big")
+    return bytes(data)
+
+
+def build_carwings_fixture():
+    """Compressed CARWINGS request body with the XML and two binary files"""
+    files = [
+        ("carwings.xml", FIXTURE_XML.encode("utf-8")),
+        ("DJ_REQ.bin", bytes(range(256)) * 4),
+        ("PROBE.bin", build_crm_fixture()),
+    ]
+    return bytes(compress_carwings(bytes(construct_carwings_filepacket(files)))[RESUME_ID_LENGTH:])
+
+
+def _gps_ie():
+    # Flags, latitude and longitude as degrees, minutes and seconds * 100
+    return composer._encode_ie(bytes([0x80, 60, 10, 0x04, 0xD2, 24, 56, 0x10, 0xE1]), ie_id=0)
+
+
+def build_ficosa_auth_fixture():
+    """Ficosa authentication request as sent by the TCU on every connection"""
+    body = bytearray()
+    body += composer.VersionFicosa(sw_version=3, hw_1=1, hw_2=2, hw_3=0).encode()
+    body += composer.VehDesc(vin=FIXTURE_VIN, dcm="201300026078", imei_msn="356938035643809",
+                             sim_id="89358062309145784950", vehicle_type="ZE1A").encode()
+    body += bytes([0x01, 0x2A])
+    body += composer.Timestamp(FIXTURE_TIME).encode()
+    body += composer.Auth("benchmark", "benchmark").encode()
+    body += _gps_ie()
+    return composer.AppHeader(app_id=0x1D, mcf=2, length=len(body), special_flag=1).encode() + bytes(body)
+
+
+def build_ficosa_evinfo_fixture():
+    """Ficosa EV info element of a ZE1 car, 24 bytes including the cabin temperature"""
+    return composer._encode_ie(bytes([
+        0x4B, 0x20, 0x48, 0x2C, 0x08, 0x78, 0xC5, 0x4C, 0xA0, 0x60, 0xA0, 0x48,
+        0x00, 0xC0, 0x21, 0x02, 0x00, 0x02, 0x60, 0x2D, 0x41, 0x90, 0x00, 0x70,
+    ]), ie_id=0)
+
+
+def build_autodj_kwargs():
+    """Arguments of an AutoDJ response with an item and a 20 kB image"""
+    items = [dict(NOT_FOUND_AUTODJ_ITEM[0], imageDataField=bytes(range(256)) * 80)]
+    return {
+        "message_type": 0,
+        "channel_id": 0x1234,
+        "adj_items": items,
+        "footer": {"type": 6, "data": b"\x01"},
+        "extra_fields": {
+            "stringField1": "Benchmark",
+            "stringField2": "Benchmark channel",
+            "mode0_processedFieldCntPos": 1,
+            "mode0_countOfSomeItems3": 1,
+            "countOfSomeItems": 1,
+        },
+    }
+
+
+def benchmark_cases():
+    """Benchmarked operations as {name: callable}, fixtures are built once"""
+    data_packet = sample_packet(SAMPLE_DATA)
+    config_packet = sample_packet(SAMPLE_CONFIG)
+    carwings_body = build_carwings_fixture()
+    carwings_files = decompress_body(carwings_body)
+    crm_file = build_crm_fixture()
+    dot_file = build_dot_fixture()
+    ficosa_auth = build_ficosa_auth_fixture()
+    ficosa_evinfo = build_ficosa_evinfo_fixture()
+    autodj_kwargs = build_autodj_kwargs()
+
+    return {
+        "gdc.parse_data": lambda: parse_gdc_packet(data_packet),
+        "gdc.parse_config": lambda: parse_gdc_packet(config_packet),
+        "gdc.decode_data": lambda: decode_gdc_packet(data_packet),
+        "ficosa.parse_auth": lambda: ficosa_acp.parse_auth_ev_pload(ficosa_auth),
+        "ficosa.parse_ev_info": lambda: ficosa_acp.parse_ev_info(ficosa_evinfo, 0),
+        "carwings.decompress_body": lambda: decompress_body(carwings_body),
+        "carwings.parse_files": lambda: parse_carwings_files(carwings_files),
+        "carwings.parse_xml": lambda: parse_carwings_xml(FIXTURE_XML),
+        "probe.parse_crm": lambda: parse_crmfile(crm_file),
+        "probe.parse_dot": lambda: parse_dotfile(dot_file),
+        "autodj.build_payload": lambda: build_autodj_payload(**autodj_kwargs),
+    }
+
+
+def measure(operation, min_time=0.2, rounds=5):
+    """Operations per second (best round) and peak bytes allocated by one operation"""
+    operation()
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            operation()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time / 10:
+            break
+        number *= 2
+    number = max(int(number * (min_time / elapsed)), 1)
+
+    best = None
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            started = time.perf_counter()
+            for _ in range(number):
+                operation()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        operation()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+    return {
+        "ops": number / best if best > 0 else float("inf"),
+        "peak_bytes": peak - baseline,
+    }
+
+
+def run_benchmarks(names=None, min_time=0.2, rounds=5):
+    """Results as {name: {"ops": ..., "peak_bytes": ...}}, names filters cases by substring"""
+    results = {}
+    # Parsers log every field at debug and info level, logging is measured elsewhere
+    logging.disable(logging.CRITICAL)
+    try:
+        for name, operation in benchmark_cases().items():
+            if names and not any(filter_name in name for filter_name in names):
+                continue
+            results[name] = measure(operation, min_time=min_time, rounds=rounds)
+    finally:
+        logging.disable(logging.NOTSET)
+    return results
+
+
+def save_baseline(path, results):
+    with open(path, "w") as file:
+        json.dump({
+            "version": BASELINE_VERSION,
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }, file, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path) as file:
+        baseline = json.load(file)
+    if baseline.get("version") != BASELINE_VERSION:
+        raise ValueError(f"Unsupported baseline version {baseline.get('version')}")
+    return baseline["results"]
+
+
+def find_regressions(results, baseline, threshold=0.2):
+    """Cases slower than the baseline by more than threshold, as [(name, baseline ops, ops)]"""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if result["ops"] < previous["ops"] * (1 - threshold):
+            regressions.append((name, previous["ops"], result["ops"]))
+    return regressions
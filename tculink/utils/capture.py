@@ -0,0 +1,234 @@
+"""
+Capture of unparseable and debug payloads to disk.
+
+Request handlers and the TCU server hand payloads to capture(), which only queues them.
+A background thread writes them under logs/<category>/, skipping payloads already captured
+recently, and deletes the oldest captures when the size or count quota is exceeded. With
+CAPTURE_COMPRESS the payloads are appended to compressed capture files instead of being
+written one file each, read them back with read_capture_file(). The open files count against the
+size quota and are closed for rotation once it is exceeded.
+
+Quotas are enforced per process, captures of other processes found on startup are included.
+"""
+import atexit
+import collections
+import gzip
+import hashlib
+import logging
+import os
+import queue
+import struct
+import threading
+from datetime import datetime
+
+from django.conf import settings
+
+from tculink.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_DIR = "logs"
+CATEGORIES = ("datalog", "dj", "probe", "probev2")
+ARCHIVE_SUFFIX = ".capture.gz"
+# Recently written payload hashes kept for deduplication
+DEDUP_SIZE = 10000
+
+captures = metrics.Counter("opencarwings_captures_total", "Captured debug payloads", ("category", "result"))
+
+
+def read_capture_file(path):
+    """Yield (name, data) of every payload in a compressed capture file"""
+    with gzip.open(path, "rb") as file:
+        while True:
+            header = file.read(4)
+            if len(header) < 4:
+                return
+            name = file.read(struct.unpack(">I", header)[0]).decode("utf-8")
+            size = struct.unpack(">I", file.read(4))[0]
+            yield name, file.read(size)
+
+
+def _safe_parts(name):
+    # Names contain values sent by the car, never allow them to leave the capture directory
+    return [part for part in name.replace("\\", "/").split("/") if part not in ("", ".", "..")]
+
+
+class CaptureSink:
+
+    def __init__(self, base_dir=CAPTURE_DIR, max_bytes=None, max_files=None, queue_size=None, compress=None,
+                 segment_bytes=None):
+        self.base_dir = base_dir
+        self.max_bytes = max_bytes if max_bytes is not None else getattr(settings, "CAPTURE_MAX_BYTES", 256 * 1024 * 1024)
+        self.max_files = max_files if max_files is not None else getattr(settings, "CAPTURE_MAX_FILES", 10000)
+        self.queue_size = queue_size if queue_size is not None else getattr(settings, "CAPTURE_QUEUE_SIZE", 1000)
+        self.compress = compress if compress is not None else getattr(settings, "CAPTURE_COMPRESS", False)
+        self.segment_bytes = segment_bytes if segment_bytes is not None else \
+            getattr(settings, "CAPTURE_SEGMENT_BYTES", 16 * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._queue = queue.Queue(self.queue_size)
+        self._writer = None
+        # Written files oldest first as (path, size), total size of them
+        self._inventory = None
+        self._total_bytes = 0
+        self._recent = collections.OrderedDict()
+        self._archives = {}
+
+    def capture(self, category, name, data):
+        """Queue a payload for writing, returns False if it was dropped because the queue is full"""
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait((category, name, bytes(data)))
+        except queue.Full:
+            captures.inc(category=category, result="dropped")
+            return False
+        return True
+
+    def flush(self, timeout=5):
+        """Wait until queued payloads are written"""
+        if self._writer is None:
+            return
+        done = threading.Event()
+        try:
+            self._queue.put((None, done, None), timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def _ensure_writer(self):
+        if self._writer is not None:
+            return
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name="capture-writer", daemon=True)
+                self._writer.start()
+
+    def _run(self):
+        while True:
+            category, name, data = self._queue.get()
+            if category is None:
+                for archive in self._archives.values():
+                    archive[0].flush()
+                name.set()
+                continue
+            try:
+                self._write(category, name, data)
+            except Exception as e:
+                logger.warning("Capturing %s/%s failed: %s", category, name, e)
+
+    def _write(self, category, name, data):
+        digest = hashlib.sha1(data).digest()
+        if digest in self._recent:
+            self._recent.move_to_end(digest)
+            captures.inc(category=category, result="duplicate")
+            return
+        self._recent[digest] = None
+        if len(self._recent) > DEDUP_SIZE:
+            self._recent.popitem(last=False)
+
+        if self._inventory is None:
+            self._load_inventory()
+
+        if self.compress:
+            self._append_archive(category, name, data)
+        else:
+            self._write_file(category, name, data, digest)
+        captures.inc(category=category, result="written")
+        self._enforce_quota()
+
+    def _write_file(self, category, name, data, digest):
+        parts = _safe_parts(name) or [digest.hex()]
+        directory = os.path.join(self.base_dir, category, *parts[:-1])
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, parts[-1])
+        if os.path.exists(path):
+            path = os.path.join(directory, f"dupl-{digest.hex()[:8]}-{parts[-1]}")
+        with open(path, "wb") as file:
+            file.write(data)
+        self._add_inventory(path, len(data))
+
+    def _append_archive(self, category, name, data):
+        archive = self._archives.get(category)
+        if archive is not None and archive[2] >= self.segment_bytes:
+            self._close_archive(category)
+            archive = None
+        if archive is None:
+            directory = os.path.join(self.base_dir, category)
+            os.makedirs(directory, exist_ok=True)
+            # Segments rotated within the same second must not share a file
+            path = os.path.join(directory, f"capture-{datetime.now().strftime('%Y%m%d%H%M%S%f')}-{os.getpid()}"
+                                           f"{ARCHIVE_SUFFIX}")
+            archive = self._archives[category] = [gzip.open(path, "ab"), path, 0]
+
+        encoded_name = "/".join(_safe_parts(name)).encode("utf-8")
+        record = struct.pack(">I", len(encoded_name)) + encoded_name + struct.pack(">I", len(data)) + data
+        archive[0].write(record)
+        archive[2] += len(record)
+
+    def _close_archive(self, category):
+        """Close the open segment of a category, it is rotated like any other capture file from now on"""
+        archive = self._archives.pop(category)
+        archive[0].close()
+        self._add_inventory(archive[1], os.path.getsize(archive[1]))
+
+    def _open_archive_bytes(self):
+        # Compressed bytes written to the open segments so far, the compressor may hold back some more
+        return sum(archive[0].fileobj.tell() for archive in self._archives.values())
+
+    def _load_inventory(self):
+        files = []
+        for category in CATEGORIES:
+            for root, _, filenames in os.walk(os.path.join(self.base_dir, category)):
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, path, stat.st_size))
+        files.sort()
+        self._inventory = collections.deque((path, size) for _, path, size in files)
+        self._total_bytes = sum(size for _, size in self._inventory)
+
+    def _add_inventory(self, path, size):
+        self._inventory.append((path, size))
+        self._total_bytes += size
+
+    def _enforce_quota(self):
+        if self._archives and self._total_bytes + self._open_archive_bytes() > self.max_bytes:
+            for category in list(self._archives):
+                self._close_archive(category)
+        while self._inventory and (self._total_bytes > self.max_bytes or len(self._inventory) > self.max_files):
+            path, size = self._inventory.popleft()
+            self._total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            # Remove directories left empty by rotation, up to the category directory
+            directory = os.path.dirname(path)
+            while os.path.dirname(directory) != self.base_dir:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+
+    def close(self):
+        self.flush()
+        for category in list(self._archives):
+            self._close_archive(category)
+        if self._inventory is not None:
+            self._enforce_quota()
+
+
+default_sink = CaptureSink()
+atexit.register(default_sink.close)
+
+
+def capture(category, name, data):
+    """Write a payload to logs/<category>/<name> in the background"""
+    return default_sink.capture(category, name, data)
@@ -0,0 +1,112 @@
+"""
+Leader election for processes of which only one may be active, like tcuscheduler
+
+On PostgreSQL a session advisory lock is held on the process' database connection, it is
+released by the server as soon as the connection closes. Other databases use a lease in the
+shared cache (Redis), renewed while the leader runs and taken over by another process when it
+expires. Work that may outlast the lease runs inside keep_alive(), which renews the lease from
+a thread.
+"""
+import logging
+import os
+import socket
+import threading
+import zlib
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY_PREFIX = "leader:"
+
+
+def _owner_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class CacheLeaderLock:
+    """Lease in the shared cache, lost when not renewed within `ttl` seconds"""
+
+    def __init__(self, name, ttl):
+        self.key = CACHE_KEY_PREFIX + name
+        self.ttl = ttl
+        self.owner = _owner_id()
+
+    def acquire(self):
+        """Take or renew the lease, returns True while this process is the leader"""
+        if cache.add(self.key, self.owner, self.ttl):
+            return True
+        return self.renew()
+
+    def renew(self):
+        """Extend the lease held by this process, returns False if it was lost"""
+        if cache.get(self.key) != self.owner:
+            return False
+        # Renewed well before expiry, another process can only take over a lease which expired
+        return cache.touch(self.key, self.ttl)
+
+    @contextmanager
+    def keep_alive(self):
+        """Renew the lease every third of `ttl` while the block runs"""
+        stopped = threading.Event()
+
+        def heartbeat():
+            while not stopped.wait(self.ttl / 3):
+                try:
+                    if not self.renew():
+                        logger.warning("Lease %s was lost while the leader was running", self.key)
+                except Exception as e:
+                    logger.warning("Renewing lease %s failed: %s", self.key, e)
+
+        thread = threading.Thread(target=heartbeat, name="leader-heartbeat", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def release(self):
+        if cache.get(self.key) == self.owner:
+            cache.delete(self.key)
+
+
+class PostgresLeaderLock:
+    """Session advisory lock on the database connection of this process"""
+
+    def __init__(self, name):
+        # Keys below 2^31 end up in pg_locks.objid with classid 0
+        self.lock_id = zlib.crc32(name.encode()) & 0x7FFFFFFF
+        self.held = False
+
+    def acquire(self):
+        with connection.cursor() as cursor:
+            if self.held:
+                # The lock is gone if the connection was reopened since the last call
+                cursor.execute(
+                    "SELECT 1 FROM pg_locks WHERE locktype = 'advisory' AND classid = 0 AND objid = %s "
+                    "AND pid = pg_backend_pid() AND granted", [self.lock_id])
+                self.held = cursor.fetchone() is not None
+            if not self.held:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", [self.lock_id])
+                self.held = cursor.fetchone()[0]
+        return self.held
+
+    @contextmanager
+    def keep_alive(self):
+        # Held as long as the connection, nothing to renew
+        yield
+
+    def release(self):
+        if self.held:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [self.lock_id])
+            self.held = False
+
+
+def get_leader_lock(name, ttl):
+    if connection.vendor == "postgresql":
+        return PostgresLeaderLock(name)
+    return CacheLeaderLock(name, ttl)
@@ -0,0 +1,336 @@
+"""
+Metrics of the TCU server, the HTTP gateways and outbound API calls, exported in the
+Prometheus text format.
+
+Values are recorded in the memory of each process, recording is a dict update under a lock.
+A background thread flushes the changes every METRICS_FLUSH_INTERVAL seconds to the shared
+cache: counters and histograms are added with atomic increments so values of restarted
+workers and short-lived commands are kept, gauges are stored per process with an expiry.
+The scrape endpoint merges everything found in the cache.
+"""
+import atexit
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+INDEX_KEY = "metrics_index"
+INSTANCES_KEY = "metrics_instances"
+SERIES_KEY_PREFIX = "metrics_series_"
+GAUGES_KEY_PREFIX = "metrics_gauges_"
+# Histogram sums are stored as integer microseconds, cache increments only support integers
+SUM_SCALE = 1000000
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _flush_interval():
+    return getattr(settings, "METRICS_FLUSH_INTERVAL", 15)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def series_name(name, labels):
+    """Prometheus series name, labels is a sequence of (name, value) pairs"""
+    labels = list(labels)
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{label}="{_escape(value)}"' for label, value in labels) + "}"
+
+
+def _series_key(series):
+    return SERIES_KEY_PREFIX + hashlib.sha1(series.encode("utf-8")).hexdigest()
+
+
+def _format_value(value):
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry if registry is not None else REGISTRY
+        self.registry.register(self)
+
+    def _labels(self, labels):
+        # Missing labels are exported empty, a typo must not break the code being measured
+        return tuple(labels.get(label, "") for label in self.labelnames)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        self.registry.add(self.name, self._labels(labels), amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        self.registry.add_gauge(self.name, self._labels(labels), amount)
+
+    def dec(self, amount=1, **labels):
+        self.registry.add_gauge(self.name, self._labels(labels), -amount)
+
+    def set(self, value, **labels):
+        self.registry.set_gauge(self.name, self._labels(labels), value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        self.registry.observe(self, self._labels(labels), value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """Drop values copied from the parent process, they are flushed by the parent"""
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        # Series written by this process, kept in the index of the shared cache
+        self._written = {}
+        self._flusher = None
+        self.instance = f"{socket.gethostname()}-{os.getpid()}"
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+
+    def add(self, name, labels, amount):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+        self._ensure_flusher()
+
+    def observe(self, histogram, labels, value):
+        key = (histogram.name, labels)
+        slot = bisect.bisect_left(histogram.buckets, value)
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                # Bucket counts (last one is +Inf) followed by the sum
+                values = self._histograms[key] = [0] * (len(histogram.buckets) + 1) + [0.0]
+            values[slot] += 1
+            values[-1] += value
+        self._ensure_flusher()
+
+    def add_gauge(self, name, labels, amount):
+        key = (name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + amount
+        self._ensure_flusher()
+
+    def set_gauge(self, name, labels, value):
+        with self._lock:
+            self._gauges[(name, labels)] = value
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        if self._flusher is not None or not _flush_interval():
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(_flush_interval())
+            self.flush()
+
+    def _series_updates(self, counters, histograms):
+        """Changed series as {series: (metric name, increment)}"""
+        updates = {}
+        for (name, labels), amount in counters.items():
+            metric = self.metrics[name]
+            updates[series_name(name, zip(metric.labelnames, labels))] = (name, amount)
+
+        for (name, labels), values in histograms.items():
+            metric = self.metrics[name]
+            label_pairs = list(zip(metric.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ("+Inf",), values[:-1]):
+                cumulative += count
+                updates[series_name(name + "_bucket", label_pairs + [("le", bound)])] = (name, cumulative)
+            updates[series_name(name + "_count", label_pairs)] = (name, cumulative)
+            updates[series_name(name + "_sum", label_pairs)] = (name, round(values[-1] * SUM_SCALE))
+        return updates
+
+    def flush(self):
+        """Write recorded values to the shared cache, kept locally if the cache is unavailable"""
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            histograms, self._histograms = self._histograms, {}
+            gauges = dict(self._gauges)
+
+        updates = self._series_updates(counters, histograms)
+        incrementing = False
+        try:
+            for series, (name, _) in updates.items():
+                self._written[series] = name
+            if self._written:
+                index = cache.get(INDEX_KEY) or {}
+                missing = {series: name for series, name in self._written.items() if series not in index}
+                if missing:
+                    # Concurrent writers may drop each others additions, they are added again on next flush
+                    index.update(missing)
+                    cache.set(INDEX_KEY, index, None)
+            incrementing = True
+            for series, (_, amount) in updates.items():
+                self._increment(_series_key(series), amount)
+            if gauges:
+                self._flush_gauges(gauges)
+        except Exception as e:
+            logger.warning("Flushing metrics failed: %s", e)
+            # Values already added to the cache must not be added twice, the rest is lost
+            if not incrementing:
+                self._restore(counters, histograms)
+
+    @staticmethod
+    def _increment(key, amount):
+        if not amount:
+            return
+        try:
+            cache.incr(key, amount)
+        except ValueError:
+            # First write of the series, another process may have created it meanwhile
+            if not cache.add(key, amount, None):
+                cache.incr(key, amount)
+
+    def _flush_gauges(self, gauges):
+        ttl = max(_flush_interval() * 3, 60)
+        snapshot = {}
+        for (name, labels), value in gauges.items():
+            metric = self.metrics[name]
+            snapshot[series_name(name, zip(metric.labelnames, labels))] = (name, value)
+        cache.set(GAUGES_KEY_PREFIX + self.instance, snapshot, ttl)
+        instances = cache.get(INSTANCES_KEY) or []
+        if self.instance not in instances:
+            cache.set(INSTANCES_KEY, instances + [self.instance], None)
+
+    def _restore(self, counters, histograms):
+        with self._lock:
+            for key, amount in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + amount
+            for key, values in histograms.items():
+                current = self._histograms.get(key)
+                if current is None:
+                    self._histograms[key] = values
+                else:
+                    self._histograms[key] = [a + b for a, b in zip(current, values)]
+
+    def collect(self):
+        """Merged values of all processes as {metric name: {series: value}}"""
+        collected = {}
+        index = cache.get(INDEX_KEY) or {}
+        keys = {_series_key(series): series for series in index}
+        for key, value in cache.get_many(list(keys)).items():
+            series = keys[key]
+            name = index[series]
+            metric = self.metrics.get(name)
+            if metric is not None and metric.kind == "histogram" and series.startswith(name + "_sum"):
+                value = value / SUM_SCALE
+            collected.setdefault(name, {})[series] = value
+
+        instances = cache.get(INSTANCES_KEY) or []
+        snapshots = cache.get_many([GAUGES_KEY_PREFIX + instance for instance in instances])
+        for snapshot in snapshots.values():
+            for series, (name, value) in snapshot.items():
+                values = collected.setdefault(name, {})
+                values[series] = values.get(series, 0) + value
+        live = [instance for instance in instances if GAUGES_KEY_PREFIX + instance in snapshots]
+        if len(live) != len(instances):
+            cache.set(INSTANCES_KEY, live, None)
+        return collected
+
+    def render(self):
+        """Prometheus text exposition of all processes"""
+        lines = []
+        for name, values in sorted(self.collect().items()):
+            metric = self.metrics.get(name)
+            if metric is not None:
+                lines.append(f"# HELP {name} {metric.documentation}")
+                lines.append(f"# TYPE {name} {metric.kind}")
+            for series, value in values.items():
+                lines.append(f"{series} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+atexit.register(REGISTRY.flush)
+
+
+# Metrics of OpenCARWINGS
+
+packets = Counter("opencarwings_tcu_packets_total", "GDC packets received by the TCU server",
+                  ("message_type", "body_type"))
+gateway_requests = Counter("opencarwings_gateway_requests_total", "Requests received by the HTTP gateways",
+                           ("gateway", "app"))
+parse_seconds = Histogram("opencarwings_parse_seconds", "Time spent parsing TCU messages", ("protocol",))
+db_seconds = Histogram("opencarwings_db_seconds", "Time spent on database work of TCU messages, including waiting for a database thread", ("protocol",))
+response_seconds = Histogram("opencarwings_response_seconds", "Time spent building responses to TCU messages",
+                             ("protocol", "app"))
+active_connections = Gauge("opencarwings_tcu_active_connections", "Open TCU server connections")
+db_queue_depth = Gauge("opencarwings_tcu_db_queue_depth",
+                       "Packets queued or running on the database threads of the TCU server")
+auth_failures = Counter("opencarwings_auth_failures_total", "Rejected TCU messages", ("protocol", "reason"))
+commands = Counter("opencarwings_commands_total", "Remote commands by result", ("result",))
+outbound_seconds = Histogram("opencarwings_outbound_request_seconds", "Latency of calls to external services",
+                             ("service",))
+refresh_wakeups = Histogram("opencarwings_refresh_wakeups", "Cars woken for a periodic refresh per scheduler run",
+                            buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+refresh_deferred = Counter("opencarwings_refresh_deferred_total",
+                           "Due periodic refreshes deferred to a later run by the wake-up budget")
+outbound_errors = Counter("opencarwings_outbound_errors_total", "Failed calls to external services", ("service",))
+
+
+@contextmanager
+def track_outbound(service):
+    """Time a call to an external service, exceptions are counted as errors and raised"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        outbound_errors.inc(service=service)
+        raise
+    finally:
+        outbound_seconds.observe(time.perf_counter() - started, service=service)
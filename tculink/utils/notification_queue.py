@@ -0,0 +1,337 @@
+"""
+Background delivery of vehicle alert notifications.
+
+Packet handlers only call enqueue_vehicle_alert(), which never blocks: jobs are handed to a
+forwarder thread that pushes them to a Redis list. `manage.py notificationworker` takes jobs
+from the list and delivers them with a pool of concurrent tasks. Every job delivers a single
+channel (email or push) so a failing channel is retried without repeating the other one.
+Failed deliveries are retried with exponential backoff up to NOTIFICATION_MAX_ATTEMPTS times.
+
+Jobs taken by a worker are kept in its processing list until delivered, lists of workers that
+stopped sending heartbeats are moved back to the queue by the remaining workers.
+
+Without Redis, or while Redis can not be reached, jobs are delivered by a thread of the
+enqueuing process instead. Those jobs are lost if the process exits before delivery.
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from tculink.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = "notifications:queue"
+RETRY_KEY = "notifications:retry"
+FAILED_KEY = "notifications:failed"
+PROCESSING_KEY_PREFIX = "notifications:processing:"
+HEARTBEAT_KEY_PREFIX = "notifications:worker:"
+CHANNELS = ("email", "push")
+# Jobs waiting for the forwarder before new ones are dropped
+OUTBOX_SIZE = 10000
+# Failed jobs kept for inspection
+FAILED_KEEP = 1000
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TTL = 60
+
+notifications = metrics.Counter("opencarwings_notifications_total", "Vehicle alert notification jobs by result",
+                                ("channel", "result"))
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def redis_url():
+    """Redis holding the queue, NOTIFICATION_QUEUE_REDIS or the Redis of the default cache"""
+    url = _setting("NOTIFICATION_QUEUE_REDIS", None)
+    if url:
+        return url
+    cache_config = settings.CACHES.get("default", {})
+    if cache_config.get("BACKEND") == "django.core.cache.backends.redis.RedisCache":
+        location = cache_config.get("LOCATION")
+        return location[0] if isinstance(location, (list, tuple)) else location
+    return None
+
+
+def retry_delay(attempts):
+    """Seconds before the next attempt of a job which has failed `attempts` times"""
+    return min(_setting("NOTIFICATION_RETRY_DELAY", 30) * 2 ** (attempts - 1), 3600)
+
+
+def create_jobs(car, alert_message, subject):
+    now = time.time()
+    return [{
+        "id": str(uuid.uuid4()),
+        "channel": channel,
+        "car_id": car.pk,
+        "message": str(alert_message),
+        "subject": str(subject),
+        "attempts": 0,
+        "created": now,
+    } for channel in CHANNELS]
+
+
+async def deliver(job):
+    """Deliver a single job, exceptions are retried"""
+    from tculink.utils.notifications import get_alert_car, send_email_for_user, send_push_notification_for_user
+
+    car = await get_alert_car(job["car_id"])
+    if car is None:
+        logger.info("Car %s of notification %s no longer exists", job["car_id"], job["id"])
+        return
+    if job["channel"] == "email":
+        await send_email_for_user(car, car.owner, car.ev_info, car.location, job["message"], job["subject"])
+    elif job["channel"] == "push":
+        await send_push_notification_for_user(car, car.owner, job["message"], job["subject"])
+    else:
+        raise ValueError(f"Unknown notification channel {job['channel']}")
+
+
+async def deliver_with_retries(job):
+    """Deliver a job in this process, waiting between failed attempts"""
+    max_attempts = _setting("NOTIFICATION_MAX_ATTEMPTS", 5)
+    while True:
+        try:
+            await deliver(job)
+        except Exception as e:
+            job["attempts"] += 1
+            if job["attempts"] >= max_attempts:
+                logger.error("Delivering %s notification %s failed, giving up: %s", job["channel"], job["id"], e)
+                notifications.inc(channel=job["channel"], result="failed")
+                return
+            logger.warning("Delivering %s notification %s failed, retrying: %s", job["channel"], job["id"], e)
+            notifications.inc(channel=job["channel"], result="retried")
+            await asyncio.sleep(retry_delay(job["attempts"]))
+            continue
+        notifications.inc(channel=job["channel"], result="delivered")
+        return
+
+
+class LocalDelivery:
+    """Delivers jobs on an event loop of a background thread of this process"""
+
+    def __init__(self, concurrency):
+        self._loop = asyncio.new_event_loop()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="notification-delivery", daemon=True)
+        self._thread.start()
+
+    def submit(self, job):
+        with self._idle:
+            self._pending += 1
+        asyncio.run_coroutine_threadsafe(self._deliver(job), self._loop)
+
+    def wait_idle(self, timeout=None):
+        """Wait until all submitted jobs are delivered or given up, returns False on timeout"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    async def _deliver(self, job):
+        try:
+            async with self._slots:
+                await deliver_with_retries(job)
+        except Exception as e:
+            logger.error("Notification %s failed: %s", job["id"], e)
+        finally:
+            with self._idle:
+                self._pending -= 1
+                self._idle.notify_all()
+
+
+class NotificationDispatcher:
+    """Accepts jobs without blocking and forwards them to Redis, or to local delivery"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._outbox = queue.Queue(OUTBOX_SIZE)
+        self._forwarder = None
+        self._local = None
+        self._redis = None
+
+    def enqueue(self, jobs):
+        self._ensure_forwarder()
+        for job in jobs:
+            try:
+                self._outbox.put_nowait(job)
+            except queue.Full:
+                logger.error("Notification queue full, dropping %s notification %s", job["channel"], job["id"])
+                notifications.inc(channel=job["channel"], result="dropped")
+
+    def flush(self, timeout=10):
+        """Wait until enqueued jobs are forwarded, and delivered if they were delivered locally"""
+        if self._forwarder is None:
+            return
+        done = threading.Event()
+        self._outbox.put(done)
+        done.wait(timeout)
+        if self._local is not None:
+            self._local.wait_idle(timeout)
+
+    def _ensure_forwarder(self):
+        if self._forwarder is not None:
+            return
+        with self._lock:
+            if self._forwarder is None:
+                self._forwarder = threading.Thread(target=self._forward, name="notification-forwarder", daemon=True)
+                self._forwarder.start()
+
+    def _local_delivery(self):
+        if self._local is None:
+            self._local = LocalDelivery(_setting("NOTIFICATION_CONCURRENCY", 4))
+        return self._local
+
+    def _get_redis(self):
+        if self._redis is None:
+            url = redis_url()
+            if url is None:
+                return None
+            import redis
+            self._redis = redis.Redis.from_url(url, socket_timeout=5, socket_connect_timeout=5)
+        return self._redis
+
+    def _forward(self):
+        while True:
+            batch = [self._outbox.get()]
+            # Forward everything waiting in one round trip
+            while len(batch) < 100:
+                try:
+                    batch.append(self._outbox.get_nowait())
+                except queue.Empty:
+                    break
+            markers = [item for item in batch if isinstance(item, threading.Event)]
+            jobs = [item for item in batch if not isinstance(item, threading.Event)]
+            if jobs:
+                self._forward_jobs(jobs)
+            for marker in markers:
+                marker.set()
+
+    def _forward_jobs(self, jobs):
+        try:
+            client = self._get_redis()
+            if client is not None:
+                client.lpush(QUEUE_KEY, *[json.dumps(job) for job in jobs])
+                for job in jobs:
+                    notifications.inc(channel=job["channel"], result="queued")
+                return
+        except Exception as e:
+            logger.warning("Notification queue unavailable, delivering %d notifications locally: %s", len(jobs), e)
+        local = self._local_delivery()
+        for job in jobs:
+            notifications.inc(channel=job["channel"], result="local")
+            local.submit(job)
+
+
+dispatcher = NotificationDispatcher()
+
+
+def enqueue_vehicle_alert(car, alert_message, subject):
+    """Queue email and push notifications of a vehicle alert, safe to call from the event loop"""
+    dispatcher.enqueue(create_jobs(car, alert_message, subject))
+
+
+class NotificationWorker:
+    """Delivers jobs of the Redis queue, run by `manage.py notificationworker`"""
+
+    def __init__(self, client, concurrency=4, worker_id=None):
+        self.client = client
+        self.concurrency = concurrency
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.processing_key = PROCESSING_KEY_PREFIX + self.worker_id
+        self.heartbeat_key = HEARTBEAT_KEY_PREFIX + self.worker_id
+        self.max_attempts = _setting("NOTIFICATION_MAX_ATTEMPTS", 5)
+        self.stopping = False
+
+    async def run(self):
+        await self.heartbeat()
+        await self.recover()
+        tasks = [asyncio.create_task(self.consume()) for _ in range(self.concurrency)]
+        tasks.append(asyncio.create_task(self.maintain()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def heartbeat(self):
+        await self.client.set(self.heartbeat_key, time.time(), ex=HEARTBEAT_TTL)
+
+    async def recover(self):
+        """Move jobs of this worker's previous run and of dead workers back to the queue"""
+        async for key in self.client.scan_iter(match=PROCESSING_KEY_PREFIX + "*"):
+            key = key.decode() if isinstance(key, bytes) else key
+            worker_id = key[len(PROCESSING_KEY_PREFIX):]
+            if worker_id != self.worker_id and await self.client.exists(HEARTBEAT_KEY_PREFIX + worker_id):
+                continue
+            moved = 0
+            while await self.client.lmove(key, QUEUE_KEY, "RIGHT", "LEFT") is not None:
+                moved += 1
+            if moved:
+                logger.warning("Requeued %d notifications of worker %s", moved, worker_id)
+
+    async def maintain(self):
+        """Heartbeat, recovery of dead workers and moving due retries back to the queue"""
+        last_heartbeat = 0
+        while not self.stopping:
+            if time.monotonic() - last_heartbeat >= HEARTBEAT_INTERVAL:
+                await self.heartbeat()
+                await self.recover()
+                last_heartbeat = time.monotonic()
+            due = await self.client.zrangebyscore(RETRY_KEY, "-inf", time.time(), start=0, num=100)
+            for payload in due:
+                # Only the worker which removes the job requeues it
+                if await self.client.zrem(RETRY_KEY, payload):
+                    await self.client.lpush(QUEUE_KEY, payload)
+            await asyncio.sleep(1)
+
+    async def consume(self):
+        while not self.stopping:
+            payload = await self.client.blmove(QUEUE_KEY, self.processing_key, 5, "RIGHT", "LEFT")
+            if payload is None:
+                continue
+            try:
+                await self.handle(payload)
+            finally:
+                await self.client.lrem(self.processing_key, 1, payload)
+
+    async def handle(self, payload):
+        try:
+            job = json.loads(payload)
+        except ValueError:
+            logger.error("Dropping malformed notification job %r", payload)
+            return
+        try:
+            await deliver(job)
+        except Exception as e:
+            await self.failed(job, e)
+            return
+        notifications.inc(channel=job["channel"], result="delivered")
+
+    async def failed(self, job, error):
+        job["attempts"] += 1
+        if job["attempts"] >= self.max_attempts:
+            logger.error("Delivering %s notification %s failed, giving up: %s", job["channel"], job["id"], error)
+            notifications.inc(channel=job["channel"], result="failed")
+            job["error"] = str(error)
+            await self.client.lpush(FAILED_KEY, json.dumps(job))
+            await self.client.ltrim(FAILED_KEY, 0, FAILED_KEEP - 1)
+            return
+        delay = retry_delay(job["attempts"])
+        logger.warning("Delivering %s notification %s failed, retrying in %d s: %s",
+                       job["channel"], job["id"], delay, error)
+        notifications.inc(channel=job["channel"], result="retried")
+        await self.client.zadd(RETRY_KEY, {json.dumps(job): time.time() + delay})
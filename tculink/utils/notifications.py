@@ -1,15 +1,28 @@
 import asyncio
+import functools
+import logging
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 
 from aioapns import NotificationRequest, PushType, APNs
-from asgiref.sync import sync_to_async, async_to_sync
+from aioapns.common import APNS_RESPONSE_CODE
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.utils import translation
 from pyfcm import FCMNotification
+from pyfcm.errors import FCMNotRegisteredError, FCMSenderIdMismatchError
 
 from api.models import TokenMetadata
+from db.models import Car
+from tculink.utils import metrics
+from tculink.utils.notification_queue import enqueue_vehicle_alert
+
+logger = logging.getLogger(__name__)
 
 APNS_KEY_CONTENT = None
 
@@ -18,16 +31,8 @@ if settings.APNS_KEY:
         APNS_KEY_CONTENT = key_file.read()
 
 @sync_to_async
-def get_evinfo(car):
-    return car.ev_info
-
-@sync_to_async
-def get_location(car):
-    return car.location
-
-@sync_to_async
-def get_car_owner_info(car):
-    return car.owner
+def get_alert_car(car_id):
+    return Car.objects.select_related("owner", "ev_info", "location").filter(pk=car_id).first()
 
 @sync_to_async
 def get_push_tokens(user):
@@ -52,16 +57,11 @@ def translate_msg(lang, msg):
         return translation.gettext(msg)
 
 async def send_vehicle_alert_notification(car, alert_message, subject):
-    car_owner = await get_car_owner_info(car)
-    ev_info = await get_evinfo(car)
-    location = await get_location(car)
-
-    await send_email_for_user(car, car_owner, ev_info, location, alert_message, subject)
-    await send_push_notification_for_user(car, car_owner, alert_message, subject)
+    """Queue the notifications, they are delivered in the background"""
+    enqueue_vehicle_alert(car, alert_message, subject)
 
-@async_to_sync
-async def send_vehicle_alert_notification_sync(car, alert_message, subject):
-    await send_vehicle_alert_notification(car, alert_message, subject)
+def send_vehicle_alert_notification_sync(car, alert_message, subject):
+    enqueue_vehicle_alert(car, alert_message, subject)
 
 async def send_email_for_user(car, car_owner, ev_info, location, alert_message, subject):
     if not car_owner.email_notifications:
@@ -80,70 +80,167 @@ async def send_email_for_user(car, car_owner, ev_info, location, alert_message,
         },
     )
 
-    send_mail(
+    # Raises on failure, the delivery is retried by the notification queue
+    await sync_to_async(send_mail, thread_sensitive=False)(
         f"{subject} - OpenCARWINGS",
         text_content,
         settings.DEFAULT_FROM_EMAIL,
         [car_owner.email],
-        fail_silently=True
     )
 
 
 
 """
 Send Push notification messages via Apple APNS and other possible channels
+
+Push clients are created once and kept, so alerts reuse their HTTP/2 (APNs) and keep-alive (FCM)
+connections. All devices of a user are notified concurrently, tokens the providers report as
+no longer registered are cleared from TokenMetadata.
 """
+# APNs reasons of tokens which will never be valid again
+APNS_DEAD_TOKEN_REASONS = {"BadDeviceToken", "Unregistered", "DeviceTokenNotForTopic"}
+
+push_notifications = metrics.Counter("opencarwings_push_notifications_total", "Push notifications by provider and result",
+                                     ("provider", "result"))
+
+# aioapns binds its connection pool to the event loop it was created on
+_apns_clients = weakref.WeakKeyDictionary()
+_fcm_client = None
+_fcm_executor = None
+_push_lock = threading.Lock()
+
+
+def _reset_push_clients():
+    global _apns_clients, _fcm_client, _fcm_executor
+    _apns_clients = weakref.WeakKeyDictionary()
+    _fcm_client = None
+    _fcm_executor = None
+
+
+os.register_at_fork(after_in_child=_reset_push_clients)
+
+
+def get_apns_client():
+    """APNs client of the running event loop, None if APNs is not configured"""
+    loop = asyncio.get_running_loop()
+    client = _apns_clients.get(loop)
+    if client is None:
+        max_connections = getattr(settings, "PUSH_MAX_CONNECTIONS", 4)
+        if APNS_KEY_CONTENT:
+            client = APNs(
+                key=APNS_KEY_CONTENT,
+                key_id=settings.APNS_KEY_ID,
+                team_id=settings.APNS_TEAM_ID,
+                topic=settings.APNS_BUNDLE_ID,  # Bundle ID
+                use_sandbox=settings.APNS_USE_SANDBOX,
+                max_connections=max_connections,
+            )
+        elif settings.APNS_CERT:
+            client = APNs(
+                client_cert=settings.APNS_CERT,
+                use_sandbox=False,
+                max_connections=max_connections,
+            )
+        else:
+            return None
+        _apns_clients[loop] = client
+    return client
+
+
+def get_fcm_client():
+    """Shared FCM client and the executor its blocking requests run on, (None, None) if FCM is not configured"""
+    global _fcm_client, _fcm_executor
+    if not settings.FCM_SERVICE_FILE:
+        return None, None
+    with _push_lock:
+        if _fcm_client is None:
+            _fcm_client = FCMNotification(service_account_file=settings.FCM_SERVICE_FILE,
+                                          project_id=settings.FCM_PROJECT_ID)
+            # pyfcm keeps a requests session per thread, a small fixed pool keeps those connections alive
+            _fcm_executor = ThreadPoolExecutor(max_workers=getattr(settings, "PUSH_MAX_CONNECTIONS", 4),
+                                               thread_name_prefix="fcm")
+        return _fcm_client, _fcm_executor
+
+
+@sync_to_async
+def prune_push_tokens(push_keys):
+    """Clear push keys the providers no longer accept, the login tokens stay valid"""
+    return TokenMetadata.objects.filter(push_notification_key__in=push_keys).update(push_notification_key="")
+
+
+async def send_apns(client, token, lang, car, message, subject):
+    """Returns True when sent, False when the token is dead, raises on other failures"""
+    request = NotificationRequest(
+        device_token=token,
+        message={
+            "aps": {
+                "alert": {
+                    "title": translate_msg(lang, subject),
+                    "subtitle": car.nickname,
+                    "body": translate_msg(lang, message),
+                },
+                "sound": "default"
+            }
+        },
+        notification_id=str(uuid4()),
+        time_to_live=3,
+        push_type=PushType.ALERT,
+    )
+    result = await client.send_notification(request)
+    if result.is_successful:
+        return True
+    if result.status == APNS_RESPONSE_CODE.GONE or result.description in APNS_DEAD_TOKEN_REASONS:
+        return False
+    raise RuntimeError(f"APNs status {result.status} ({result.description})")
+
+
+async def send_fcm(client, executor, token, lang, car, message, subject):
+    """Returns True when sent, False when the token is dead, raises on other failures"""
+    notify = functools.partial(client.notify, fcm_token=token,
+                               notification_title=f"{car.nickname}: {translate_msg(lang, subject)}",
+                               notification_body=translate_msg(lang, message), timeout=10)
+    try:
+        await asyncio.get_running_loop().run_in_executor(executor, notify)
+    except (FCMNotRegisteredError, FCMSenderIdMismatchError):
+        return False
+    return True
+
+
 async def send_push_notification_for_user(car, car_owner, message, subject):
     tokens = await get_push_tokens(car_owner)
-    apns_client = None
-    fcm_client = None
-
-    if settings.FCM_SERVICE_FILE:
-        fcm_client = FCMNotification(service_account_file=settings.FCM_SERVICE_FILE, project_id=settings.FCM_PROJECT_ID)
-
-    if settings.APNS_CERT:
-        apns_client = APNs(
-            client_cert=settings.APNS_KEY,
-            use_sandbox=False,
-        )
-    if APNS_KEY_CONTENT:
-        apns_client = APNs(
-            key=APNS_KEY_CONTENT,
-            key_id=settings.APNS_KEY_ID,
-            team_id=settings.APNS_TEAM_ID,
-            topic=settings.APNS_BUNDLE_ID,  # Bundle ID
-            use_sandbox=settings.APNS_USE_SANDBOX,
-        )
+    sends = []
 
+    apns_client = get_apns_client() if tokens["apns"] else None
     if apns_client is not None:
         for apns_token, lang in tokens["apns"].items():
-            try:
-                request = NotificationRequest(
-                    device_token=apns_token,
-                    message={
-                        "aps": {
-                            "alert": {
-                                "title": translate_msg(lang, subject),
-                                "subtitle": car.nickname,
-                                "body": translate_msg(lang, message),
-                            },
-                            "sound": "default"
-                        }
-                    },
-                    notification_id=str(uuid4()),  # optional
-                    time_to_live=3,  # optional
-                    push_type=PushType.ALERT,  # optional
-                )
-                asyncio.get_running_loop().create_task(apns_client.send_notification(request))
-            except Exception as e:
-                print("Failed to send APNS notification:", e)
+            sends.append(("apns", apns_token, send_apns(apns_client, apns_token, lang, car, message, subject)))
 
+    fcm_client, fcm_executor = get_fcm_client() if tokens["fcm"] else (None, None)
     if fcm_client is not None:
         for fcm_token, lang in tokens["fcm"].items():
-            try:
-                result = fcm_client.notify(fcm_token=fcm_token, notification_title= f"{car.nickname}: {translate_msg(fcm_token[1], subject)}",
-                                    notification_body=translate_msg(lang, message))
-                print(result)
-            except Exception as e:
-                print("Failed to send FCM notification:", e)
+            sends.append(("fcm", fcm_token, send_fcm(fcm_client, fcm_executor, fcm_token, lang, car, message,
+                                                     subject)))
+
+    if not sends:
+        return
 
+    results = await asyncio.gather(*[send for _, _, send in sends], return_exceptions=True)
+    dead_tokens = []
+    errors = []
+    for (provider, token, _), result in zip(sends, results):
+        if isinstance(result, Exception):
+            logger.warning("Failed to send %s notification to %s...: %s", provider, token[:8], result)
+            push_notifications.inc(provider=provider, result="failed")
+            errors.append(result)
+        elif result:
+            push_notifications.inc(provider=provider, result="sent")
+        else:
+            logger.info("Pruning dead %s token %s...", provider, token[:8])
+            push_notifications.inc(provider=provider, result="pruned")
+            dead_tokens.append(token)
+
+    if dead_tokens:
+        await prune_push_tokens(dead_tokens)
+    # Retrying is only safe when no device got the notification yet
+    if errors and len(errors) == len(sends):
+        raise errors[0]
@@ -0,0 +1,176 @@
+"""
+Cache of the TCU identity and credentials of cars, keyed by VIN.
+
+Every packet from a TCU is authenticated against these values, caching them avoids
+querying the car and its owner for each packet. Lookups go through a small per-process
+LRU first and then the shared Django cache (Redis in production). Entries are
+invalidated from the model signals in db/signals.py.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from db.models import Car
+
+logger = logging.getLogger(__name__)
+
+# Car fields stored in the identity, owner credentials are added separately
+CAR_IDENTITY_FIELDS = ("tcu_model", "tcu_serial", "iccid", "disable_auth", "tcu_type", "owner_id")
+# Stored for VINs that are not registered, so unknown TCUs do not reach the database
+_MISSING = "missing"
+
+CACHE_KEY_PREFIX = "tcu_identity_"
+
+
+def _cache_ttl():
+    return getattr(settings, "TCU_IDENTITY_CACHE_TTL", 300)
+
+
+def _missing_ttl():
+    return getattr(settings, "TCU_IDENTITY_MISSING_TTL", 30)
+
+
+class LocalLRU:
+    """Thread-safe LRU with a per-entry expiry time"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + min(self.ttl, ttl if ttl is not None else self.ttl)
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Short lived, invalidations from other processes only reach the shared cache
+local_cache = LocalLRU(getattr(settings, "TCU_IDENTITY_LOCAL_SIZE", 4096),
+                       getattr(settings, "TCU_IDENTITY_LOCAL_TTL", 5))
+
+
+def _load_identity(vin):
+    try:
+        car = Car.objects.select_related("owner").only(
+            "id", "vin", *CAR_IDENTITY_FIELDS, "owner__username", "owner__tcu_pass_hash"
+        ).get(vin=vin)
+    except Car.DoesNotExist:
+        return None
+
+    identity = {field: getattr(car, field) for field in CAR_IDENTITY_FIELDS}
+    identity["car_id"] = car.pk
+    identity["vin"] = car.vin
+    identity["owner_username"] = car.owner.username
+    identity["owner_tcu_pass_hash"] = car.owner.tcu_pass_hash
+    return identity
+
+
+def _get_cached(vin):
+    value = local_cache.get(vin)
+    if value is not None:
+        return value
+    try:
+        value = cache.get(CACHE_KEY_PREFIX + vin)
+    except Exception as e:
+        # Shared cache is an optimization, fall back to the database
+        logger.warning("TCU identity cache unavailable: %s", e)
+        return None
+    if value is not None:
+        local_cache.set(vin, value)
+    return value
+
+
+def _set_cached(vin, value, ttl):
+    local_cache.set(vin, value, ttl)
+    try:
+        cache.set(CACHE_KEY_PREFIX + vin, value, ttl)
+    except Exception as e:
+        logger.warning("TCU identity cache unavailable: %s", e)
+
+
+def get_tcu_identity(vin):
+    """
+    Identity dict of the car with given VIN, or None if no such car is registered.
+
+    Keys: car_id, vin, tcu_model, tcu_serial, iccid, disable_auth, tcu_type, owner_id,
+    owner_username and owner_tcu_pass_hash.
+    """
+    if not vin:
+        return None
+    identity = _get_cached(vin)
+    if identity is None:
+        identity = _load_identity(vin)
+        if identity is None:
+            _set_cached(vin, _MISSING, _missing_ttl())
+        else:
+            _set_cached(vin, identity, _cache_ttl())
+    if identity == _MISSING:
+        return None
+    return identity
+
+
+def invalidate_tcu_identity(vin):
+    local_cache.delete(vin)
+    try:
+        cache.delete(CACHE_KEY_PREFIX + vin)
+    except Exception as e:
+        logger.warning("TCU identity cache unavailable: %s", e)
+
+
+def car_identity_changed(car, update_fields=None, previous_vin=None):
+    """
+    Invalidate the cached identity of a saved car if any of the identity fields may have changed.
+    Cars are saved after every packet, unchanged identities are kept. `previous_vin` is the VIN
+    the car was loaded with, its entry is dropped when the VIN changed.
+    """
+    if update_fields is not None:
+        changed_fields = set(update_fields)
+        if not changed_fields.intersection(CAR_IDENTITY_FIELDS + ("owner", "vin")):
+            return
+
+    if previous_vin is not None and previous_vin != car.vin:
+        invalidate_tcu_identity(previous_vin)
+
+    identity = _get_cached(car.vin)
+    if identity is None:
+        return
+    if identity != _MISSING and identity["car_id"] == car.pk and \
+            all(identity[field] == getattr(car, field) for field in CAR_IDENTITY_FIELDS):
+        return
+    invalidate_tcu_identity(car.vin)
+
+
+def owner_identity_changed(user, update_fields=None):
+    """Invalidate identities of all cars of a user whose credentials may have changed"""
+    if update_fields is not None and not set(update_fields).intersection(("username", "tcu_pass_hash")):
+        return
+    for vin in Car.objects.filter(owner=user).values_list("vin", flat=True):
+        invalidate_tcu_identity(vin)
@@ -0,0 +1,129 @@
+"""
+Logging of the TCU server off the event loop.
+
+Records are put on a queue by the serving threads and formatted and written to the log
+file by a listener thread, the event loop never waits for disk I/O. Full packet dumps are
+sampled per VIN, VINs in the debug capture list have every packet dumped. The capture
+list is kept in the shared cache so it can be changed at runtime with `manage.py tcucapture`.
+"""
+import logging
+import logging.handlers
+import queue
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_CACHE_KEY = "tcu_debug_capture_vins"
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+# Records buffered before new ones are dropped, the server must not stall on a slow disk
+QUEUE_SIZE = 10000
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler which leaves formatting to the listener thread. Arguments of records are
+    formatted later, they must not be modified after logging.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _log_handlers(log_file):
+    formatter = logging.Formatter(LOG_FORMAT)
+    file_handler = logging.FileHandler(log_file)
+    stream_handler = logging.StreamHandler()  # This keeps console output as well
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+    return file_handler, stream_handler
+
+
+def _set_root_handlers(handlers, level):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def start_queue_logging(log_file, level=logging.INFO):
+    """
+    Route root logger records through a queue to the log file and console, replacing any
+    previously configured handlers. Returns the started listener, stop it on exit to flush.
+    """
+    log_queue = queue.Queue(QUEUE_SIZE)
+    _set_root_handlers([DeferredQueueHandler(log_queue)], level)
+    listener = logging.handlers.QueueListener(log_queue, *_log_handlers(log_file), respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def start_direct_logging(log_file, level=logging.INFO):
+    """
+    Write root logger records to the log file and console from the logging thread. Used by
+    processes which fork, a listener thread would not exist in the children.
+    """
+    _set_root_handlers(_log_handlers(log_file), level)
+
+
+def get_capture_vins():
+    try:
+        return set(cache.get(CAPTURE_CACHE_KEY) or ())
+    except Exception as e:
+        logger.warning("Debug capture list unavailable: %s", e)
+        return set()
+
+
+def set_capture_vins(vins):
+    cache.set(CAPTURE_CACHE_KEY, sorted(vins), None)
+
+
+class PayloadSampler:
+    """
+    Decides which packets get their full payload logged. Captured VINs are dumped on every
+    packet, other VINs at most once per interval. An interval of 0 disables sampling.
+    """
+
+    def __init__(self, interval=None, max_tracked=100000):
+        self.interval = interval if interval is not None else getattr(settings, "TCU_LOG_SAMPLE_INTERVAL", 3600)
+        self.max_tracked = max_tracked
+        self.captured_vins = frozenset()
+        self._last_dump = {}
+
+    def is_captured(self, vin):
+        return vin in self.captured_vins
+
+    def should_dump(self, vin):
+        if vin in self.captured_vins:
+            return True
+        if not self.interval:
+            return False
+        now = time.monotonic()
+        last_dump = self._last_dump.get(vin)
+        if last_dump is not None and now - last_dump < self.interval:
+            return False
+        if len(self._last_dump) >= self.max_tracked:
+            self._last_dump.clear()
+        self._last_dump[vin] = now
+        return True
+
+    def refresh_capture(self):
+        """Reload the debug capture list from the shared cache, blocking"""
+        vins = frozenset(get_capture_vins())
+        if vins != self.captured_vins:
+            logger.info("Debug capture enabled for %d VINs", len(vins))
+        self.captured_vins = vins
@@ -0,0 +1,139 @@
+"""
+Async HTTP client for third-party APIs called while answering head units
+
+Sessions are bound to the event loop they were created on, like the APNs clients of
+notifications, and keep up to UPSTREAM_MAX_CONNECTIONS connections open, at most
+UPSTREAM_MAX_CONNECTIONS_PER_HOST of them to one API. Sync code, e.g. AutoDJ channels, uses
+request_sync which runs the request on a shared background event loop.
+
+close() closes the session of the running loop, the ASGI lifespan shutdown of carwings.asgi
+calls it. Servers without lifespan events, like daphne, leave the sessions to be closed at exit.
+"""
+import asyncio
+import atexit
+import json
+import os
+import threading
+import weakref
+
+import aiohttp
+from django.conf import settings
+
+from tculink.utils import metrics
+
+# Seconds to wait for an API, unless set by UPSTREAM_TIMEOUT or the request
+DEFAULT_TIMEOUT = 20
+
+_sessions = weakref.WeakKeyDictionary()
+_background_loop = None
+_background_lock = threading.Lock()
+
+
+def _discard(session):
+    """Forget a session whose loop can't close it, without closing the connections"""
+    session.detach()
+
+
+def _reset_sessions():
+    global _sessions, _background_loop
+    # The connections of the parent process are not ours to close
+    for session in _sessions.values():
+        _discard(session)
+    _sessions = weakref.WeakKeyDictionary()
+    _background_loop = None
+
+
+os.register_at_fork(after_in_child=_reset_sessions)
+
+
+class UpstreamResponse:
+    """Status and body of a response, read before its connection returned to the pool"""
+
+    def __init__(self, status_code, content, encoding=None):
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding or "utf-8"
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def get_session():
+    """HTTP session of the running event loop"""
+    loop = asyncio.get_running_loop()
+    for stale_loop in [stale_loop for stale_loop in _sessions if stale_loop.is_closed()]:
+        _discard(_sessions.pop(stale_loop))
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        max_connections = getattr(settings, "UPSTREAM_MAX_CONNECTIONS", 100)
+        connector = aiohttp.TCPConnector(
+            limit=max_connections,
+            limit_per_host=getattr(settings, "UPSTREAM_MAX_CONNECTIONS_PER_HOST", max_connections // 4))
+        session = aiohttp.ClientSession(
+            connector=connector, headers={"User-Agent": "OpenCARWINGS"},
+            timeout=aiohttp.ClientTimeout(total=getattr(settings, "UPSTREAM_TIMEOUT", DEFAULT_TIMEOUT)))
+        _sessions[loop] = session
+    return session
+
+
+async def close():
+    """Close the HTTP session of the running event loop"""
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+async def request(method, url, service, timeout=None, **kwargs):
+    """
+    Send a request, timed and counted as a call to `service`. Takes the arguments of
+    aiohttp.ClientSession.request, `timeout` in seconds.
+    """
+    if timeout is not None:
+        kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+    with metrics.track_outbound(service):
+        async with get_session().request(method, url, **kwargs) as response:
+            return UpstreamResponse(response.status, await response.read(), response.charset)
+
+
+async def get(url, service, **kwargs):
+    return await request("GET", url, service, **kwargs)
+
+
+async def post(url, service, **kwargs):
+    return await request("POST", url, service, **kwargs)
+
+
+def _get_background_loop():
+    global _background_loop
+    with _background_lock:
+        if _background_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="upstream", daemon=True).start()
+            _background_loop = loop
+        return _background_loop
+
+
+@atexit.register
+def _close_sessions():
+    for loop, session in list(_sessions.items()):
+        try:
+            if loop is _background_loop and loop.is_running():
+                asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout=5)
+            elif not loop.is_running() and not loop.is_closed():
+                loop.run_until_complete(session.close())
+            else:
+                _discard(session)
+        except Exception:
+            _discard(session)
+    loop = _background_loop
+    if loop is not None and loop.is_running():
+        loop.call_soon_threadsafe(loop.stop)
+
+
+def request_sync(method, url, service, **kwargs):
+    """request for sync code, the calling thread waits while the connections stay pooled"""
+    return asyncio.run_coroutine_threadsafe(request(method, url, service, **kwargs), _get_background_loop()).result()
@@ -0,0 +1,55 @@
+import threading
+from multiprocessing.sharedctypes import RawArray
+
+# Counters kept for every TCU server worker
+STAT_FIELDS = ("connections", "active_connections", "packets", "errors", "db_queue_depth",
+               "rejected", "timeouts", "shed")
+_FIELD_INDEX = {field: idx for idx, field in enumerate(STAT_FIELDS)}
+
+
+def create_shared_stats(workers):
+    """Shared memory block holding counters of all workers, must be created before forking"""
+    return RawArray('q', workers * len(STAT_FIELDS))
+
+
+class WorkerStats:
+    """
+    Counters of a single worker. Each worker only writes its own slot of the shared
+    array, the lock only guards against the worker's own threads. Without an array the
+    counters are process-local.
+    """
+
+    def __init__(self, array=None, slot=0):
+        self._array = array if array is not None else [0] * len(STAT_FIELDS)
+        self._offset = slot * len(STAT_FIELDS)
+        self._lock = threading.Lock()
+
+    def incr(self, field, amount=1):
+        with self._lock:
+            self._array[self._offset + _FIELD_INDEX[field]] += amount
+
+    def decr(self, field, amount=1):
+        self.incr(field, -amount)
+
+    def get(self, field):
+        return self._array[self._offset + _FIELD_INDEX[field]]
+
+    def reset_gauges(self):
+        """Clear counters which are only valid while the worker is running"""
+        self._array[self._offset + _FIELD_INDEX["active_connections"]] = 0
+        self._array[self._offset + _FIELD_INDEX["db_queue_depth"]] = 0
+
+    def as_dict(self):
+        return {field: self.get(field) for field in STAT_FIELDS}
+
+
+def aggregate_stats(array, workers):
+    totals = dict.fromkeys(STAT_FIELDS, 0)
+    for slot in range(workers):
+        for field, value in WorkerStats(array, slot).as_dict().items():
+            totals[field] += value
+    return totals
+
+
+def format_stats(stats):
+    return ", ".join(f"{field}: {value}" for field, value in stats.items())
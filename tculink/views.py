@@ -1,14 +1,21 @@
+import inspect
 import io
 import logging
+import time
+
+from asgiref.sync import sync_to_async
 
 from tculink.carwings_proto.applications.cp import handle_cp
 from tculink.carwings_proto.utils import update_car_info
 from tculink.httpgateway import ficosa
+from tculink.utils import metrics
 
 logger = logging.getLogger("carwings")
 
+from django.conf import settings
 from django.http import HttpResponse
 from django.shortcuts import redirect
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.csrf import csrf_exempt
 
 from tculink.carwings_proto.applications.ap import handle_ap
@@ -19,10 +26,36 @@ from tculink.carwings_proto.databuffer import decompress_body, parse_carwings_fi
 from tculink.carwings_proto.xml import parse_carwings_xml
 from rest_framework.decorators import authentication_classes, permission_classes
 
+# Handlers of CARWINGS applications. Async handlers only wait for third-party APIs, the others use the
+# database and run in a thread.
+CARWINGS_APPS = {
+    # Authentication
+    "AP": handle_ap,
+    # AutoDJ (information channels)
+    "DJ": handle_dj,
+    # Charge points
+    "CP": handle_cp,
+    # Probe (vehicle data)
+    "PI": handle_pi,
+    # google
+    "GLS": handle_gls,
+}
+
+
+async def handle_carwings_app(app_name, parsed_xml, files):
+    """Response of an application, None if it has none"""
+    handler = CARWINGS_APPS.get(app_name)
+    if handler is None:
+        return None
+    if inspect.iscoroutinefunction(handler):
+        return await handler(parsed_xml, files)
+    return await sync_to_async(handler)(parsed_xml, files)
+
+
 @authentication_classes([])
 @permission_classes([])
 @csrf_exempt
-def carwings_http_gateway(request):
+async def carwings_http_gateway(request):
     """Handle Carwings telematics POST request."""
     # Check headers
     if request.method != 'POST' or request.headers.get('Content-Type') != 'application/x-carwings-nz'\
@@ -34,15 +67,16 @@ def carwings_http_gateway(request):
     if not compressed_data:
         return HttpResponse(status=400)
 
-    decompressed_body = decompress_body(compressed_data)
-    files = parse_carwings_files(decompressed_body)
+    with metrics.parse_seconds.time(protocol="carwings"):
+        decompressed_body = decompress_body(compressed_data)
+        files = parse_carwings_files(decompressed_body)
 
-    # Parse XML
-    if not files[0]['name'].endswith('.xml'):
-        logger.warning("No XML file!")
-        return HttpResponse(status=400)
+        # Parse XML
+        if not files[0]['name'].endswith('.xml'):
+            logger.warning("No XML file!")
+            return HttpResponse(status=400)
 
-    parsed_xml = parse_carwings_xml(files[0]['content'].decode('utf-8'))
+        parsed_xml = parse_carwings_xml(files[0]['content'].decode('utf-8'))
 
     logger.info("XML:")
     logger.info(parsed_xml)
@@ -51,40 +85,20 @@ def carwings_http_gateway(request):
         logger.warning("No service info in XML file!")
         return HttpResponse(status=400)
 
-    update_car_info(parsed_xml)
+    app_name = parsed_xml["service_info"]["application"]["name"]
+    metrics.gateway_requests.inc(gateway="carwings", app=app_name)
 
-    resp_buffer = bytearray()
-
-    # Authentication
-    if parsed_xml["service_info"]["application"]["name"] == "AP":
-        ap_resp = handle_ap(parsed_xml, files)
-        if ap_resp is not None:
-            resp_buffer = ap_resp
-
-    # AutoDJ (information channels)
-    if parsed_xml["service_info"]["application"]["name"] == "DJ":
-        dj_resp = handle_dj(parsed_xml, files)
-        if dj_resp is not None:
-            resp_buffer = dj_resp
+    with metrics.db_seconds.time(protocol="carwings"):
+        await sync_to_async(update_car_info)(parsed_xml)
 
-    # Charge points
-    if parsed_xml["service_info"]["application"]["name"] == "CP":
-        cp_resp = handle_cp(parsed_xml, files)
-        if cp_resp is not None:
-            resp_buffer = cp_resp
-
-    # Probe (vehicle data)
-    if parsed_xml["service_info"]["application"]["name"] == "PI":
-         pi_resp = handle_pi(parsed_xml, files)
-         if pi_resp is not None:
-             resp_buffer = pi_resp
+    resp_buffer = bytearray()
+    response_started = time.perf_counter()
 
-    # google
-    if parsed_xml["service_info"]["application"]["name"] == "GLS":
-        gls_resp = handle_gls(parsed_xml, files)
-        if gls_resp is not None:
-            resp_buffer = gls_resp
+    app_resp = await handle_carwings_app(app_name, parsed_xml, files)
+    if app_resp is not None:
+        resp_buffer = app_resp
 
+    metrics.response_seconds.observe(time.perf_counter() - response_started, protocol="carwings", app=app_name)
     logger.info("Binary response length: %d", len(resp_buffer))
 
     # Return binary response
@@ -97,4 +111,16 @@ def ficosa_http_gateway(request):
     """Handle FICOSA TCU POST request."""
     if request.method != 'POST' or request.headers.get('Content-Type') != 'application/octet-stream':
         return redirect('/')
-    return ficosa.handle_request(request)
\ No newline at end of file
+    return ficosa.handle_request(request)
+
+def metrics_endpoint(request):
+    """Prometheus scrape endpoint, disabled unless METRICS_TOKEN is set"""
+    token = getattr(settings, "METRICS_TOKEN", None)
+    if not token:
+        return HttpResponse(status=404)
+    if not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponse(status=401)
+
+    # Values of this process are included without waiting for the flush interval
+    metrics.REGISTRY.flush()
+    return HttpResponse(metrics.REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
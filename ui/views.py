@@ -35,6 +35,7 @@ from tculink.carwings_proto.autodj.channels import get_info_channel_data
 from tculink.carwings_proto.probe_config import PROBE_CONFIGS, PROBE_CONFIG_INFO
 from tculink.coordinators import get_required_sms_types, get_supported_commands
 from tculink.coordinators.ficosa2016 import Ficosa2016
+from tculink.sms import get_provider_class
 from tculink.gdc_proto.ficosa.utils import CONFIGURATION_MAP, get_config_map_translated
 from tculink.utils.password_hash import check_password_validity, password_hash
 from .forms import Step2Form, Step3Form, SettingsForm, ChangeCarwingsPasswordForm, AccountForm, SignUpForm, \
@@ -49,19 +50,11 @@ SETUP_STEPS = [
     {"index": 5, "name": _("Car added")},
 ]
 
-def get_class( kls ):
-    parts = kls.split('.')
-    module = ".".join(parts[:-1])
-    m = __import__( module )
-    for comp in parts[1:]:
-        m = getattr(m, comp)
-    return m
-
 UI_SMS_PROVIDERS = []
 
 
 for provider_id, provider in django.conf.settings.SMS_PROVIDERS.items():
-    provider_class = get_class(provider[1])
+    provider_class = get_provider_class(provider_id)
     link = None
     if hasattr(provider_class, 'LINK'):
         link = provider_class.LINK